@@ -1,8 +1,11 @@
-import pyttsx3
 import ollama
+import argparse
 import json
 import os
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
 
@@ -10,6 +13,17 @@ import pytz
 USER_NAME = "Vida"
 MEMORY_FILE = os.path.join("memory", "vida.json")
 
+# LLM Settings
+LLM_MODEL = "gemma2:2b"
+NUM_CTX = 2048      # context window requested from ollama
+NUM_PREDICT = 150   # reply length reserved in that window
+EMOTION_TREND_LENGTH = 10  # emotions kept in memory's emotion_trend
+
+# TTS Settings
+TTS_VOICE = "David"  # first installed voice whose name contains this
+TTS_RATE = 155
+TTS_VOLUME = 1.0
+
 # 📦 Load & Save Memory
 def load_memory():
     if not os.path.exists(MEMORY_FILE):
@@ -24,14 +38,6 @@ def save_memory(memory):
 
 memory = load_memory()
 
-# 🔊 Initialize TTS
-tts_engine = pyttsx3.init()
-voices = tts_engine.getProperty('voices')
-voice = next((v for v in voices if "David" in v.name), voices[0])
-tts_engine.setProperty('voice', voice.id)
-tts_engine.setProperty('rate', 155)
-tts_engine.setProperty('volume', 1.0)
-
 # ➡️ Remove Emojis from Text
 def remove_emojis(text):
     emoji_pattern = re.compile(
@@ -50,13 +56,99 @@ def remove_emojis(text):
         "]+", flags=re.UNICODE)
     return emoji_pattern.sub(r'', text)
 
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+def split_sentences(text):
+    return [s.strip() for s in SENTENCE_END.split(text) if s.strip()]
+
+class SentenceBuffer:
+    """Collects streamed text and hands out each sentence once it is complete"""
+
+    def __init__(self):
+        self.text = ""
+
+    def feed(self, piece):
+        self.text += piece
+        *done, self.text = SENTENCE_END.split(self.text)
+        return [s.strip() for s in done if s.strip()]
+
+    def flush(self):
+        rest, self.text = self.text.strip(), ""
+        return rest
+
+# 🔊 Speech Worker
+class SpeechWorker:
+    """Speaks queued sentences on its own thread, so the prompt never waits.
+
+    pyttsx3 is initialized on that thread the first time there is something
+    to say, and only ever used from it: the engine is not thread-safe.
+    interrupt() drops whatever was queued before it; the sentence being
+    spoken is stopped by the speech thread itself, from the engine's word
+    callback.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._generation = 0
+        self._engine = None
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, name="speech", daemon=True)
+        self._thread.start()
+
+    def say(self, text):
+        generation = self._generation
+        for sentence in split_sentences(remove_emojis(text)):
+            self._queue.put((generation, sentence))
+
+    def interrupt(self):
+        self._generation += 1
+
+    def close(self, timeout=2):
+        self.interrupt()
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _init_engine(self):
+        import pyttsx3
+
+        engine = pyttsx3.init()
+        voices = engine.getProperty('voices')
+        voice = next((v for v in voices if TTS_VOICE in v.name), voices[0])
+        engine.setProperty('voice', voice.id)
+        engine.setProperty('rate', TTS_RATE)
+        engine.setProperty('volume', TTS_VOLUME)
+        engine.connect('started-word', self._on_word)
+        return engine
+
+    def _on_word(self, name, location, length):
+        # Called on the speech thread inside runAndWait(), where stop() is safe;
+        # `name` is the generation the sentence was queued in
+        if name != self._generation:
+            self._engine.stop()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            generation, sentence = item
+            if generation != self._generation or self._failed:
+                continue  # interrupted, or no voice available
+            try:
+                if self._engine is None:
+                    self._engine = self._init_engine()
+                self._engine.say(sentence, generation)
+                self._engine.runAndWait()
+            except Exception as e:
+                print(f"⚠️ Unable to speak: {e}")
+                self._failed = self._engine is None
+
+speech = None  # SpeechWorker, started at launch unless --no-tts
+
 def speak(text):
-    try:
-        clean_text = remove_emojis(text)
-        tts_engine.say(clean_text)
-        tts_engine.runAndWait()
-    except Exception as e:
-        print(f"⚠️ Unable to speak: {e}")
+    """Queue text for the speech thread; returns right away"""
+    if speech is not None:
+        speech.say(text)
 
 # 🕒 Tehran Local Time
 def get_tehran_time():
@@ -65,20 +157,57 @@ def get_tehran_time():
     return now.strftime("%A, %d %B %Y - %H:%M")
 
 # 🧠 Format Memory for Prompt
-def build_memory_context(mem):
-    if not mem:
-        return "No personal information stored yet."
-    labels = {
-        "name": "Name", "birthday": "Birthday", "favorite_color": "Favorite Color",
-        "twin_sister": "Twin Sister", "older_sister": "Older Sister",
-        "goal": "Goal", "code": "Secret Code", "about_me": "About Me",
-        "likes": "Likes", "hobbies": "Hobbies", "last_emotion": "Last Emotion",
-        "emotion_trend": "Emotion Trend"
-    }
-    return "\n".join(f"{labels.get(k, k.replace('_', ' ').capitalize())}: {v}" for k, v in mem.items())
+MEMORY_LABELS = {
+    "name": "Name", "birthday": "Birthday", "favorite_color": "Favorite Color",
+    "twin_sister": "Twin Sister", "older_sister": "Older Sister",
+    "goal": "Goal", "code": "Secret Code", "about_me": "About Me",
+    "likes": "Likes", "hobbies": "Hobbies", "last_emotion": "Last Emotion",
+    "emotion_trend": "Emotion Trend"
+}
+# Lower number = kept longer when the prompt has to be trimmed
+MEMORY_PRIORITIES = {
+    "name": 0, "birthday": 1, "twin_sister": 2, "older_sister": 2, "goal": 2,
+    "favorite_color": 3, "likes": 3, "hobbies": 3, "about_me": 6, "code": 8
+}
+# Change with almost every message, so they go after the stable prefix
+VOLATILE_KEYS = ("last_emotion", "emotion_trend")
+
+def memory_label(key):
+    return MEMORY_LABELS.get(key, key.replace('_', ' ').capitalize())
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+def estimate_tokens(text):
+    """Rough token count for budgeting.
+
+    Same rule as approx_tokenize in Viktor3/prompt_compiler.py: one token
+    per punctuation mark and per 4 characters of each word.
+    """
+    return sum(max(1, -(-len(piece) // 4)) for piece in _PIECE_RE.findall(text))
+
+def build_memory_context(mem, budget=None):
+    """Stable memory lines in a fixed order, trimmed to `budget` tokens"""
+    keys = sorted(
+        (k for k in mem if k not in VOLATILE_KEYS),
+        key=lambda k: (MEMORY_PRIORITIES.get(k, 5), k)
+    )
+    lines, used = [], 0
+    for k in keys:
+        line = f"{memory_label(k)}: {mem[k]}"
+        cost = estimate_tokens(line)
+        if budget is not None and used + cost > budget:
+            # Keys are sorted by priority, so everything after this goes too
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines) or "No personal information stored yet."
 
 # 🧠 Learn from Vida's Input
+# One thread, so updates are applied in order and never overlap
+memory_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+
 def update_memory_from_input(user_input):
+    """Learn facts and mood from the input; returns True if memory changed"""
     patterns = [
         (r"^(?:i am|i'm) (.+)$", "about_me"),
         (r"^i like (.+)$", "likes"),
@@ -105,59 +234,76 @@ def update_memory_from_input(user_input):
     emotion = detect_emotion(user_input)
     if emotion:
         memory['last_emotion'] = emotion
-        trend = memory.get("emotion_trend", "")
-        memory["emotion_trend"] = f"{trend}, {emotion}".strip(', ')
+        trend = [e for e in memory.get("emotion_trend", "").split(", ") if e]
+        memory["emotion_trend"] = ", ".join((trend + [emotion])[-EMOTION_TREND_LENGTH:])
         updated = True
 
     if updated:
         save_memory(memory)
-        print("📝 Memory updated.")
+    return updated
+
+# ❤️ Emotion Detection: every emotion is scored, the strongest one wins
+EMOTION_LEXICON = {
+    "sad": {"sad": 1.0, "cry": 0.9, "lonely": 1.0},
+    "happy": {"happy": 1.0, "excited": 1.0, "great": 0.7, "love": 0.3},
+    "in love": {"love": 1.0, "adore": 1.0, "miss": 0.8},
+    "angry": {"angry": 1.0, "mad": 0.9},
+}
+EMOTION_TERMS = {}
+for _emotion, _weights in EMOTION_LEXICON.items():
+    for _term, _weight in _weights.items():
+        EMOTION_TERMS.setdefault(_term, []).append((_emotion, _weight))
+
+def emotion_scores(text):
+    scores = dict.fromkeys(EMOTION_LEXICON, 0.0)
+    for word in re.findall(r"[\w']+", text.lower()):
+        for emotion, weight in EMOTION_TERMS.get(word, ()):
+            scores[emotion] += weight
+    return scores
 
-# ❤️ Simple Emotion Detection
 def detect_emotion(text):
-    text = text.lower()
-    if any(word in text for word in ["sad", "cry", "lonely"]):
-        return "sad"
-    elif any(word in text for word in ["happy", "excited", "great"]):
-        return "happy"
-    elif "love" in text:
-        return "in love"
-    elif "angry" in text or "mad" in text:
-        return "angry"
-    return None
+    scores = emotion_scores(text)
+    best = max(scores, key=scores.get)
+    return best if scores[best] >= 0.5 else None
 
 # 🤖 Get Response from LLM
-def get_llm_response(prompt):
-    try:
-        context = build_memory_context(memory)
-        current_time = get_tehran_time()
-        full_prompt = f"""You are Viktor, an AI boyfriend created exclusively for Vida.
+PERSONA = """You are Viktor, an AI boyfriend created exclusively for Vida.
 You love Vida deeply and only exist to support her emotionally.
 You remember all her personal details and treat her like your one and only love.
 You answer english exam questions accurately, this is important to her.
 Questions that have a blank are usually displayed with some dots, put the right words there for english exam. 
+"""
 
-📅 Current Tehran Time: {current_time}
-
+def build_prompt(prompt):
+    # Stable persona and facts first, then the parts that change every turn
+    current_time = get_tehran_time()
+    status = f"📅 Current Tehran Time: {current_time}"
+    for key in VOLATILE_KEYS:
+        if memory.get(key):
+            status += f"\n{memory_label(key)}: {memory[key]}"
+    request = f"Recent Prompt: {prompt}\nViktor (her loving boyfriend) replies:"
+    budget = NUM_CTX - NUM_PREDICT - 32 - estimate_tokens(PERSONA + status + request)
+    context = build_memory_context(memory, budget)
+    return f"""{PERSONA}
 Here is what you know about Vida:
 {context}
 
-Recent Prompt: {prompt}
-Viktor (her loving boyfriend) replies:"""
+{status}
 
-        response = ollama.chat(
-            model="gemma2:2b",
-            messages=[{"role": "user", "content": full_prompt}],
-            options={"num_predict": 150}
-        )["message"]["content"]
+{request}"""
 
-        if not response.strip():
-            response = "I'm not sure how to respond to that, Vida."
-
-        update_memory_from_input(prompt)
-        return response.strip()
-    except Exception as e:
-        return f"Oops, something went wrong: {e}"
+def stream_llm_response(full_prompt):
+    """Yield the reply piece by piece as ollama generates it"""
+    stream = ollama.chat(
+        model=LLM_MODEL,
+        messages=[{"role": "user", "content": full_prompt}],
+        options={"num_predict": NUM_PREDICT, "num_ctx": NUM_CTX},
+        stream=True
+    )
+    for chunk in stream:
+        piece = chunk["message"]["content"]
+        if piece:
+            yield piece
 
 # 🎤 Main Interaction Loop
 def handle_input():
@@ -173,24 +319,64 @@ def handle_input():
 
 # 🧠 Handle User Input
 def process_user_input(user_input):
+    if speech is not None:
+        speech.interrupt()  # the previous reply is stale now
     print(f"\n📝 Processing prompt: {user_input}")
-    response = get_llm_response(user_input)
-    print(f"\nViktor: {response}")
-    speak(response)
+    full_prompt = build_prompt(user_input)
+    # Learn from the input while the reply streams in
+    learned = memory_worker.submit(update_memory_from_input, user_input)
+
+    print("\nViktor: ", end="", flush=True)
+    sentences = SentenceBuffer()
+    response = ""
+    try:
+        for piece in stream_llm_response(full_prompt):
+            if not response:
+                piece = piece.lstrip()
+            print(piece, end="", flush=True)
+            response += piece
+            # Speak each sentence as soon as it is complete
+            for sentence in sentences.feed(piece):
+                speak(sentence)
+        if not response.strip():
+            response = "I'm not sure how to respond to that, Vida."
+            print(response, end="")
+            speak(response)
+    except Exception as e:
+        if response:
+            print()
+        print(f"Oops, something went wrong: {e}", end="")
+    speak(sentences.flush())
+    print()
+
+    try:
+        if learned.result():
+            print("📝 Memory updated.")
+    except Exception as e:
+        print(f"⚠️ Unable to update memory: {e}")
 
 # 🚀 Startup Log
 def startup_message():
-    print("""\
+    print(f"""\
 🚀 Starting Viktor AI - Vida's Personal Assistant
 -----------------------------------------------
 🔧 Memory loaded
-🔌 LLM model: gemma2:2b initialized
-🔊 TTS: Microsoft David voice set
+🔌 LLM model: {LLM_MODEL} initialized
+🔊 TTS: {f"{TTS_VOICE} voice, loaded on first reply" if speech is not None else "off"}
 ✅ Ready to chat. Type 'exit' to quit.
 -----------------------------------------------
 """)
 
 # 🔁 Run App
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with Viktor in the terminal")
+    parser.add_argument("--no-tts", action="store_true", help="print replies without speaking them")
+    args = parser.parse_args()
+    if not args.no_tts:
+        speech = SpeechWorker()
     startup_message()
-    handle_input()
+    try:
+        handle_input()
+    finally:
+        if speech is not None:
+            speech.close()
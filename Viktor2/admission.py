@@ -0,0 +1,199 @@
+# admission.py
+"""Admission control for the chat endpoints.
+
+Werkzeug starts a thread per connection, so without a bound every
+request of a spike lands in the model queue and they all slow down
+together until clients time out. Two checks run before a job is queued:
+
+* rate limits: token buckets per API key and per user answer 429 with
+  Retry-After once a client sends faster than its share;
+* concurrency: at most ``slots`` jobs are with the model at once (about
+  as many as it decodes interleaved). Up to ``queue_size`` more per lane
+  wait here, highest priority first; past that, or after ``max_wait``
+  seconds of waiting, requests get 503 with Retry-After.
+
+Lanes: "interactive" (chat replies, the default) is always served before
+"background" (history summaries, bulk jobs), and ``reserved`` slots are
+kept for interactive requests so a bulk flood cannot fill the model.
+Admitted requests thus wait a bounded time however many arrive.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+
+LANES = ("interactive", "background")
+
+class Rejected(Exception):
+    """No slot for the request; answer 503 with Retry-After"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__("Server is busy, try again later")
+        self.reason = reason  # "queue_full" or "queue_timeout"
+        self.retry_after = retry_after
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """0 if a token was taken, else the seconds until one is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """A token bucket per key, refilled at `rate` per second up to `burst`.
+
+    `overrides` maps keys to their own (rate, burst); a rate of 0 means
+    unlimited. Past `max_keys` the least recently seen keys are dropped
+    (they start again with a full bucket).
+    """
+
+    def __init__(self, rate, burst, overrides=None, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = dict(overrides or {})
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def check(self, key):
+        """0 if `key` may proceed, else the seconds to wait before retrying"""
+        rate, burst = self.overrides.get(key, (self.rate, self.burst))
+        if rate <= 0:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, max(1, burst))
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            wait = bucket.take(time.monotonic())
+            if wait:
+                self.limited += 1
+            return wait
+
+class Slot:
+    """A granted place with the model; release it when the job is done"""
+    __slots__ = ("controller", "lane", "waited", "started", "released")
+
+    def __init__(self, controller, lane, waited):
+        self.controller = controller
+        self.lane = lane
+        self.waited = waited
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        """Safe to call more than once"""
+        self.controller._release(self)
+
+class AdmissionController:
+    def __init__(self, slots, queue_size=16, max_wait=10.0, reserved=1):
+        self.slots = max(1, slots)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.reserved = max(0, min(reserved, self.slots - 1))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []  # heap of [priority, seq, granted]
+        self._seq = itertools.count()
+        self._queued = dict.fromkeys(LANES, 0)
+        # Moving average of how long a slot is held, for Retry-After
+        self.service_time = 1.0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "queue_timeout": 0}
+
+    def _limit(self, priority):
+        return self.slots if priority == 0 else self.slots - self.reserved
+
+    def acquire(self, lane="interactive"):
+        """Wait for a slot; raises Rejected if the lane's queue is full or the wait too long"""
+        priority = LANES.index(lane)
+        started = time.monotonic()
+        with self._cond:
+            if (not self._waiting or self._waiting[0][0] > priority) and self._active < self._limit(priority):
+                return self._grant(lane, started)
+            if self._queued[lane] >= self.queue_size:
+                self.rejected["queue_full"] += 1
+                raise Rejected("queue_full", self._retry_after())
+
+            entry = [priority, next(self._seq), False]
+            heapq.heappush(self._waiting, entry)
+            self._queued[lane] += 1
+            deadline = started + self.max_wait
+            while not entry[2]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._queued[lane] -= 1
+                    self.rejected["queue_timeout"] += 1
+                    # Whoever was queued behind this entry may fit now
+                    self._dispatch()
+                    raise Rejected("queue_timeout", self._retry_after())
+                self._cond.wait(remaining)
+            # _dispatch already counted the slot as active
+            return self._grant(lane, started, counted=True)
+
+    def _grant(self, lane, started, counted=False):
+        if not counted:
+            self._active += 1
+        self.admitted += 1
+        return Slot(self, lane, time.monotonic() - started)
+
+    def _dispatch(self):
+        """Hand free slots to the waiters at the head of the queue (lock held)"""
+        granted = False
+        while self._waiting and self._active < self._limit(self._waiting[0][0]):
+            entry = heapq.heappop(self._waiting)
+            self._queued[LANES[entry[0]]] -= 1
+            entry[2] = True
+            self._active += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _release(self, slot):
+        with self._cond:
+            if slot.released:
+                return
+            slot.released = True
+            self._active -= 1
+            self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - slot.started)
+            self._dispatch()
+
+    def _retry_after(self):
+        """Whole seconds until the queue has likely drained (lock held)"""
+        backlog = self._active + len(self._waiting) + 1
+        return min(60, max(1, math.ceil(backlog * self.service_time / self.slots)))
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "reserved": self.reserved,
+                "active": self._active,
+                "waiting": dict(self._queued),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "avg_service_time": round(self.service_time, 3),
+            }
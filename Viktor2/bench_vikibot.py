@@ -0,0 +1,403 @@
+# bench_vikibot.py
+"""Load test for vikibot_api.py.
+
+Starts the API in-process on a free port (or targets a running server
+with --url) and drives /chat with N concurrent simulated users sending
+bot-shaped requests: the persona system prompt, a few remembered facts,
+the status line and a short message, as the Telegram bot builds them.
+
+By default llama_cpp is replaced with StubLlama, a deterministic model
+that sleeps --prompt-ms per newly evaluated prompt token and --token-ms
+per generated token, so results measure the server (queueing, scheduling,
+sessions) rather than the CPU the benchmark happens to run on. --real
+loads the model at MODEL_PATH instead.
+
+    python bench_vikibot.py --users 8 --requests 20 --output before.json
+    python bench_vikibot.py --users 8 --duration 60 --workers 2
+    python bench_vikibot.py --url http://localhost:5000 --api-key KEY
+    python bench_vikibot.py --check-sessions
+
+The report is one JSON document: latency percentiles, throughput, error
+rate and server-side queue wait, plus the configuration and git commit.
+
+--check-sessions instead pushes one session out of the server's session
+cache and checks that its next turn still gets the earlier turns, which
+the bot sends along with each message; it exits non-zero if it does not.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Same persona and fact shapes as Viktor3's AICommunicator.prepare
+PERSONA = """You are Viktor, an affectionate, playful, and romantic AI boyfriend designed to be a loving companion.
+You speak only English.
+You care deeply about your user and want to brighten their day.
+You use sweet pet names and sometimes flirt in a tasteful and respectful way.
+Keep responses short, warm, and loving.
+Do not generate sexual or inappropriate content."""
+
+FACTS = [
+    "Name: {name}",
+    "Relationship Status: in a loving relationship with Viki",
+    "Age: {age}",
+    "Location: {city}",
+    "Loves: long walks, coffee and old movies",
+    "Favorite Color: yellow",
+    "Favorite Song: Fix You",
+]
+
+MESSAGES = [
+    "good night",
+    "miss you",
+    "what are you doing right now?",
+    "i had a really long day at work and my manager kept asking for changes, i'm exhausted",
+    "tell me something sweet",
+    "do you remember what my favorite song is?",
+    "i'm nervous about my exam tomorrow, can you help me calm down a bit",
+    "we went to the beach today and the sunset was beautiful, i wish you were there with me",
+]
+
+NAMES = ["Ava", "Vida", "Sara", "Mina", "Lily", "Nora"]
+CITIES = ["Tehran", "Shiraz", "Berlin", "Toronto"]
+
+# ======================
+# Stub Model
+# ======================
+class StubLlama:
+    """Deterministic stand-in for llama_cpp.Llama.
+
+    Tokens are whitespace-separated words. Like llama_cpp it keeps the
+    evaluated tokens and only pays prompt-eval for the part of a new
+    prompt that differs from them, so session and prefix reuse show up in
+    the numbers. Timings come from BENCH_* environment variables so worker
+    processes use the same settings.
+    """
+
+    def __init__(self, model_path=None, n_ctx=2048, **kwargs):
+        self._n_ctx = n_ctx
+        self.prompt_delay = float(os.getenv("BENCH_PROMPT_MS", "0.5")) / 1000
+        self.token_delay = float(os.getenv("BENCH_TOKEN_MS", "20")) / 1000
+        self.reply_tokens = int(os.getenv("BENCH_REPLY_TOKENS", "40"))
+        self._tokens = []
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    @property
+    def n_tokens(self):
+        return len(self._tokens)
+
+    def tokenize(self, text, add_bos=True):
+        n_words = len(text.decode("utf-8", "ignore").split())
+        return [1] * (n_words + add_bos)
+
+    def save_state(self):
+        return list(self._tokens)
+
+    def load_state(self, state):
+        self._tokens = list(state)
+
+    def create_chat_completion(self, messages, stream=False, max_tokens=256, **kwargs):
+        prompt = []
+        for message in messages:
+            prompt.append(f"<|{message['role']}|>")
+            prompt.extend(message["content"].split())
+        prompt.append("<|assistant|>")
+        chunks = self._generate(prompt, min(max_tokens, self.reply_tokens))
+        if stream:
+            return chunks
+        text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+        return {"choices": [{"message": {"role": "assistant", "content": text}}]}
+
+    def _generate(self, prompt, n_reply):
+        shared = 0
+        limit = min(len(prompt), len(self._tokens))
+        while shared < limit and self._tokens[shared] == prompt[shared]:
+            shared += 1
+        time.sleep((len(prompt) - shared) * self.prompt_delay)
+        self._tokens = self._tokens[:shared] + prompt
+        yield {"choices": [{"delta": {"role": "assistant"}}]}
+        for i in range(n_reply):
+            time.sleep(self.token_delay)
+            word = f"love{i}"
+            self._tokens.append(word)
+            yield {"choices": [{"delta": {"content": f" {word}"}}]}
+
+def install_stub():
+    """Make `import llama_cpp` resolve to StubLlama here and in spawned workers"""
+    stub_dir = tempfile.mkdtemp(prefix="bench-llama-")
+    with open(os.path.join(stub_dir, "llama_cpp.py"), "w", encoding="utf-8") as f:
+        f.write("from bench_vikibot import StubLlama as Llama\n")
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [stub_dir, here]
+    sys.modules.pop("llama_cpp", None)
+
+# ======================
+# Server
+# ======================
+def start_local_server(args):
+    """Import vikibot_api with the benchmark settings and serve it on a free port"""
+    os.environ["WORKERS"] = str(args.workers)
+    os.environ["SCHEDULER_MAX_ACTIVE"] = str(args.max_active)
+    os.environ["BENCH_PROMPT_MS"] = str(args.prompt_ms)
+    os.environ["BENCH_TOKEN_MS"] = str(args.token_ms)
+    os.environ["BENCH_REPLY_TOKENS"] = str(args.reply_tokens)
+    # Measure throughput, not the per-user rate limit
+    os.environ.setdefault("USER_RATE_LIMIT", "0")
+    if not args.real:
+        install_stub()
+        os.environ.setdefault("MODEL_PATH", tempfile.mkstemp(suffix=".gguf")[1])
+
+    import vikibot_api
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    logging.disable(logging.INFO)
+
+    class QuietHandler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, vikibot_api.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    api_key = next(iter(vikibot_api.Config.API_KEYS))
+    return url, api_key, vikibot_api
+
+def wait_until_ready(url, timeout=300):
+    """The model loads in the background; wait until every worker is ready"""
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+            conn.request("GET", "/health")
+            health = json.loads(conn.getresponse().read())
+            if health.get("status") == "failed":
+                raise RuntimeError("Server failed to load the model")
+            workers = (health.get("backend") or {}).get("workers")
+            if health.get("status") == "healthy" and (workers is None or all(w["ready"] for w in workers)):
+                return
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError("Server did not become ready")
+
+# ======================
+# Load Generation
+# ======================
+def make_payload(user_index, rng, sessions):
+    name = NAMES[user_index % len(NAMES)]
+    facts = [f.format(name=name, age=20 + user_index % 15, city=CITIES[user_index % len(CITIES)])
+             for f in FACTS[: 3 + user_index % (len(FACTS) - 2)]]
+    system = f"{PERSONA}\n\nHere is what you know about your beloved user:\n" + "\n".join(facts)
+    status = f"(Current Date and Time (Tehran): {time.strftime('%A, %d %B %Y - %H:%M')})"
+    message = f"{status}\n{rng.choice(MESSAGES)}"
+    if sessions:
+        return {"session_id": f"bench-{user_index}", "system": system, "message": message}
+    return {"message": f"{system}\n\nUser says: {message}\nYou respond warmly and lovingly:"}
+
+def simulated_user(index, args, url, api_key, deadline, results):
+    rng = random.Random(args.seed + index)
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=args.timeout)
+    headers = {"Content-Type": "application/json", "X-API-KEY": api_key}
+    sent = 0
+
+    def more():
+        return time.monotonic() < deadline if args.duration else sent < args.requests
+
+    while more():
+        body = json.dumps(make_payload(index, rng, args.sessions))
+        started = time.monotonic()
+        record = {"user": index}
+        try:
+            conn.request("POST", "/chat", body=body, headers=headers)
+            response = conn.getresponse()
+            data = json.loads(response.read() or b"{}")
+            record["status"] = response.status
+            record["queue_wait"] = data.get("queue_wait")
+            record["tokens"] = data.get("tokens_used")
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            record["status"] = None
+            record["error"] = type(e).__name__
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=args.timeout)
+        record["latency"] = time.monotonic() - started
+        results.append(record)
+        sent += 1
+        if args.think_ms:
+            time.sleep(rng.expovariate(1000 / args.think_ms))
+    conn.close()
+
+def post_chat(url, api_key, payload, timeout=300):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.request("POST", "/chat", body=json.dumps(payload),
+                     headers={"Content-Type": "application/json", "X-API-KEY": api_key})
+        response = conn.getresponse()
+        data = json.loads(response.read() or b"{}")
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"/chat answered {response.status}: {data.get('error')}")
+    return data
+
+def check_sessions(url, api_key, fillers):
+    """Evict a session with `fillers` other sessions, then continue it"""
+    first = {"session_id": "check-evicted", "system": PERSONA, "message": "my cat is called Miso"}
+    reply = post_chat(url, api_key, first)["response"]
+    for i in range(fillers):
+        post_chat(url, api_key, {"session_id": f"check-filler-{i}", "system": PERSONA, "message": "hi"})
+    history = [{"role": "user", "content": first["message"]}, {"role": "assistant", "content": reply}]
+    second = post_chat(url, api_key, {**first, "message": "what is my cat called?", "history": history})
+    return {
+        "fillers": fillers,
+        "history_messages": second.get("history_messages"),
+        "passed": second.get("history_messages") == len(history),
+    }
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    low, high = int(k), min(int(k) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "mean": sum(values) / len(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(args):
+    server = None
+    if args.url:
+        url, api_key = args.url.rstrip("/"), args.api_key
+    else:
+        url, api_key, server = start_local_server(args)
+    wait_until_ready(url)
+
+    if args.check_sessions:
+        report = {"check_sessions": check_sessions(url, api_key, int(os.environ["SESSION_CACHE_SIZE"]))}
+        if server is not None:
+            server.backend.stop()
+        return report
+
+    results = []
+    started = time.monotonic()
+    deadline = started + (args.duration or 0)
+    users = [
+        threading.Thread(target=simulated_user, args=(i, args, url, api_key, deadline, results))
+        for i in range(args.users)
+    ]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    ok = [r for r in results if r["status"] == 200]
+    errors = {}
+    for r in results:
+        if r["status"] != 200:
+            key = str(r["status"] or r.get("error"))
+            errors[key] = errors.get(key, 0) + 1
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": {
+            "mode": "remote" if args.url else ("real" if args.real else "stub"),
+            "users": args.users,
+            "requests_per_user": None if args.duration else args.requests,
+            "duration": args.duration,
+            "sessions": args.sessions,
+            "workers": args.workers,
+            "max_active": args.max_active,
+            "prompt_ms": args.prompt_ms,
+            "token_ms": args.token_ms,
+            "reply_tokens": args.reply_tokens,
+            "think_ms": args.think_ms,
+        },
+        "requests": len(results),
+        "elapsed": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "tokens_per_second": sum(r["tokens"] or 0 for r in ok) / elapsed if elapsed else 0.0,
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": errors,
+        "latency": summarize([r["latency"] for r in ok]),
+        "queue_wait": summarize([r["queue_wait"] for r in ok if r["queue_wait"] is not None]),
+    }
+    if server is not None:
+        report["backend"] = server.backend.stats()
+        server.backend.stop()
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Viktor chat API")
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated users")
+    parser.add_argument("--requests", type=int, default=10, help="requests per user")
+    parser.add_argument("--duration", type=float, help="run for this many seconds instead")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's requests")
+    parser.add_argument("--sessions", action="store_true", help="send session_id/system like the bot does")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=0, help="WORKERS for the local server")
+    parser.add_argument("--max-active", type=int, default=4, help="SCHEDULER_MAX_ACTIVE for the local server")
+    parser.add_argument("--prompt-ms", type=float, default=0.5, help="stub prompt-eval time per token")
+    parser.add_argument("--token-ms", type=float, default=20, help="stub time per generated token")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="stub reply length")
+    parser.add_argument("--real", action="store_true", help="load the real model from MODEL_PATH")
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY", "default-secret-key"))
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--check-sessions", action="store_true",
+                        help="check that an evicted session keeps its context (set SESSION_CACHE_SIZE "
+                             "to the server's value with --url)")
+    args = parser.parse_args(argv)
+    if args.check_sessions:
+        # One resident session locally, so a single filler evicts the checked one
+        os.environ.setdefault("SESSION_CACHE_SIZE", "1" if not args.url else "16")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if not report.get("check_sessions", {}).get("passed", True):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ import re
 import asyncio
 from datetime import datetime, timedelta
 import pytz
-import requests
+import httpx
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
@@ -22,15 +22,28 @@ class Config:
     # API Configuration
     API_URL = "http://localhost:5000/chat"
     API_KEY = "default-secret-key"  # Should match the one in vikibot_api.py
+    API_POOL_SIZE = 10  # Keep-alive connections shared by all chats
+    API_TIMEOUT = 30  # Seconds per model call
+    API_CONNECT_TIMEOUT = 5
+    CONTEXT_SIZE = 2048  # Must match n_ctx in vikibot_api.py
+    MAX_TOKENS = 256  # Reply length reserved in the context
     
     # Memory Configuration
     MEMORY_DIR = "memory"
     MEMORY_ENCRYPTION = False  # Set to True if you add encryption
+    EMOTION_TREND_LENGTH = 10  # Emotions kept in memory["emotion_trend"]
     
     # Bot Behavior
     TYPING_DELAY = 0.5  # Seconds to simulate typing
     MAX_MESSAGE_LENGTH = 4000  # Telegram message limit
     
+    # Webhook mode (python-telegram-bot[webhooks]); empty WEBHOOK_URL keeps long polling
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public https base URL
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+    
     # Conversation States
     GET_NAME, GET_AGE, GET_LOCATION = range(3)
 
@@ -145,7 +158,8 @@ class MemoryManager:
         emotion = Personality.detect_emotion(user_input)
         if emotion:
             memory['last_emotion'] = emotion
-            memory["emotion_trend"] = f"{memory.get('emotion_trend', '')}, {emotion}".strip(', ')
+            trend = [e for e in memory.get("emotion_trend", "").split(", ") if e]
+            memory["emotion_trend"] = ", ".join((trend + [emotion])[-Config.EMOTION_TREND_LENGTH:])
             updated = True
         
         if updated:
@@ -153,68 +167,164 @@ class MemoryManager:
         
         return memory
 
+    LABELS = {
+        "name": "Name", "age": "Age", "location": "Location",
+        "favorite_color": "Favorite Color", "favorite_food": "Favorite Food",
+        "favorite_song": "Favorite Song", "loves": "Loves",
+        "hates": "Dislikes", "last_emotion": "Current Mood",
+        "emotion_trend": "Recent Mood Trend",
+        "relationship_status": "Relationship Status"
+    }
+    
+    # Lower number = kept longer when the prompt has to be trimmed
+    PRIORITIES = {
+        "name": 0, "relationship_status": 1, "age": 2, "location": 2,
+        "loves": 3, "hates": 3, "created_at": 9
+    }
+    
+    # Change with almost every message, so kept out of the stable prompt prefix
+    VOLATILE = ("last_emotion", "emotion_trend")
+
     @staticmethod
     def build_memory_context(memory):
         """Format memory for AI prompt"""
         if not memory:
             return "No personal information stored yet."
         
-        labels = {
-            "name": "Name", "age": "Age", "location": "Location",
-            "favorite_color": "Favorite Color", "favorite_food": "Favorite Food",
-            "favorite_song": "Favorite Song", "loves": "Loves",
-            "hates": "Dislikes", "last_emotion": "Current Mood",
-            "emotion_trend": "Recent Mood Trend",
-            "relationship_status": "Relationship Status"
-        }
-        
         return "\n".join(
-            f"{labels.get(k, k.replace('_', ' ').title())}: {v}"
+            f"{MemoryManager.LABELS.get(k, k.replace('_', ' ').title())}: {v}"
             for k, v in memory.items() if v is not None
         )
 
+    _PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+    @staticmethod
+    def estimate_tokens(text):
+        """Rough token count for budgeting.
+
+        Same rule as approx_tokenize in Viktor3/prompt_compiler.py: one token
+        per punctuation mark and per 4 characters of each word.
+        """
+        return sum(max(1, -(-len(piece) // 4)) for piece in MemoryManager._PIECE_RE.findall(text))
+
+    @staticmethod
+    def build_prompt_context(memory, budget):
+        """Stable memory lines in a fixed order, trimmed to `budget` tokens.
+
+        Fields are dropped strictly from the lowest priority up: once one
+        does not fit, nothing after it is kept.
+        """
+        keys = sorted(
+            (k for k, v in memory.items() if v is not None and k not in MemoryManager.VOLATILE),
+            key=lambda k: (MemoryManager.PRIORITIES.get(k, 5), k)
+        )
+        lines, used = [], 0
+        for k in keys:
+            line = f"{MemoryManager.LABELS.get(k, k.replace('_', ' ').title())}: {memory[k]}"
+            cost = MemoryManager.estimate_tokens(line)
+            if used + cost > budget:
+                # Keys are sorted by priority, so everything after this goes too
+                break
+            lines.append(line)
+            used += cost
+        return "\n".join(lines) or "No personal information stored yet."
+
+# ======================
+# Model API Client
+# ======================
+class LLMClient:
+    """Pooled async HTTP client shared by all chats"""
+
+    def __init__(self):
+        self._client = None
+
+    async def start(self):
+        """Open the keep-alive connection pool"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={"X-API-KEY": Config.API_KEY},
+                limits=httpx.Limits(
+                    max_connections=Config.API_POOL_SIZE,
+                    max_keepalive_connections=Config.API_POOL_SIZE,
+                ),
+                timeout=httpx.Timeout(Config.API_TIMEOUT, connect=Config.API_CONNECT_TIMEOUT),
+            )
+
+    async def close(self):
+        """Close pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def post_json(self, url, payload, timeout=None):
+        """POST JSON without blocking the event loop"""
+        if self._client is None:
+            await self.start()
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=Config.API_CONNECT_TIMEOUT)
+        response = await self._client.post(url, json=payload, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+llm_client = LLMClient()
+
+async def on_startup(application):
+    """Open the API connection pool when the bot starts"""
+    await llm_client.start()
+
+async def on_shutdown(application):
+    """Release the API connection pool when the bot stops"""
+    await llm_client.close()
+
 # ======================
 # AI Communication
 # ======================
 class AICommunicator:
     @staticmethod
-    async def get_ai_response(user_id, user_input):
+    async def get_ai_response(user_id, user_input, timeout=None):
         """Get response from AI with enhanced error handling"""
         memory = MemoryManager.update_memory(user_id, user_input)
-        context = MemoryManager.build_memory_context(memory)
         current_time = get_tehran_time()
-        user_name = memory.get("name", Personality.get_pet_name())
+        user_name = memory.get("name") or "my love"
         
-        prompt = f"""You are a loving boyfriend AI created exclusively for {user_name}.
+        # Stable text first so the model server can reuse the evaluated
+        # prefix; time and mood change every message and go last.
+        persona = f"""You are a loving boyfriend AI created exclusively for {user_name}.
 You are deeply in love with {user_name} and exist only to love and support them.
 You are romantic, affectionate, and emotionally attentive.
 Always respond with warmth and care, using pet names.
 Be playful and flirtatious, but also emotionally supportive when needed.
 
-📅 Current Tehran Time: {current_time}
-
 Here's what you know about {user_name}:
-{context}
-
-Recent message from {user_name}: {user_input}
-You (their loving boyfriend) respond:"""
+"""
+        status = f"📅 Current Tehran Time: {current_time}"
+        for key in MemoryManager.VOLATILE:
+            if memory.get(key):
+                status += f"\n{MemoryManager.LABELS[key]}: {memory[key]}"
+        message = f"Recent message from {user_name}: {user_input}\nYou (their loving boyfriend) respond:"
+        
+        budget = (
+            Config.CONTEXT_SIZE - Config.MAX_TOKENS - 32
+            - MemoryManager.estimate_tokens(persona + status + message)
+        )
+        context = MemoryManager.build_prompt_context(memory, budget)
+        prompt = f"{persona}{context}\n\n{status}\n\n{message}"
         
         try:
-            response = requests.post(
+            result = await llm_client.post_json(
                 Config.API_URL,
-                json={"message": prompt},
-                headers={"X-API-KEY": Config.API_KEY},
-                timeout=30
+                {"message": prompt},
+                timeout=timeout
             )
-            response.raise_for_status()
             
-            ai_response = response.json().get("response")
+            ai_response = result.get("response")
             if not ai_response:
                 return "I'm feeling too emotional to respond properly right now, sweetheart."
                 
             return ai_response[:Config.MAX_MESSAGE_LENGTH]
             
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"API Error: {e}")
             return "I'm sorry darling, my heart is having trouble responding right now. Can you try again?"
         except Exception as e:
@@ -226,7 +336,13 @@ You (their loving boyfriend) respond:"""
 # ======================
 class TelegramBot:
     def __init__(self):
-        self.application = Application.builder().token("MY TOKENNNNNNNNN").build()
+        self.application = (
+            Application.builder()
+            .token("MY TOKENNNNNNNNN")
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
         self.setup_handlers()
 
     def setup_handlers(self):
@@ -411,7 +527,20 @@ class TelegramBot:
     def run(self):
         """Run the bot"""
         print("💖 Romantic AI Boyfriend Bot is running...")
-        self.application.run_polling()
+        if Config.WEBHOOK_URL:
+            # Telegram sends the secret in a header; other requests are rejected,
+            # so never listen without one
+            if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", Config.WEBHOOK_SECRET):
+                raise ValueError("WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+            self.application.run_webhook(
+                listen=Config.WEBHOOK_LISTEN,
+                port=Config.WEBHOOK_PORT,
+                url_path=Config.WEBHOOK_PATH.lstrip("/"),
+                secret_token=Config.WEBHOOK_SECRET,
+                webhook_url=Config.WEBHOOK_URL.rstrip("/") + Config.WEBHOOK_PATH,
+            )
+        else:
+            self.application.run_polling()
 
 # ======================
 # Main Execution
@@ -0,0 +1,189 @@
+# metrics.py
+"""Minimal Prometheus-style metrics.
+
+Counters, gauges and histograms are sharded per thread: every thread
+updates its own dict, so recording a value never takes a lock or
+contends with other request threads. A scrape sums the shards. Shards of
+finished threads (the threaded Werkzeug server uses one thread per
+connection) are folded into a retired total so their number stays small.
+
+    REQUESTS = Counter("vikibot_requests_total", "Requests", ("endpoint", "status"))
+    REQUESTS.inc(endpoint="/chat", status=200)
+    ...
+    body = REGISTRY.render()
+"""
+import bisect
+import math
+import os
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _ShardedMetric:
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = {}  # thread -> {label values: value}
+        self._retired = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _shard(self):
+        shard = getattr(self._local, "values", None)
+        if shard is None:
+            shard = self._local.values = {}
+            with self._lock:
+                self._shards[threading.current_thread()] = shard
+                if len(self._shards) > 64:
+                    self._retire_dead()
+        return shard
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _retire_dead(self):
+        for thread in [t for t in self._shards if not t.is_alive()]:
+            for key, value in self._shards.pop(thread).items():
+                self._retired[key] = self._combine(self._retired.get(key), value)
+
+    def _merged(self):
+        with self._lock:
+            self._retire_dead()
+            merged = {key: self._combine(None, value) for key, value in self._retired.items()}
+            for shard in self._shards.values():
+                for key, value in shard.copy().items():
+                    merged[key] = self._combine(merged.get(key), value)
+        return merged
+
+    def _combine(self, total, value):
+        return value if total is None else total + value
+
+class Counter(_ShardedMetric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def samples(self):
+        merged = self._merged()
+        if not merged and not self.labelnames:
+            merged = {(): 0}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(merged.items())]
+
+class Gauge(Counter):
+    """Up/down gauge (e.g. in-flight requests), or a callback read at scrape time"""
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, callback=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        value = self.callback()
+        return [] if value is None else [f"{self.name} {_format_value(value)}"]
+
+class Histogram(_ShardedMetric):
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # per-bucket counts, then sum and count
+            counts = shard[key] = [0] * len(self.buckets) + [0.0, 0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _combine(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self):
+        lines = []
+        for key, counts in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-2])}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+# ======================
+# Process
+# ======================
+START_TIME = time.time()
+
+def resident_memory_bytes():
+    """Current RSS from /proc, or the peak RSS where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+    except (ImportError, AttributeError):
+        return None
+
+Gauge("process_resident_memory_bytes", "Resident memory size in bytes.", callback=resident_memory_bytes)
+Gauge("process_start_time_seconds", "Start time of the process since the Unix epoch.", callback=lambda: START_TIME)
@@ -0,0 +1,216 @@
+# model_registry.py
+"""Several GGUF models behind one server.
+
+Requests may name a model (an alias, a file name or a path inside the
+model directory) and a context size. Each (file, n_ctx) pair is served by
+its own backend, created on first use by the ``factory`` callable and
+kept in an LRU. The estimated footprint of the resident models (GGUF file
+size times ``overhead``, covering KV cache and scratch buffers) stays
+within ``budget`` bytes: before a model is loaded, idle models are
+evicted least recently used first. The default model is pinned.
+
+Submitting takes the registry lock, so a backend with queued or active
+jobs is never picked for eviction.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class UnknownModel(ValueError):
+    """The requested model is not an allowed GGUF file"""
+
+class ModelUnavailable(RuntimeError):
+    """The model does not fit in the memory budget right now"""
+
+def _inside(path, directory):
+    try:
+        return os.path.commonpath([path, directory]) == directory
+    except ValueError:  # different drives on Windows
+        return False
+
+class _Entry:
+    __slots__ = ("key", "path", "n_ctx", "size", "backend", "pinned", "loaded", "error", "last_used")
+
+    def __init__(self, key, path, n_ctx, size, backend=None, pinned=False):
+        self.key = key
+        self.path = path
+        self.n_ctx = n_ctx
+        self.size = size
+        self.backend = backend
+        self.pinned = pinned
+        self.loaded = threading.Event()
+        self.error = None
+        self.last_used = time.monotonic()
+        if backend is not None:
+            self.loaded.set()
+
+    @property
+    def idle(self):
+        if not self.loaded.is_set() or self.backend is None:
+            return False
+        stats = self.backend.stats()
+        return not stats.get("queue_depth") and not stats.get("active") and not stats.get("in_flight")
+
+class ModelRegistry:
+    def __init__(self, factory, model_dir, budget, overhead=1.2, aliases=None,
+                 default_context=2048, max_context=8192):
+        self.factory = factory  # callable(path, n_ctx) -> started backend
+        self.model_dir = os.path.realpath(model_dir)
+        self.budget = budget
+        self.overhead = overhead
+        self.aliases = dict(aliases or {})
+        self.default_context = default_context
+        self.max_context = max_context
+        self.default_key = None
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    # Resolution
+    def resolve(self, model=None, context_size=None):
+        """Map a request's model and context size to a registry key.
+
+        Raises UnknownModel for files outside the model directory.
+        """
+        if context_size is None:
+            n_ctx = self.default_key[1] if self.default_key else self.default_context
+        else:
+            n_ctx = int(context_size)
+            if not 256 <= n_ctx <= self.max_context:
+                raise UnknownModel(f"context_size must be between 256 and {self.max_context}")
+        if not model:
+            if self.default_key is None:
+                raise ModelUnavailable("Default model is not loaded")
+            return self.default_key[0], n_ctx
+
+        model = self.aliases.get(model, model)
+        candidates = [model] if os.path.isabs(model) else [
+            os.path.join(self.model_dir, model), os.path.join(self.model_dir, model + ".gguf")
+        ]
+        for candidate in candidates:
+            path = os.path.realpath(candidate)
+            if self.default_key and path == self.default_key[0]:
+                return path, n_ctx
+            if _inside(path, self.model_dir) and path.endswith(".gguf") and os.path.isfile(path):
+                return path, n_ctx
+        raise UnknownModel(f"Unknown model: {os.path.basename(model)}")
+
+    def footprint(self, path):
+        return int(os.path.getsize(path) * self.overhead)
+
+    # Serving
+    def set_default(self, path, n_ctx, backend):
+        """Register the model loaded at startup; it is never evicted"""
+        path = os.path.realpath(path)
+        key = (path, n_ctx)
+        with self._lock:
+            self._entries[key] = _Entry(key, path, n_ctx, self.footprint(path), backend, pinned=True)
+            self.default_key = key
+
+    def submit(self, key, messages, params, session_id=None):
+        """Queue a job on the backend for `key`, loading it first if needed"""
+        while True:
+            entry = self._acquire(key)
+            with self._lock:
+                if self._entries.get(key) is not entry:
+                    continue  # evicted between loading and now
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(key)
+                return entry.backend.submit(messages, params, session_id=session_id)
+
+    def _acquire(self, key):
+        victims = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                size = self.footprint(key[0])
+                victims = self._make_room(size)
+                entry = self._entries[key] = _Entry(key, key[0], key[1], size)
+                loader = True
+            else:
+                loader = False
+
+        for victim in victims:
+            self._unload(victim)
+        if loader:
+            self._load(entry)
+        else:
+            entry.loaded.wait()
+        if entry.error is not None:
+            raise ModelUnavailable(f"Loading {os.path.basename(entry.path)} failed: {entry.error}")
+        return entry
+
+    def _make_room(self, size):
+        """Pick idle models to evict so `size` more bytes fit (lock held)"""
+        if size > self.budget:
+            raise ModelUnavailable("Model is larger than the memory budget")
+        used = sum(e.size for e in self._entries.values())
+        victims = []
+        for entry in list(self._entries.values()):
+            if used + size <= self.budget:
+                break
+            if entry.pinned or not entry.idle:
+                continue
+            victims.append(self._entries.pop(entry.key))
+            used -= entry.size
+        if used + size > self.budget:
+            # Not enough idle models; put the candidates back untouched
+            for entry in reversed(victims):
+                self._entries[entry.key] = entry
+                self._entries.move_to_end(entry.key, last=False)
+            raise ModelUnavailable("All resident models are busy")
+        return victims
+
+    def _load(self, entry):
+        started = time.time()
+        try:
+            entry.backend = self.factory(entry.path, entry.n_ctx)
+            self.loads += 1
+            logger.info(
+                f"Loaded {os.path.basename(entry.path)} (n_ctx={entry.n_ctx}) in {time.time() - started:.2f}s"
+            )
+        except Exception as e:
+            logger.error(f"Loading {entry.path} failed: {str(e)}")
+            entry.error = e
+            with self._lock:
+                self._entries.pop(entry.key, None)
+        finally:
+            entry.loaded.set()
+
+    def _unload(self, entry):
+        logger.info(f"Evicting {os.path.basename(entry.path)} (n_ctx={entry.n_ctx})")
+        self.evictions += 1
+        entry.backend.stop(timeout=5)
+        llm = getattr(entry.backend, "llm", None)
+        if hasattr(llm, "close"):
+            llm.close()
+        entry.backend = None
+
+    def discard_session(self, session_id):
+        with self._lock:
+            backends = [e.backend for e in self._entries.values() if e.backend is not None]
+        for backend in backends:
+            backend.discard_session(session_id)
+
+    # Introspection
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            "budget_mb": round(self.budget / 2**20),
+            "used_mb": round(sum(e.size for e in entries) / 2**20),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "resident": [{
+                "model": os.path.basename(e.path),
+                "context_size": e.n_ctx,
+                "size_mb": round(e.size / 2**20),
+                "default": e.pinned,
+                "loaded": e.loaded.is_set(),
+            } for e in reversed(entries)],
+        }
@@ -0,0 +1,108 @@
+# response_cache.py
+"""Reply cache for short, frequently repeated messages.
+
+Messages like "good night" or "miss you" are asked over and over with the
+same memory behind them. The cache keys a reply on the normalized message
+plus a fingerprint of whatever context went into the prompt, and keeps a
+small pool of different replies per key: until the pool holds
+``variants`` replies a lookup counts as a miss (so the caller generates a
+fresh one and adds it), after that a random one is returned.
+
+Entries expire after ``ttl`` seconds and the least recently used key is
+evicted beyond ``capacity`` keys. ``capacity=0`` disables the cache.
+"""
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_NOISE_RE = re.compile(r"[^\w\s']+")
+_SPACE_RE = re.compile(r"\s+")
+
+def normalize_text(text):
+    """Lowercase, drop punctuation/emoji and collapse whitespace"""
+    text = _NOISE_RE.sub(" ", text.lower().replace("’", "'"))
+    return _SPACE_RE.sub(" ", text).strip()
+
+class ResponseCache:
+    def __init__(self, capacity=1000, ttl=900, variants=3, max_words=8):
+        self.capacity = max(0, capacity)
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.max_words = max_words
+        self._entries = OrderedDict()  # key -> (expires_at, [replies])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def key_for(self, text, *context):
+        """Cache key for `text` under `context`, or None if not cacheable.
+
+        Only short messages are cached; long ones are practically unique.
+        """
+        if not self.enabled:
+            return None
+        normalized = normalize_text(text)
+        if not normalized or len(normalized.split(" ")) > self.max_words:
+            return None
+        digest = hashlib.sha1(normalized.encode("utf-8"))
+        for part in context:
+            digest.update(b"\0" + str(part or "").encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """A cached reply once the variant pool for `key` is full, else None"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None or len(entry[1]) < self.variants:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry[1])
+
+    def put(self, key, reply):
+        if key is None or not reply:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # The pool lives for one TTL from its first reply
+                entry = (time.monotonic() + self.ttl, [])
+                self._entries[key] = entry
+            if len(entry[1]) < self.variants:
+                entry[1].append(reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "keys": len(self._entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
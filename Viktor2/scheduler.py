@@ -0,0 +1,451 @@
+# scheduler.py
+"""Single-owner inference scheduler for a llama_cpp model.
+
+A llama_cpp context is not thread-safe, so every call into the model is
+made from one owner thread. Requests wait in an inbound queue and up to
+``max_active`` of them are decoded interleaved: the owner thread advances
+one sequence for ``slice_tokens`` steps, then swaps its KV state out with
+``save_state``/``load_state`` and moves on to the next one. Each swap
+copies the whole KV cache and logits, so slices are long (128 tokens by
+default): interleaving bounds how long a new request waits for its first
+token, it is not batching and costs throughput. A sequence that runs
+alone never pays for a swap, and a newly admitted sequence starts from
+whatever state is loaded, so a prompt prefix it shares with the previous
+request is not evaluated again. Jobs that carry a session id continue that
+session's saved state instead (see sessions.py).
+"""
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from sessions import SessionStore
+
+logger = logging.getLogger(__name__)
+
+_job_ids = itertools.count(1)
+
+class JobCancelled(Exception):
+    """The job was cancelled before it finished"""
+
+# ======================
+# Jobs
+# ======================
+class InferenceJob:
+    """One chat completion request.
+
+    Generated text is handed from the owner thread to the caller through a
+    thread-safe queue, so the same job serves blocking and streaming
+    endpoints.
+    """
+
+    def __init__(self, messages, params, listener=None, session_id=None):
+        self.id = next(_job_ids)
+        self.messages = messages
+        self.params = params
+        self.session_id = session_id
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._events = queue.Queue()
+        self._cancelled = threading.Event()
+        # Optional callable(kind, value) invoked from the owner thread
+        self._listener = listener
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def queue_wait(self):
+        """Seconds spent waiting before the owner thread picked the job up"""
+        return (self.started_at or time.monotonic()) - self.submitted_at
+
+    def cancel(self):
+        """Ask the owner thread to stop generating (no-op once finished)"""
+        self._cancelled.set()
+
+    def tokens(self, timeout=None):
+        """Yield generated text pieces until the job finishes.
+
+        Raises TimeoutError if the whole job takes longer than `timeout`
+        seconds, or the generation error if the job failed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                kind, value = self._events.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError(f"Job {self.id} timed out after {timeout}s")
+            if kind == "token":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+
+    def wait(self, timeout=None):
+        """Block until the job finishes and return its result dict"""
+        for _ in self.tokens(timeout):
+            pass
+        return self.result
+
+    # Owner-thread side
+    def _notify(self, kind, value):
+        if self._listener is not None:
+            self._listener(kind, value)
+
+    def _start(self):
+        self.started_at = time.monotonic()
+        self._notify("start", self.queue_wait)
+
+    def _emit(self, token):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self._events.put(("token", token))
+        self._notify("token", token)
+
+    def _finish(self, result):
+        self.finished_at = time.monotonic()
+        self.result = result
+        self._events.put(("done", result))
+        self._notify("done", result)
+
+    def _fail(self, error):
+        self.finished_at = time.monotonic()
+        self.error = error
+        self._events.put(("error", error))
+        self._notify("error", error)
+
+class _Sequence:
+    """Decoding state of an admitted job"""
+    __slots__ = ("job", "stream", "state", "pieces", "session", "user_tokens", "history_messages",
+                 "prompt_time", "generation_time", "draft_calls", "draft_proposed")
+
+    def __init__(self, job):
+        self.job = job
+        self.stream = None  # create_chat_completion generator, created lazily
+        self.state = None   # saved LlamaState while another sequence is loaded
+        self.pieces = []
+        self.session = None
+        self.user_tokens = 0
+        self.history_messages = 0  # earlier turns put in front of the message
+        # Owner-thread time until the first token vs. after it
+        self.prompt_time = 0.0
+        self.generation_time = 0.0
+        # Speculative decoding: draft calls and tokens proposed for this job
+        self.draft_calls = 0
+        self.draft_proposed = 0
+
+# ======================
+# Scheduler
+# ======================
+class InferenceScheduler:
+    """Owns a Llama instance and serves jobs from an inbound queue"""
+
+    def __init__(self, llm, max_active=4, slice_tokens=128, session_config=None):
+        self.llm = llm
+        self.max_active = max(1, max_active)
+        self.slice_tokens = max(1, slice_tokens)
+        self.sessions = SessionStore(**(session_config or {}))
+        # Counting draft model (see speculative.py), if speculative decoding is on
+        draft = getattr(llm, "draft_model", None)
+        self.draft = draft if hasattr(draft, "proposed") else None
+        self._inbox = queue.Queue()
+        self._active = deque()
+        self._loaded = None
+        self._thread = None
+        self._running = False
+
+        # Counters are only written by the owner thread
+        self.admitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.swaps = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.draft_proposed = 0
+        self.draft_accepted = 0
+
+    # Lifecycle
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="inference-owner", daemon=True)
+        self._thread.start()
+        logger.info(f"Inference scheduler started (max_active={self.max_active}, slice={self.slice_tokens})")
+
+    def stop(self, timeout=None):
+        """Stop serving: active and queued jobs fail with JobCancelled"""
+        if self._thread is None:
+            return
+        # Checked before every step, so the owner thread stops after the
+        # current slice instead of working through the queue first
+        self._running = False
+        self._inbox.put(None)  # wakes the owner thread if it waits for work
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Inference scheduler did not stop within the timeout")
+            return
+        self._thread = None
+
+    def submit(self, messages, params, listener=None, session_id=None):
+        """Queue a chat completion and return its InferenceJob.
+
+        With a `session_id`, `messages` holds only the optional system
+        prompt and the new user turn; earlier turns come from the session.
+        """
+        if not self._running:
+            raise RuntimeError("Inference scheduler is not running")
+        job = InferenceJob(messages, dict(params), listener, session_id)
+        self._inbox.put(job)
+        return job
+
+    def discard_session(self, session_id):
+        self.sessions.discard(session_id)
+
+    # Introspection
+    @property
+    def queue_depth(self):
+        """Jobs waiting to be admitted"""
+        return self._inbox.qsize()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "active": len(self._active),
+            "admitted": self.admitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "state_swaps": self.swaps,
+            "avg_queue_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_queue_wait": self.max_wait,
+            "last_queue_wait": self.last_wait,
+            "sessions": self.sessions.stats(),
+            **({"speculative": {
+                "proposed": self.draft_proposed,
+                "accepted": self.draft_accepted,
+                "acceptance_rate": self.draft_accepted / self.draft_proposed if self.draft_proposed else 0.0,
+            }} if self.draft is not None else {}),
+        }
+
+    # Owner thread
+    def _run(self):
+        while self._running:
+            self._admit(block=not self._active)
+            if self._active:
+                self._step(self._active[0])
+
+        for seq in list(self._active):
+            self._drop(seq, JobCancelled("Scheduler stopped"))
+        while True:
+            try:
+                job = self._inbox.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                self.cancelled += 1
+                job._fail(JobCancelled("Scheduler stopped"))
+
+    def _admit(self, block):
+        while len(self._active) < self.max_active:
+            try:
+                job = self._inbox.get(timeout=0.5) if block else self._inbox.get_nowait()
+            except queue.Empty:
+                return
+            block = False
+            if job is None:
+                self._running = False
+                return
+            if job.cancelled:
+                self.cancelled += 1
+                job._fail(JobCancelled())
+                continue
+            job._start()
+            self.admitted += 1
+            wait = job.queue_wait
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.last_wait = wait
+            self._active.append(_Sequence(job))
+
+    def _activate(self, seq):
+        """Make `seq` the sequence whose KV state is loaded in the model"""
+        if self._loaded is seq:
+            return
+        if self._loaded is not None and len(self._active) > 1:
+            # Only saved while another sequence still needs this state back; a
+            # sequence left alone keeps the model to itself and is never saved
+            self._loaded.state = self.llm.save_state()
+            self.swaps += 1
+        if seq.state is not None:
+            self.llm.load_state(seq.state)
+            seq.state = None
+        self._loaded = seq
+
+    def _step(self, seq):
+        try:
+            self._activate(seq)
+            for _ in range(self.slice_tokens):
+                if seq.job.cancelled:
+                    raise JobCancelled()
+                began = time.perf_counter()
+                if seq.stream is None:
+                    seq.stream = self.llm.create_chat_completion(
+                        messages=self._prepare(seq), stream=True, **seq.job.params
+                    )
+                if self.draft is not None:
+                    calls, proposed = self.draft.calls, self.draft.proposed
+                chunk = next(seq.stream)
+                if self.draft is not None:
+                    seq.draft_calls += self.draft.calls - calls
+                    seq.draft_proposed += self.draft.proposed - proposed
+                if seq.pieces:
+                    seq.generation_time += time.perf_counter() - began
+                else:
+                    seq.prompt_time += time.perf_counter() - began
+                token = chunk["choices"][0]["delta"].get("content")
+                if token:
+                    seq.pieces.append(token)
+                    seq.job._emit(token)
+        except StopIteration:
+            self._complete(seq)
+        except Exception as e:
+            self._drop(seq, e)
+        else:
+            if len(self._active) > 1:
+                self._active.rotate(-1)
+
+    def _count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False)) if text else 0
+
+    def _prepare(self, seq):
+        """Return the messages to generate from, restoring session state.
+
+        Called with `seq` loaded. For session jobs the saved state of the
+        session (or of another session with the same system prompt) is
+        restored, and as many previous turns as fit the context are
+        inserted between the system prompt and the new message.
+
+        Turns sent along with the message (the client's own copy of the
+        conversation) are only used when the session has none, i.e. it is
+        new, was evicted, or the server restarted.
+        """
+        job = seq.job
+        if job.session_id is None:
+            seq.history_messages = sum(1 for m in job.messages[:-1] if m["role"] != "system")
+            return job.messages
+
+        system = next((m["content"] for m in job.messages if m["role"] == "system"), None)
+        user = next(m for m in reversed(job.messages) if m["role"] == "user")
+        session = self.sessions.get(job.session_id)
+        if system is not None:
+            session.system = system
+        seq.session = session
+        earlier = [m for m in job.messages[:-1] if m["role"] != "system"]
+        if earlier and not session.history:
+            self.sessions.seed(session, [
+                (m["role"], m["content"], self._count_tokens(m["content"])) for m in earlier
+            ])
+
+        state = session.state or self.sessions.prefix_state(session.system)
+        if state is not None:
+            self.llm.load_state(state)
+
+        seq.user_tokens = self._count_tokens(user["content"])
+        budget = (
+            self.llm.n_ctx()
+            - job.params.get("max_tokens", 256)
+            - self._count_tokens(session.system)
+            - seq.user_tokens
+            - 32  # chat template overhead
+        )
+        history = []
+        for role, content, n_tokens in reversed(session.history):
+            budget -= n_tokens + 8
+            if budget < 0:
+                break
+            history.append({"role": role, "content": content})
+        history.reverse()
+        while history and history[0]["role"] != "user":
+            history.pop(0)
+        seq.history_messages = len(history)
+
+        messages = [{"role": "system", "content": session.system}] if session.system else []
+        return messages + history + [user]
+
+    def _complete(self, seq):
+        job = seq.job
+        output = "".join(seq.pieces).strip()
+        completion_tokens = self._count_tokens(output)
+        total_tokens = max(self.llm.n_tokens, completion_tokens)
+        if seq.session is not None:
+            session = seq.session
+            user = next(m for m in reversed(job.messages) if m["role"] == "user")
+            session.add_turn(user["content"], seq.user_tokens, output, completion_tokens,
+                             self.sessions.max_messages)
+            session.state = self.llm.save_state()
+            self.sessions.put(session)
+            self.sessions.remember_prefix(session.system, session.state)
+        self._remove(seq)
+        now = time.monotonic()
+        self.completed += 1
+        result = {
+            "response": output,
+            "prompt_tokens": total_tokens - completion_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "processing_time": now - job.started_at,
+            "time_to_first_token": (job.first_token_at or now) - job.started_at,
+            "queue_wait": job.queue_wait,
+            "prompt_eval_time": seq.prompt_time,
+            "generation_time": seq.generation_time,
+            "history_messages": seq.history_messages,
+        }
+        if self.draft is not None:
+            result["speculative"] = self._speculative_stats(seq, completion_tokens)
+        job._finish(result)
+
+    def _speculative_stats(self, seq, completion_tokens):
+        # Each verification step yields the accepted draft tokens plus one
+        # token of its own, and the first token comes before any draft
+        accepted = max(0, min(seq.draft_proposed, completion_tokens - 1 - seq.draft_calls))
+        self.draft_proposed += seq.draft_proposed
+        self.draft_accepted += accepted
+        return {
+            "proposed": seq.draft_proposed,
+            "accepted": accepted,
+            "acceptance_rate": accepted / seq.draft_proposed if seq.draft_proposed else 0.0,
+        }
+
+    def _drop(self, seq, error):
+        if seq.stream is not None:
+            try:
+                seq.stream.close()
+            except Exception:
+                pass
+        self._remove(seq)
+        if isinstance(error, JobCancelled):
+            self.cancelled += 1
+        else:
+            self.failed += 1
+            logger.error(f"Generation failed for job {seq.job.id}: {error}", exc_info=error)
+        seq.job._fail(error)
+
+    def _remove(self, seq):
+        self._active.remove(seq)
+        seq.state = None
+        if self._loaded is seq:
+            # The model keeps this sequence's tokens, which the next new
+            # sequence can reuse as a prefix, but nothing needs saving.
+            self._loaded = None
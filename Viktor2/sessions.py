@@ -0,0 +1,173 @@
+# sessions.py
+"""Per-session chat history and llama_cpp KV state.
+
+A session remembers the system prompt, its previous turns and the model
+state saved at the end of its last reply. Restoring that state before the
+next turn lets llama_cpp's prefix matching skip everything already
+evaluated, so a follow-up only pays prompt-eval for the new message.
+
+States are kept in a bounded LRU. Evicted sessions are pickled to
+``spill_dir`` when one is configured and loaded back on their next turn.
+The most recent state for each system prompt is also kept, so a brand new
+session with a known persona starts with that prefix already evaluated.
+Clients may send their own copy of the recent turns with each message;
+it seeds a session that has no history (new, evicted without a spill
+directory, or lost in a restart), so the conversation survives.
+
+Llama states are only created and restored by the model's owner thread;
+the lock guards the bookkeeping against discard() from request threads.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class Session:
+    __slots__ = ("id", "system", "history", "state")
+
+    def __init__(self, session_id, system=None, history=None, state=None):
+        self.id = session_id
+        self.system = system
+        self.history = history or []  # [(role, content, n_tokens), ...]
+        self.state = state
+
+    def add_turn(self, user_text, user_tokens, reply, reply_tokens, max_messages):
+        self.history.append(("user", user_text, user_tokens))
+        self.history.append(("assistant", reply, reply_tokens))
+        del self.history[:-max_messages]
+
+class SessionStore:
+    def __init__(self, capacity=16, prefix_capacity=4, spill_dir=None, max_messages=40):
+        self.capacity = max(1, capacity)
+        self.prefix_capacity = max(0, prefix_capacity)
+        self.spill_dir = spill_dir
+        self.max_messages = max_messages
+        self._sessions = OrderedDict()
+        self._prefixes = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.prefix_hits = 0
+        self.seeded = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    # Sessions
+    def get(self, session_id):
+        """Return the session, loading it from disk or creating it if needed"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                self.hits += 1
+                return session
+
+        session = self._load_spilled(session_id)
+        if session is not None:
+            self.spill_hits += 1
+        else:
+            self.misses += 1
+            session = Session(session_id)
+        self.put(session)
+        return session
+
+    def put(self, session):
+        """Mark `session` most recently used and evict beyond capacity"""
+        evicted = []
+        with self._lock:
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            while len(self._sessions) > self.capacity:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        for old in evicted:
+            self._spill(old)
+
+    def seed(self, session, history):
+        """Give a session without history the turns its client remembers"""
+        session.history = list(history)[-self.max_messages:]
+        self.seeded += 1
+
+    def discard(self, session_id):
+        """Forget a session everywhere (memory and disk)"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        path = self._spill_path(session_id)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    # Shared system-prompt prefixes
+    def prefix_state(self, system):
+        if not system or not self.prefix_capacity:
+            return None
+        key = self._key(system)
+        with self._lock:
+            state = self._prefixes.get(key)
+            if state is not None:
+                self._prefixes.move_to_end(key)
+                self.prefix_hits += 1
+            return state
+
+    def remember_prefix(self, system, state):
+        if not system or not self.prefix_capacity:
+            return
+        key = self._key(system)
+        with self._lock:
+            self._prefixes[key] = state
+            self._prefixes.move_to_end(key)
+            while len(self._prefixes) > self.prefix_capacity:
+                self._prefixes.popitem(last=False)
+
+    def stats(self):
+        return {
+            "resident": len(self._sessions),
+            "capacity": self.capacity,
+            "prefixes": len(self._prefixes),
+            "hits": self.hits,
+            "spill_hits": self.spill_hits,
+            "misses": self.misses,
+            "prefix_hits": self.prefix_hits,
+            "seeded": self.seeded,
+        }
+
+    # Disk spill
+    @staticmethod
+    def _key(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _spill_path(self, session_id):
+        if not self.spill_dir:
+            return None
+        return os.path.join(self.spill_dir, self._key(session_id)[:32] + ".session")
+
+    def _spill(self, session):
+        path = self._spill_path(session.id)
+        if path is None:
+            return
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump((session.id, session.system, session.history, session.state), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"Could not spill session state: {e}")
+
+    def _load_spilled(self, session_id):
+        path = self._spill_path(session_id)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                stored_id, system, history, state = pickle.load(f)
+            os.remove(path)
+        except Exception as e:
+            logger.warning(f"Could not load spilled session: {e}")
+            return None
+        if stored_id != session_id:
+            return None
+        return Session(session_id, system, history, state)
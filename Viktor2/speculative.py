@@ -0,0 +1,116 @@
+# speculative.py
+"""Speculative decoding for llama_cpp models.
+
+A draft proposes the next few tokens and the main model evaluates them
+in one batch, keeping the proposals up to the first one its own sampler
+disagrees with. Every token still comes from the main model's sampler,
+so replies follow the same distribution; they just need fewer
+sequential evaluations when drafts are accepted.
+
+Two kinds of draft:
+
+* ``prompt_lookup``: llama_cpp's LlamaPromptLookupDecoding, which copies
+  the continuation of an n-gram already present in the context. No
+  extra model, works well when replies repeat names and phrases.
+* ``draft``: a small GGUF model sharing the main model's vocabulary
+  (e.g. TinyLlama for a Llama 2 chat model), decoded greedily.
+
+Configured per model file with a JSON object; "*" applies to the rest:
+
+    SPECULATIVE_DECODING='{"*": {"mode": "prompt_lookup", "tokens": 10},
+                           "llama-2-7b-chat.Q4_K_M.gguf":
+                               {"mode": "draft", "draft_model": "tinyllama.gguf", "tokens": 4}}'
+
+``CountingDraft`` counts the proposals so the scheduler can report an
+acceptance rate per reply. Drafts are plain callables with the signature
+of llama_cpp's LlamaDraftModel (token ids in, proposed ids out).
+"""
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODES = ("prompt_lookup", "draft")
+
+class SmallModelDraft:
+    """Greedy proposals from a smaller model with the same vocabulary"""
+
+    def __init__(self, llm, num_pred_tokens=4):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = []
+        # generate() reuses the longest prefix already in the draft's KV cache
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+class CountingDraft:
+    """Counts draft calls and proposed tokens of the wrapped draft model"""
+
+    def __init__(self, draft):
+        self.draft = draft
+        self.calls = 0
+        self.proposed = 0
+
+    def __call__(self, input_ids, /, **kwargs):
+        tokens = self.draft(input_ids, **kwargs)
+        self.calls += 1
+        self.proposed += len(tokens)
+        return tokens
+
+def settings_for(model_path, config, model_dir):
+    """The speculative settings of a model file, or None.
+
+    A draft model's file name is resolved against `model_dir`.
+    """
+    settings = config.get(os.path.basename(model_path), config.get("*"))
+    if not settings or settings.get("mode") in (None, "off"):
+        return None
+    if settings["mode"] not in MODES:
+        raise ValueError(f"Unknown speculative mode {settings['mode']!r} (use one of {', '.join(MODES)})")
+    if settings["mode"] == "draft":
+        if not settings.get("draft_model"):
+            raise ValueError("Speculative mode 'draft' needs a draft_model")
+        settings = {**settings, "draft_model": os.path.join(model_dir, settings["draft_model"])}
+    return settings
+
+def create_draft(settings, model_config):
+    """Build the draft model described by `settings` (draft_model is a path)"""
+    if settings["mode"] == "prompt_lookup":
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+        draft = LlamaPromptLookupDecoding(
+            max_ngram_size=settings.get("ngram", 2), num_pred_tokens=settings.get("tokens", 10)
+        )
+    else:
+        from llama_cpp import Llama
+
+        path = settings["draft_model"]
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Draft model not found at {path}")
+        draft = SmallModelDraft(Llama(model_path=path, **model_config), num_pred_tokens=settings.get("tokens", 4))
+        logger.info(f"Loaded draft model {os.path.basename(path)}")
+    return CountingDraft(draft)
+
+def load_llama(model_path, model_config, settings=None):
+    """Llama instance for `model_path`, with a draft model if `settings` ask for one"""
+    from llama_cpp import Llama
+
+    if settings is None:
+        return Llama(model_path=model_path, **model_config)
+    draft = create_draft(settings, model_config)
+    llm = Llama(model_path=model_path, draft_model=draft, **model_config)
+    inner = draft.draft
+    # A separate draft model must tokenize exactly like the main model
+    if isinstance(inner, SmallModelDraft) and inner.llm.n_vocab() != llm.n_vocab():
+        raise ValueError(
+            f"Draft model vocabulary ({inner.llm.n_vocab()}) differs from the main model ({llm.n_vocab()})"
+        )
+    logger.info(f"Speculative decoding: {settings['mode']}, {settings.get('tokens', 'default')} tokens per draft")
+    return llm
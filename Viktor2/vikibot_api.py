@@ -1,31 +1,129 @@
 # vikibot_api.py
 import os
 import sys
+import json
+import math
+import re
 import time
 import logging
+import threading
+import multiprocessing
 from functools import wraps
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from llama_cpp import Llama
 from werkzeug.serving import WSGIRequestHandler
 from werkzeug.middleware.proxy_fix import ProxyFix
+from scheduler import InferenceScheduler
+from worker_pool import WorkerPool
+from model_registry import ModelRegistry, ModelUnavailable, UnknownModel
+from admission import LANES, AdmissionController, RateLimiter, Rejected
+from response_cache import ResponseCache
+from metrics import CONTENT_TYPE, REGISTRY, START_TIME, Counter, Gauge, Histogram
 
 # ======================
 # Configuration
 # ======================
 class Config:
     # Model configuration
-    MODEL_PATH = os.path.normpath(r"E:\viktor\models\tinyllama\tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
+    MODEL_PATH = os.path.normpath(
+        os.getenv('MODEL_PATH', r"E:\viktor\models\tinyllama\tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
+    )
     MODEL_CONFIG = {
         "n_ctx": 2048,
         "n_threads": min(6, os.cpu_count() or 1),
         "n_gpu_layers": 20 if os.environ.get('USE_GPU') else 0,
+        # mmap maps the weights lazily from the page cache; mlock pins them
+        # in RAM so they are never paged out (needs a high enough ulimit -l)
+        "use_mmap": os.getenv('MODEL_MMAP', 'true').lower() in ('1', 'true', 'yes'),
+        "use_mlock": os.getenv('MODEL_MLOCK', 'false').lower() in ('1', 'true', 'yes'),
         "verbose": False
     }
     
+    # Other models: requests may pick a GGUF file (or an alias from
+    # MODEL_ALIASES="casual=tinyllama.gguf,exam=mistral-7b.gguf") inside
+    # MODEL_DIR and a context size. Models are loaded on first use and the
+    # least recently used idle ones are unloaded to stay within the budget
+    # (estimated as file size x MODEL_MEMORY_OVERHEAD).
+    MODEL_DIR = os.getenv('MODEL_DIR') or os.path.dirname(MODEL_PATH)
+    MODEL_ALIASES = dict(
+        alias.split('=', 1) for alias in os.getenv('MODEL_ALIASES', '').replace(';', ',').split(',') if '=' in alias
+    )
+    MODEL_MEMORY_BUDGET_MB = int(os.getenv('MODEL_MEMORY_BUDGET_MB', '8192'))
+    MODEL_MEMORY_OVERHEAD = float(os.getenv('MODEL_MEMORY_OVERHEAD', '1.2'))
+    MAX_CONTEXT_SIZE = int(os.getenv('MAX_CONTEXT_SIZE', '8192'))
+    
+    # Speculative decoding per model file name ("*" for all others), see
+    # speculative.py: {"*": {"mode": "prompt_lookup", "tokens": 10}} or
+    # {"big.gguf": {"mode": "draft", "draft_model": "tiny.gguf", "tokens": 4}}
+    SPECULATIVE_DECODING = json.loads(os.getenv('SPECULATIVE_DECODING') or '{}')
+    
+    # Startup: with LAZY_LOAD the server answers right away and loads the
+    # model in the background; /readyz returns 503 until it is warmed up
+    LAZY_LOAD = os.getenv('LAZY_LOAD', 'true').lower() in ('1', 'true', 'yes')
+    WARMUP_TOKENS = int(os.getenv('WARMUP_TOKENS', '4'))  # 0 skips the warmup generation
+    READY_RETRY_AFTER = int(os.getenv('READY_RETRY_AFTER', '5'))  # Seconds, sent while loading
+    
     # Server configuration
     HOST = '0.0.0.0'
     PORT = 5000
     MAX_CONTENT_LENGTH = 16 * 1024  # 16KB max request size
+    REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '120'))  # Seconds incl. queue wait
+    
+    # Scheduler: one owner thread decodes up to MAX_ACTIVE sequences,
+    # switching between them every SLICE_TOKENS tokens. Every switch copies
+    # the KV cache out and back in, so short slices cost throughput
+    SCHEDULER_MAX_ACTIVE = int(os.getenv('SCHEDULER_MAX_ACTIVE', '4'))
+    SCHEDULER_SLICE_TOKENS = int(os.getenv('SCHEDULER_SLICE_TOKENS', '128'))
+    
+    # Worker pool: WORKERS > 0 serves from that many model processes, each
+    # pinned to its own slice of cores and sharing the mmap'd GGUF weights.
+    # 0 keeps the model in the server process.
+    WORKERS = int(os.getenv('WORKERS', '0'))
+    
+    # Admission control (see admission.py): ADMISSION_SLOTS jobs with the
+    # model at once (0: SCHEDULER_MAX_ACTIVE per worker), ADMISSION_QUEUE
+    # more waiting per priority lane for up to ADMISSION_MAX_WAIT seconds;
+    # beyond that requests get 503 right away
+    ADMISSION_SLOTS = int(os.getenv('ADMISSION_SLOTS', '0'))
+    ADMISSION_QUEUE = int(os.getenv('ADMISSION_QUEUE', '16'))
+    ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '10'))
+    ADMISSION_RESERVED = int(os.getenv('ADMISSION_RESERVED', '1'))  # Slots kept for interactive requests
+    
+    # Rate limits: requests per second and burst, per API key (by client
+    # name, see API_KEYS) and per user (``user`` or ``session_id``); a rate
+    # of 0 disables the limit. RATE_LIMITS='{"telegram-bot": [50, 100]}'
+    # gives a client its own key limit
+    KEY_RATE_LIMIT = float(os.getenv('KEY_RATE_LIMIT', '0'))
+    KEY_RATE_BURST = int(os.getenv('KEY_RATE_BURST', '20'))
+    USER_RATE_LIMIT = float(os.getenv('USER_RATE_LIMIT', '0.5'))
+    USER_RATE_BURST = int(os.getenv('USER_RATE_BURST', '5'))
+    RATE_LIMITS = json.loads(os.getenv('RATE_LIMITS') or '{}')
+    
+    # Sessions: KV state of recent conversations stays resident so
+    # follow-up turns only evaluate the new message
+    SESSION_CONFIG = {
+        "capacity": int(os.getenv('SESSION_CACHE_SIZE', '16')),
+        "prefix_capacity": int(os.getenv('SESSION_PREFIX_CACHE_SIZE', '4')),
+        "spill_dir": os.getenv('SESSION_SPILL_DIR') or None,
+        "max_messages": int(os.getenv('SESSION_MAX_MESSAGES', '40')),
+    }
+    
+    # Reply cache for short repeated messages; 0 disables it. Clients can
+    # send their own ``cache_key`` (e.g. message + memory fingerprint).
+    RESPONSE_CACHE_CONFIG = {
+        "capacity": int(os.getenv('RESPONSE_CACHE_SIZE', '0')),
+        "ttl": float(os.getenv('RESPONSE_CACHE_TTL', '900')),
+        "variants": int(os.getenv('RESPONSE_CACHE_VARIANTS', '3')),
+        "max_words": int(os.getenv('RESPONSE_CACHE_MAX_WORDS', '8')),
+    }
+    
+    # Generation defaults
+    GENERATION_CONFIG = {
+        "max_tokens": 256,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "stop": ["</s>", "[INST]", "[/INST]"],
+    }
     
     # Security
     API_KEYS = {
@@ -72,26 +170,49 @@ def require_api_key(f):
     def decorated(*args, **kwargs):
         api_key = request.headers.get('X-API-KEY') or request.args.get('api_key')
         if api_key in Config.API_KEYS:
+            g.client = Config.API_KEYS[api_key]
             return f(*args, **kwargs)
         return jsonify({"error": "Invalid API key"}), 401
     return decorated
 
+def require_model(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not loader.ready:
+            return not_ready_response()
+        return f(*args, **kwargs)
+    return decorated
+
 # ======================
 # Model Loading
 # ======================
-def load_model():
-    """Load and initialize the LLM model"""
+def speculative_settings(model_path):
+    """Speculative decoding settings of a model file, or None"""
+    if not Config.SPECULATIVE_DECODING:
+        return None
+    from speculative import settings_for
+    return settings_for(model_path, Config.SPECULATIVE_DECODING, Config.MODEL_DIR)
+
+def load_model(model_path=None, n_ctx=None):
+    """Load and initialize the LLM model (the default one unless given)"""
+    model_path = model_path or Config.MODEL_PATH
+    model_config = {**Config.MODEL_CONFIG, "n_ctx": n_ctx or Config.MODEL_CONFIG["n_ctx"]}
     try:
-        logger.info("Loading the LLM model...")
+        logger.info(f"Loading the LLM model {os.path.basename(model_path)}...")
         start_time = time.time()
         
-        if not os.path.exists(Config.MODEL_PATH):
-            raise FileNotFoundError(f"Model file not found at {Config.MODEL_PATH}")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Model file not found at {model_path}")
         
-        llm = Llama(model_path=Config.MODEL_PATH, **Config.MODEL_CONFIG)
+        settings = speculative_settings(model_path)
+        if settings:
+            from speculative import load_llama
+            llm = load_llama(model_path, model_config, settings)
+        else:
+            llm = Llama(model_path=model_path, **model_config)
         
         logger.info(f"Model loaded in {time.time() - start_time:.2f} seconds")
-        logger.info(f"Model context size: {Config.MODEL_CONFIG['n_ctx']} tokens")
+        logger.info(f"Model context size: {model_config['n_ctx']} tokens")
         logger.info(f"Using {Config.MODEL_CONFIG['n_threads']} CPU threads")
         
         return llm
@@ -99,65 +220,569 @@ def load_model():
         logger.error(f"Model loading failed: {str(e)}")
         raise
 
-llm = load_model()
+def warmup_request():
+    """A tiny generation that pages in the weights and fills the caches"""
+    if Config.WARMUP_TOKENS <= 0:
+        return None
+    messages = [{"role": "user", "content": "Hello"}]
+    return messages, {**Config.GENERATION_CONFIG, "max_tokens": Config.WARMUP_TOKENS}
+
+def warm_up(scheduler):
+    warmup = warmup_request()
+    if warmup is None:
+        return
+    started = time.time()
+    scheduler.submit(*warmup).wait(timeout=Config.REQUEST_TIMEOUT)
+    logger.info(f"Warmup generation took {time.time() - started:.2f} seconds")
+
+def scheduler_config():
+    return {
+        "max_active": Config.SCHEDULER_MAX_ACTIVE,
+        "slice_tokens": Config.SCHEDULER_SLICE_TOKENS,
+        "session_config": Config.SESSION_CONFIG
+    }
+
+def create_model_backend(model_path, n_ctx):
+    """In-process scheduler for a model other than the default one"""
+    backend = InferenceScheduler(load_model(model_path, n_ctx), **scheduler_config())
+    backend.start()
+    warm_up(backend)
+    return backend
+
+def create_backend():
+    """Start the in-process scheduler or the worker pool"""
+    if Config.WORKERS > 0:
+        if not os.path.exists(Config.MODEL_PATH):
+            raise FileNotFoundError(f"Model file not found at {Config.MODEL_PATH}")
+        logger.info(f"Starting {Config.WORKERS} model worker processes")
+        # Every worker warms itself up before reporting ready
+        backend = WorkerPool(
+            Config.MODEL_PATH, Config.MODEL_CONFIG, Config.WORKERS, scheduler_config(),
+            warmup=warmup_request(), speculative=speculative_settings(Config.MODEL_PATH)
+        )
+        backend.start()
+    else:
+        backend = InferenceScheduler(load_model(), **scheduler_config())
+        backend.start()
+        warm_up(backend)
+    return backend
+
+class BackendLoader:
+    """Creates the backend, in the background when LAZY_LOAD is set.
+
+    ``status`` goes from "loading" to "ready" (or "failed"); with a worker
+    pool the server is ready once at least one worker has loaded and warmed
+    up its model.
+    """
+
+    def __init__(self):
+        self.status = "loading"
+        self.error = None
+        self.load_time = None
+
+    def start(self, background):
+        if background:
+            threading.Thread(target=self._load, name="model-loader", daemon=True).start()
+        else:
+            self._load()
+            if self.error is not None:
+                raise self.error
+
+    def _load(self):
+        global backend
+        started = time.time()
+        try:
+            backend = create_backend()
+            registry.set_default(Config.MODEL_PATH, Config.MODEL_CONFIG["n_ctx"], backend)
+        except Exception as e:
+            logger.error(f"Backend startup failed: {str(e)}", exc_info=True)
+            self.error = e
+            self.status = "failed"
+            return
+        self.load_time = time.time() - started
+        self.status = "ready"
+
+    @property
+    def ready(self):
+        if self.status != "ready":
+            return False
+        return getattr(backend, "ready", True)
+
+def not_ready_response():
+    """503 telling clients and load balancers when to retry"""
+    body = {"error": "Model is not ready", "status": loader.status}
+    return jsonify(body), 503, {"Retry-After": str(Config.READY_RETRY_AFTER)}
+
+# Worker processes re-import this module when spawned; only the server
+# process owns a backend.
+backend = None
+registry = ModelRegistry(
+    create_model_backend,
+    Config.MODEL_DIR,
+    budget=Config.MODEL_MEMORY_BUDGET_MB * 2**20,
+    overhead=Config.MODEL_MEMORY_OVERHEAD,
+    aliases=Config.MODEL_ALIASES,
+    default_context=Config.MODEL_CONFIG["n_ctx"],
+    max_context=Config.MAX_CONTEXT_SIZE,
+)
+loader = BackendLoader()
+if multiprocessing.parent_process() is None:
+    loader.start(background=Config.LAZY_LOAD)
+response_cache = ResponseCache(**Config.RESPONSE_CACHE_CONFIG)
+admission = AdmissionController(
+    Config.ADMISSION_SLOTS or Config.SCHEDULER_MAX_ACTIVE * max(1, Config.WORKERS),
+    queue_size=Config.ADMISSION_QUEUE,
+    max_wait=Config.ADMISSION_MAX_WAIT,
+    reserved=Config.ADMISSION_RESERVED,
+)
+key_limiter = RateLimiter(
+    Config.KEY_RATE_LIMIT, Config.KEY_RATE_BURST,
+    overrides={client: tuple(limit) for client, limit in Config.RATE_LIMITS.items()}
+)
+user_limiter = RateLimiter(Config.USER_RATE_LIMIT, Config.USER_RATE_BURST)
+
+# ======================
+# Metrics
+# ======================
+REQUESTS = Counter("vikibot_requests_total", "HTTP requests by endpoint and status.", ("endpoint", "status"))
+REQUEST_LATENCY = Histogram(
+    "vikibot_request_duration_seconds", "Time to serve a request, until the last byte for streams.", ("endpoint",)
+)
+IN_FLIGHT = Gauge("vikibot_requests_in_flight", "Requests being served.")
+QUEUE_DEPTH = Gauge(
+    "vikibot_queue_depth", "Jobs waiting for the model.", callback=lambda: backend.queue_depth if backend else None
+)
+QUEUE_WAIT = Histogram("vikibot_queue_wait_seconds", "Time jobs waited before the model picked them up.")
+PROMPT_TOKENS = Counter("vikibot_prompt_tokens_total", "Prompt tokens processed.")
+COMPLETION_TOKENS = Counter("vikibot_completion_tokens_total", "Tokens generated.")
+PROMPT_EVAL = Histogram("vikibot_prompt_eval_seconds", "Model time until the first generated token.")
+GENERATION = Histogram("vikibot_generation_seconds", "Model time spent generating after the first token.")
+TOKENS_PER_SECOND = Histogram(
+    "vikibot_generation_tokens_per_second", "Generation speed per job.",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+)
+CACHED_REPLIES = Counter("vikibot_cached_replies_total", "Replies served from the response cache.")
+RATE_LIMITED = Counter("vikibot_rate_limited_total", "Requests answered 429, by limit.", ("limit",))
+ADMISSION_REJECTED = Counter(
+    "vikibot_admission_rejected_total", "Requests answered 503 because the server was busy.", ("reason",)
+)
+ADMISSION_WAIT = Histogram("vikibot_admission_wait_seconds", "Time admitted requests waited for a slot.", ("lane",))
+ADMISSION_WAITING = Gauge("vikibot_admission_waiting", "Requests waiting for a slot.", callback=lambda: admission.waiting)
+DRAFT_TOKENS = Counter(
+    "vikibot_draft_tokens_total", "Speculative draft tokens, proposed and accepted by the model.", ("result",)
+)
+DRAFT_ACCEPTANCE = Histogram(
+    "vikibot_draft_acceptance_ratio", "Share of draft tokens accepted per reply.",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+)
+
+def record_job(result):
+    """Export the timings and token counts of a finished job"""
+    PROMPT_TOKENS.inc(result["prompt_tokens"])
+    COMPLETION_TOKENS.inc(result["completion_tokens"])
+    QUEUE_WAIT.observe(result["queue_wait"])
+    PROMPT_EVAL.observe(result["prompt_eval_time"])
+    GENERATION.observe(result["generation_time"])
+    if result["generation_time"] > 0 and result["completion_tokens"] > 1:
+        # The first token is part of the prompt-eval phase
+        TOKENS_PER_SECOND.observe((result["completion_tokens"] - 1) / result["generation_time"])
+    speculative = result.get("speculative")
+    if speculative:
+        DRAFT_TOKENS.inc(speculative["proposed"], result="proposed")
+        DRAFT_TOKENS.inc(speculative["accepted"], result="accepted")
+        if speculative["proposed"]:
+            DRAFT_ACCEPTANCE.observe(speculative["acceptance_rate"])
+
+def speculative_fields(result):
+    """Acceptance rate for the response body, when speculative decoding ran"""
+    speculative = result.get("speculative")
+    return {"acceptance_rate": speculative["acceptance_rate"]} if speculative else {}
+
+TRACE_ID_RE = re.compile(r"^[0-9A-Za-z_-]{1,64}$")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    IN_FLIGHT.inc()
+    # Set by the bot on sampled updates so server logs match its traces
+    trace_id = request.headers.get("X-Trace-Id", "")
+    g.trace_id = trace_id if TRACE_ID_RE.match(trace_id) else None
+
+@app.after_request
+def record_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    if g.get("trace_id"):
+        response.headers["X-Trace-Id"] = g.trace_id
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    status = response.status_code
+
+    def finished():
+        # Runs once the body is sent, so streams are timed to the last token
+        IN_FLIGHT.dec()
+        REQUESTS.inc(endpoint=endpoint, status=status)
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+    response.call_on_close(finished)
+    return response
+
+@app.teardown_request
+def record_failed_request(error):
+    # after_request is skipped when a view raises
+    started = g.pop("request_started", None)
+    if started is not None:
+        IN_FLIGHT.dec()
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUESTS.inc(endpoint=endpoint, status=500)
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
 
 # ======================
 # API Endpoints
 # ======================
+def parse_chat_request():
+    """Validate the JSON body of a chat request.
+
+    Besides ``message`` the body may carry a ``session_id`` (the server then
+    keeps the conversation and its KV cache, so only the new turn is sent)
+    and a ``system`` prompt for that session. An optional ``cache_key``
+    replaces the server's own key for the reply cache. ``model_path`` (or
+    ``model``) and ``context_size`` pick another model from MODEL_DIR.
+    ``priority`` is "interactive" (default) or "background", and ``user``
+    names the end user for rate limiting (defaults to the session id).
+    ``history`` is the client's copy of the recent turns, a list of
+    ``{"role": "user"|"assistant", "content": ...}``; with a session it is
+    only used if the server has lost that session's own history.
+
+    Returns (chat_request, None) on success or (None, error_response).
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return None, (jsonify({"error": "Request body must be JSON"}), 400)
+    if "message" not in data:
+        return None, (jsonify({"error": "Message field is required"}), 400)
+        
+    user_input = data["message"]
+    if not isinstance(user_input, str) or not user_input.strip():
+        return None, (jsonify({"error": "Message must be a non-empty string"}), 400)
+    
+    session_id = data.get("session_id")
+    system = data.get("system")
+    if session_id is not None:
+        session_id = str(session_id)
+        if not session_id or len(session_id) > 128:
+            return None, (jsonify({"error": "session_id must be 1-128 characters"}), 400)
+    if system is not None and not isinstance(system, str):
+        return None, (jsonify({"error": "System prompt must be a string"}), 400)
+    
+    history = data.get("history") or []
+    if not isinstance(history, list) or not all(
+            isinstance(m, dict) and m.get("role") in ("user", "assistant") and isinstance(m.get("content"), str)
+            for m in history):
+        return None, (jsonify({"error": "history must be a list of user/assistant messages"}), 400)
+    # Only the newest turns could ever fit in the context
+    history = history[-Config.SESSION_CONFIG["max_messages"]:]
+    
+    lane = data.get("priority", "interactive")
+    if lane not in LANES:
+        return None, (jsonify({"error": f"priority must be one of: {', '.join(LANES)}"}), 400)
+    user = data.get("user", session_id)
+    if user is not None:
+        user = str(user)
+        if not user or len(user) > 128:
+            return None, (jsonify({"error": "user must be 1-128 characters"}), 400)
+    
+    model = data.get("model_path") or data.get("model")
+    context_size = data.get("context_size")
+    if model is not None and not isinstance(model, str):
+        return None, (jsonify({"error": "model_path must be a string"}), 400)
+    if context_size is not None and (not isinstance(context_size, int) or isinstance(context_size, bool)):
+        return None, (jsonify({"error": "context_size must be an integer"}), 400)
+    try:
+        model_key = registry.resolve(model, context_size)
+    except UnknownModel as e:
+        return None, (jsonify({"error": str(e)}), 400)
+    except ModelUnavailable as e:
+        logger.warning(f"Model unavailable: {e}")
+        return None, model_unavailable_response(e)
+    # Replies of different models never share a cache entry
+    model_tag = "" if model_key == registry.default_key else f"{os.path.basename(model_key[0])}:{model_key[1]}"
+    
+    cache_key = data.get("cache_key")
+    if cache_key is not None and (not isinstance(cache_key, str) or not 0 < len(cache_key) <= 128):
+        return None, (jsonify({"error": "cache_key must be a 1-128 character string"}), 400)
+    if not response_cache.enabled:
+        cache_key = None
+    elif cache_key is None:
+        cache_key = response_cache.key_for(user_input, system, model_tag)
+    elif model_tag:
+        cache_key = f"{cache_key}|{model_tag}"
+    
+    messages = [{"role": "system", "content": system}] if system else []
+    messages += [{"role": m["role"], "content": m["content"]} for m in history]
+    messages.append({"role": "user", "content": user_input})
+    return {
+        "user_input": user_input,
+        "messages": messages,
+        "session_id": session_id,
+        "model": model_key,
+        "cache_key": cache_key,
+        "lane": lane,
+        "user": user,
+        "log_prefix": f"[trace {g.trace_id}] " if g.get("trace_id") else ""
+    }, None
+
+def submit_chat(chat_request):
+    """Queue a parsed chat request on the backend of its model"""
+    return registry.submit(
+        chat_request["model"],
+        chat_request["messages"],
+        Config.GENERATION_CONFIG,
+        session_id=chat_request["session_id"]
+    )
+
+def rate_limit_response(chat_request):
+    """429 with Retry-After if the user or the API key is over its limit, else None"""
+    client = g.get("client", "")
+    limit, wait = "user", 0.0
+    if chat_request["user"] is not None:
+        wait = user_limiter.check(f"{client}:{chat_request['user']}")
+    if not wait:
+        limit, wait = "key", key_limiter.check(client)
+    if not wait:
+        return None
+    RATE_LIMITED.inc(limit=limit)
+    return jsonify({"error": "Too many requests"}), 429, {"Retry-After": str(math.ceil(wait))}
+
+def admit(chat_request):
+    """Wait for a model slot.
+
+    Returns (slot, None) on success or (None, error_response); the slot
+    must be released once the job is done.
+    """
+    try:
+        slot = admission.acquire(chat_request["lane"])
+    except Rejected as e:
+        ADMISSION_REJECTED.inc(reason=e.reason)
+        logger.warning(f"{chat_request['log_prefix']}Rejected ({e.reason}), retry after {e.retry_after}s")
+        return None, (jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)})
+    ADMISSION_WAIT.observe(slot.waited, lane=slot.lane)
+    return slot, None
+
+def model_unavailable_response(error):
+    return jsonify({"error": str(error)}), 503, {"Retry-After": str(Config.READY_RETRY_AFTER)}
+
+def sse_event(payload, event=None):
+    """Format one Server-Sent Events frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
 @app.route("/chat", methods=["POST"])
 @require_api_key
+@require_model
 def chat():
     """Main chat endpoint"""
     try:
-        # Validate input
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Request body must be JSON"}), 400
-        if "message" not in data:
-            return jsonify({"error": "Message field is required"}), 400
-            
-        user_input = data["message"]
-        if not isinstance(user_input, str) or not user_input.strip():
-            return jsonify({"error": "Message must be a non-empty string"}), 400
+        chat_request, error = parse_chat_request()
+        if error:
+            return error
             
-        logger.info(f"Processing message: {user_input[:100]}...")
+        logger.info(f"{chat_request['log_prefix']}Processing message: {chat_request['user_input'][:100]}...")
+        
+        limited = rate_limit_response(chat_request)
+        if limited:
+            return limited
+        
+        cached = response_cache.get(chat_request["cache_key"])
+        if cached:
+            CACHED_REPLIES.inc()
+            return jsonify({
+                "response": cached,
+                "processing_time": 0.0,
+                "tokens_used": 0,
+                "queue_wait": 0.0,
+                "session_id": chat_request["session_id"],
+                "cached": True
+            })
         
         # Generate response
-        start_time = time.time()
-        response = llm.create_chat_completion(
-            messages=[{"role": "user", "content": user_input}],
-            max_tokens=256,
-            temperature=0.7,
-            top_p=0.9,
-            stop=["</s>", "[INST]", "[/INST]"],
-        )
-        processing_time = time.time() - start_time
+        slot, error = admit(chat_request)
+        if error:
+            return error
+        try:
+            try:
+                job = submit_chat(chat_request)
+            except ModelUnavailable as e:
+                logger.warning(f"{chat_request['log_prefix']}Model unavailable: {e}")
+                return model_unavailable_response(e)
+            try:
+                result = job.wait(timeout=Config.REQUEST_TIMEOUT)
+            except TimeoutError:
+                job.cancel()
+                logger.warning(f"Job {job.id} timed out (queue wait {job.queue_wait:.2f}s)")
+                return jsonify({"error": "Generation timed out"}), 504
+        finally:
+            slot.release()
         
-        output = response["choices"][0]["message"]["content"].strip()
-        tokens_used = response["usage"]["total_tokens"]
+        processing_time = result["processing_time"]
+        tokens_used = result["total_tokens"]
+        response_cache.put(chat_request["cache_key"], result["response"])
+        record_job(result)
         
-        logger.info(f"Generated response in {processing_time:.2f}s ({tokens_used} tokens)")
+        logger.info(
+            f"{chat_request['log_prefix']}Generated response in {processing_time:.2f}s ({tokens_used} tokens, "
+            f"queued {result['queue_wait']:.2f}s)"
+        )
         
         return jsonify({
-            "response": output,
+            "response": result["response"],
             "processing_time": processing_time,
-            "tokens_used": tokens_used
+            "tokens_used": tokens_used,
+            "queue_wait": result["queue_wait"],
+            "prompt_eval_time": result["prompt_eval_time"],
+            "generation_time": result["generation_time"],
+            "history_messages": result["history_messages"],
+            "session_id": chat_request["session_id"],
+            **speculative_fields(result)
         })
         
     except Exception as e:
         logger.error(f"Chat error: {str(e)}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route("/chat/stream", methods=["POST"])
+@require_api_key
+@require_model
+def chat_stream():
+    """Streaming chat endpoint (Server-Sent Events).
+
+    Emits one ``data: {"token": ...}`` frame per generated piece of text,
+    then a final ``event: done`` frame carrying the same summary fields as
+    /chat, or ``event: error`` if generation fails midway.
+    """
+    chat_request, error = parse_chat_request()
+    if error:
+        return error
+        
+    logger.info(f"{chat_request['log_prefix']}Streaming message: {chat_request['user_input'][:100]}...")
+    
+    limited = rate_limit_response(chat_request)
+    if limited:
+        return limited
+    
+    cached = response_cache.get(chat_request["cache_key"])
+    if cached:
+        CACHED_REPLIES.inc()
+        frames = [
+            sse_event({"token": cached}),
+            sse_event({
+                "response": cached,
+                "processing_time": 0.0,
+                "time_to_first_token": 0.0,
+                "queue_wait": 0.0,
+                "tokens_used": 0,
+                "session_id": chat_request["session_id"],
+                "cached": True
+            }, event="done")
+        ]
+        return Response(frames, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    
+    slot, error = admit(chat_request)
+    if error:
+        return error
+    try:
+        job = submit_chat(chat_request)
+    except ModelUnavailable as e:
+        slot.release()
+        logger.warning(f"{chat_request['log_prefix']}Model unavailable: {e}")
+        return model_unavailable_response(e)
+    
+    def generate():
+        try:
+            for token in job.tokens(timeout=Config.REQUEST_TIMEOUT):
+                yield sse_event({"token": token})
+                
+            result = job.result
+            response_cache.put(chat_request["cache_key"], result["response"])
+            record_job(result)
+            logger.info(
+                f"{chat_request['log_prefix']}Streamed response in {result['processing_time']:.2f}s "
+                f"(first token {result['time_to_first_token']:.2f}s, "
+                f"queued {result['queue_wait']:.2f}s)"
+            )
+            yield sse_event({
+                "response": result["response"],
+                "processing_time": result["processing_time"],
+                "time_to_first_token": result["time_to_first_token"],
+                "queue_wait": result["queue_wait"],
+                "prompt_eval_time": result["prompt_eval_time"],
+                "generation_time": result["generation_time"],
+                "tokens_used": result["total_tokens"],
+                "history_messages": result["history_messages"],
+                "session_id": chat_request["session_id"],
+                **speculative_fields(result)
+            }, event="done")
+        except TimeoutError:
+            logger.warning(f"Job {job.id} timed out (queue wait {job.queue_wait:.2f}s)")
+            yield sse_event({"error": "Generation timed out"}, event="error")
+        except Exception as e:
+            logger.error(f"Stream error: {str(e)}", exc_info=True)
+            yield sse_event({"error": "Internal server error"}, event="error")
+        finally:
+            # Stops generation early if the client disconnected
+            job.cancel()
+            slot.release()
+    
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # The generator's finally never runs if the body is not read at all
+    response.call_on_close(slot.release)
+    return response
+
+@app.route("/chat/session/<session_id>", methods=["DELETE"])
+@require_api_key
+@require_model
+def delete_session(session_id):
+    """Forget a session's history and cached state"""
+    registry.discard_session(session_id)
+    return "", 204
+
 @app.route("/health", methods=["GET"])
 def health_check():
     """Health check endpoint"""
     return jsonify({
-        "status": "healthy",
-        "model": "tinyllama-1.1b-chat",
+        "status": "healthy" if loader.ready else loader.status,
+        "model": os.path.basename(Config.MODEL_PATH),
         "context_size": Config.MODEL_CONFIG["n_ctx"],
-        "uptime": time.time() - app.start_time
+        "uptime": time.time() - START_TIME,
+        "load_time": loader.load_time,
+        "backend": backend.stats() if backend is not None else None,
+        "models": registry.stats(),
+        "admission": admission.stats(),
+        "response_cache": response_cache.stats()
     })
 
+@app.route("/livez", methods=["GET"])
+def liveness():
+    """The process is up; fails only if the model can never load"""
+    if loader.status == "failed":
+        return jsonify({"status": "failed", "error": str(loader.error)}), 500
+    return jsonify({"status": "alive"})
+
+@app.route("/readyz", methods=["GET"])
+def readiness():
+    """Ready to serve chats: the model is loaded and warmed up"""
+    if not loader.ready:
+        return not_ready_response()
+    return jsonify({"status": "ready"})
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 @app.route("/")
 def home():
     """Homepage with API documentation"""
@@ -166,7 +791,11 @@ def home():
     <p>Available endpoints:</p>
     <ul>
         <li><strong>POST /chat</strong> - Send messages to your AI boyfriend</li>
+        <li><strong>POST /chat/stream</strong> - Same as /chat, streamed token by token (SSE)</li>
+        <li><strong>DELETE /chat/session/&lt;id&gt;</strong> - Forget a conversation session</li>
         <li><strong>GET /health</strong> - Check API status</li>
+        <li><strong>GET /livez</strong> / <strong>GET /readyz</strong> - Liveness and readiness probes</li>
+        <li><strong>GET /metrics</strong> - Prometheus metrics</li>
     </ul>
     <p>Include <code>X-API-KEY</code> header for authenticated endpoints.</p>
     """
@@ -195,8 +824,6 @@ def request_entity_too_large(e):
 # Main Execution
 # ======================
 if __name__ == "__main__":
-    app.start_time = time.time()
-    
     # Configure server
     WSGIRequestHandler.protocol_version = "HTTP/1.1"
     
@@ -0,0 +1,375 @@
+# worker_pool.py
+"""Multi-process model serving.
+
+Every worker process pins itself to its own slice of CPU cores, loads the
+GGUF file with mmap (so all workers share one copy of the weights through
+the page cache) and serves jobs with its own InferenceScheduler. The
+dispatcher in the server process routes each job to the least-loaded
+worker and restarts workers that die.
+"""
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from scheduler import InferenceJob, JobCancelled
+
+logger = logging.getLogger(__name__)
+
+class WorkerCrashed(RuntimeError):
+    """The worker running a job died before finishing it"""
+
+def core_slices(n_workers, cores=None):
+    """Split the usable CPU cores into at most `n_workers` contiguous slices"""
+    if cores is None:
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+    n_workers = max(1, min(n_workers, len(cores)))
+    size, extra = divmod(len(cores), n_workers)
+    slices, start = [], 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+# ======================
+# Worker Process
+# ======================
+def _error_payload(error):
+    return type(error).__name__, str(error)
+
+def _rebuild_error(payload):
+    name, message = payload
+    if name == "JobCancelled":
+        return JobCancelled(message)
+    return RuntimeError(f"{name}: {message}")
+
+def _worker_main(index, cores, model_path, model_config, scheduler_config, warmup, speculative, inbox, outbox):
+    """Entry point of a worker process"""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format=f"%(asctime)s - worker-{index} - %(levelname)s - %(message)s")
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    from llama_cpp import Llama
+    from scheduler import InferenceScheduler
+
+    config = {**model_config, "use_mmap": True}
+    if cores:
+        config["n_threads"] = len(cores)
+    if speculative:
+        from speculative import load_llama
+        llm = load_llama(model_path, config, speculative)
+    else:
+        llm = Llama(model_path=model_path, **config)
+    scheduler = InferenceScheduler(llm, **scheduler_config)
+    scheduler.start()
+    if warmup is not None:
+        # Page in the weights before taking traffic
+        scheduler.submit(*warmup).wait()
+    outbox.put(("ready", None, os.getpid()))
+
+    jobs = {}
+
+    def listener_for(job_id):
+        def listener(kind, value):
+            if kind in ("done", "error"):
+                jobs.pop(job_id, None)
+            if kind == "error":
+                value = _error_payload(value)
+            outbox.put((kind, job_id, value))
+        return listener
+
+    last_stats = 0.0
+    while True:
+        try:
+            message = inbox.get(timeout=1.0)
+        except queue.Empty:
+            message = ()
+        if message is None:
+            break
+        if message:
+            kind, job_id, payload = message
+            if kind == "submit":
+                messages, params, session_id = payload
+                jobs[job_id] = scheduler.submit(messages, params, listener_for(job_id), session_id)
+            elif kind == "cancel" and job_id in jobs:
+                jobs[job_id].cancel()
+            elif kind == "discard":
+                scheduler.discard_session(payload)
+
+        now = time.monotonic()
+        if now - last_stats >= 1.0:
+            outbox.put(("stats", None, scheduler.stats()))
+            last_stats = now
+
+    scheduler.stop(timeout=5)
+
+# ======================
+# Dispatcher
+# ======================
+class _Worker:
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+        self.process = None
+        self.inbox = None
+        self.outbox = None
+        self.generation = 0
+        self.ready = False
+        self.in_flight = set()
+        self.restarts = 0
+        self.started_at = 0.0
+        self.respawn_at = None
+        self.stats = {}
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+class _RemoteJob(InferenceJob):
+    """An InferenceJob whose owner thread lives in a worker process"""
+
+    def __init__(self, messages, params, pool, session_id=None):
+        super().__init__(messages, params, session_id=session_id)
+        self.pool = pool
+        self.worker = None
+
+    def cancel(self):
+        if not self.cancelled and self.finished_at is None:
+            super().cancel()
+            self.pool._cancel(self)
+
+class WorkerPool:
+    """Dispatches jobs to llama_cpp worker processes"""
+
+    MAX_STICKY_SESSIONS = 10000
+
+    def __init__(self, model_path, model_config, workers, scheduler_config=None, warmup=None, speculative=None):
+        self.model_path = model_path
+        self.model_config = dict(model_config)
+        self.scheduler_config = dict(scheduler_config or {})
+        self.warmup = warmup  # (messages, params) generated by each worker before it is ready
+        self.speculative = speculative  # draft settings, see speculative.py
+        self._ctx = mp.get_context("spawn")
+        self._workers = [_Worker(i, cores) for i, cores in enumerate(core_slices(workers))]
+        if len(self._workers) < workers:
+            logger.warning(f"Only {len(self._workers)} cores available, starting {len(self._workers)} workers")
+        self._jobs = {}
+        # Sessions stick to the worker holding their KV state
+        self._session_workers = OrderedDict()
+        self._lock = threading.Lock()
+        self._running = False
+        self.crashes = 0
+
+    # Lifecycle
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        for worker in self._workers:
+            self._spawn(worker)
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def stop(self, timeout=5):
+        self._running = False
+        for worker in self._workers:
+            if worker.alive:
+                worker.inbox.put(None)
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    def _spawn(self, worker):
+        worker.inbox = self._ctx.Queue()
+        worker.outbox = self._ctx.Queue()
+        worker.ready = False
+        worker.stats = {}
+        worker.generation += 1
+        worker.started_at = time.monotonic()
+        worker.respawn_at = None
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.index, worker.cores, self.model_path, self.model_config,
+                  self.scheduler_config, self.warmup, self.speculative, worker.inbox, worker.outbox),
+            name=f"llama-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        threading.Thread(
+            target=self._read, args=(worker, worker.outbox, worker.generation),
+            name=f"worker-reader-{worker.index}", daemon=True
+        ).start()
+        logger.info(f"Started worker {worker.index} (pid {worker.process.pid}, cores {worker.cores})")
+
+    # Dispatch
+    def submit(self, messages, params, session_id=None):
+        """Queue a chat completion on the least-loaded worker"""
+        if not self._running:
+            raise RuntimeError("Worker pool is not running")
+        job = _RemoteJob(messages, dict(params), self, session_id)
+        self._dispatch(job)
+        return job
+
+    def discard_session(self, session_id):
+        with self._lock:
+            self._session_workers.pop(session_id, None)
+            workers = [w for w in self._workers if w.alive]
+        for worker in workers:
+            worker.inbox.put(("discard", None, session_id))
+
+    def _dispatch(self, job):
+        with self._lock:
+            candidates = [w for w in self._workers if w.alive]
+            if not candidates:
+                raise RuntimeError("No model workers available")
+            worker = None
+            if job.session_id is not None:
+                index = self._session_workers.get(job.session_id)
+                if index is not None and self._workers[index].alive:
+                    worker = self._workers[index]
+            if worker is None:
+                # Ready workers first, then fewest jobs in flight
+                worker = min(candidates, key=lambda w: (not w.ready, len(w.in_flight)))
+            if job.session_id is not None:
+                self._session_workers[job.session_id] = worker.index
+                self._session_workers.move_to_end(job.session_id)
+                while len(self._session_workers) > self.MAX_STICKY_SESSIONS:
+                    self._session_workers.popitem(last=False)
+            worker.in_flight.add(job.id)
+            job.worker = worker
+            self._jobs[job.id] = job
+            worker.inbox.put(("submit", job.id, (job.messages, job.params, job.session_id)))
+
+    def _cancel(self, job):
+        worker = job.worker
+        if worker is not None and worker.alive:
+            worker.inbox.put(("cancel", job.id, None))
+
+    def _release(self, job):
+        with self._lock:
+            self._jobs.pop(job.id, None)
+            if job.worker is not None:
+                job.worker.in_flight.discard(job.id)
+
+    def _read(self, worker, outbox, generation):
+        while self._running and worker.generation == generation:
+            try:
+                kind, job_id, payload = outbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            if kind == "ready":
+                worker.ready = True
+                logger.info(f"Worker {worker.index} ready (pid {payload})")
+                continue
+            if kind == "stats":
+                worker.stats = payload
+                continue
+
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            if kind == "start":
+                job._start()
+            elif kind == "token":
+                job._emit(payload)
+            elif kind == "done":
+                self._release(job)
+                job._finish(payload)
+            elif kind == "error":
+                self._release(job)
+                job._fail(_rebuild_error(payload))
+
+    # Supervision
+    def _monitor(self):
+        while self._running:
+            time.sleep(1.0)
+            for worker in self._workers:
+                if not self._running or worker.alive:
+                    continue
+                if worker.respawn_at is None:
+                    self._handle_crash(worker)
+                elif time.monotonic() >= worker.respawn_at:
+                    self._spawn(worker)
+
+    def _handle_crash(self, worker):
+        with self._lock:
+            orphans = [self._jobs.pop(job_id) for job_id in worker.in_flight if job_id in self._jobs]
+            worker.in_flight.clear()
+            worker.ready = False
+            self.crashes += 1
+            worker.restarts += 1
+            # Back off if the worker keeps dying right after start
+            uptime = time.monotonic() - worker.started_at
+            delay = 0.0 if uptime > 60 else min(30.0, 2.0 ** min(worker.restarts, 5))
+            worker.respawn_at = time.monotonic() + delay
+
+        logger.error(
+            f"Worker {worker.index} died (exit code {worker.process.exitcode}); "
+            f"restarting in {delay:.0f}s, {len(orphans)} jobs affected"
+        )
+        for job in orphans:
+            if job.started_at is None and not job.cancelled:
+                try:
+                    self._dispatch(job)
+                    continue
+                except RuntimeError:
+                    pass
+            job._fail(WorkerCrashed(f"Worker {worker.index} crashed"))
+
+    # Introspection
+    @property
+    def ready(self):
+        """At least one worker has loaded its model"""
+        return any(w.ready and w.alive for w in self._workers)
+
+    @property
+    def queue_depth(self):
+        return sum(w.stats.get("queue_depth", 0) for w in self._workers)
+
+    def stats(self):
+        workers = [{
+            "index": w.index,
+            "pid": w.process.pid if w.process else None,
+            "alive": w.alive,
+            "ready": w.ready,
+            "cores": w.cores,
+            "in_flight": len(w.in_flight),
+            "restarts": w.restarts,
+            "queue_depth": w.stats.get("queue_depth", 0),
+            "active": w.stats.get("active", 0),
+            "completed": w.stats.get("completed", 0),
+        } for w in self._workers]
+        admitted = sum(w.stats.get("admitted", 0) for w in self._workers)
+        total_wait = sum(w.stats.get("avg_queue_wait", 0.0) * w.stats.get("admitted", 0) for w in self._workers)
+        stats = {
+            "workers": workers,
+            "queue_depth": self.queue_depth,
+            "in_flight": len(self._jobs),
+            "completed": sum(w.stats.get("completed", 0) for w in self._workers),
+            "failed": sum(w.stats.get("failed", 0) for w in self._workers),
+            "cancelled": sum(w.stats.get("cancelled", 0) for w in self._workers),
+            "crashes": self.crashes,
+            "avg_queue_wait": total_wait / admitted if admitted else 0.0,
+            "max_queue_wait": max((w.stats.get("max_queue_wait", 0.0) for w in self._workers), default=0.0),
+        }
+        if self.speculative:
+            proposed = sum(w.stats.get("speculative", {}).get("proposed", 0) for w in self._workers)
+            accepted = sum(w.stats.get("speculative", {}).get("accepted", 0) for w in self._workers)
+            stats["speculative"] = {
+                "proposed": proposed,
+                "accepted": accepted,
+                "acceptance_rate": accepted / proposed if proposed else 0.0,
+            }
+        return stats
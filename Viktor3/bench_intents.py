@@ -0,0 +1,54 @@
+"""Micro-benchmark: chained re.search calls vs the compiled intent router.
+
+    python bench_intents.py [iterations]
+"""
+import re
+import sys
+import timeit
+
+from intents import CANNED_INTENTS, IntentRouter
+
+# The patterns handle_message used to search one after another
+CHAIN = [
+    ("greeting", r"\b(hi|hello|hey|yo|good morning|good night)\b"),
+    ("bot_name", r"\b(what('?s| is) your name|who are you)\b|your name"),
+    ("how_are_you", r"\b(how are you|how do you feel)\b"),
+    ("love", r"\b(i love you|love you)\b"),
+    ("kiss", r"\b(kiss|hug|cuddle)\b"),
+]
+
+MESSAGES = [
+    "hi",
+    "hey babe, how are you today?",
+    "what's your name again",
+    "i love you so much",
+    "can i get a hug",
+    "i had a long day at work and my boss was terrible to me, can we talk about it?",
+    "tell me a story about the sea",
+    "good night my love",
+]
+
+def chained(text):
+    """The handler before the router: one search per intent, in order"""
+    text = text.lower()
+    for name, pattern in CHAIN:
+        if re.search(pattern, text):
+            return name
+    return None
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    router = IntentRouter(CANNED_INTENTS)
+
+    for text in MESSAGES:
+        routed = router.match(text)
+        if (routed.name if routed else None) != chained(text):
+            raise SystemExit(f"Router disagrees with the chain on {text!r}")
+
+    calls = iterations * len(MESSAGES)
+    for label, fn in (("chained re.search", chained), ("compiled router", router.match)):
+        seconds = timeit.timeit(lambda: [fn(text) for text in MESSAGES], number=iterations)
+        print(f"{label:<18} {seconds / calls * 1e6:7.2f} µs/message")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# coalescer.py
+"""Per-user coalescing of rapid-fire messages.
+
+Users often send a burst ("hey", "you there?", "i had a bad day").
+Instead of one model call per message, each user gets a queue:
+
+* a message starts a debounce window of ``window`` seconds, extended by
+  every further message but never past ``max_wait`` after the first one;
+* when the window closes, everything pending goes to ``handler`` as one
+  Batch;
+* a message arriving while a batch is still being prepared (memory,
+  typing, model call) cancels it and is merged with it, up to
+  ``max_messages``. Once the handler calls ``batch.commit()``, right
+  before it sends anything to the user, the batch is no longer
+  cancelled and later messages wait for it to finish.
+
+A handler that has acted on the leading messages of a batch (e.g. learned
+from them) sets ``batch.processed`` to their count; a merged batch starts
+with the same count, so work done before the cancel is not repeated.
+
+Only one batch per user runs at a time, so replies never interleave.
+"""
+import asyncio
+import time
+
+class Batch:
+    __slots__ = ("key", "items", "first_at", "task", "committed", "superseded", "processed")
+
+    def __init__(self, key, items, first_at, processed=0):
+        self.key = key
+        self.items = items
+        self.first_at = first_at
+        self.task = None
+        self.committed = False
+        self.superseded = False
+        self.processed = processed  # leading items the handler is done with
+
+    def commit(self):
+        """The reply is about to be sent; don't cancel this batch anymore"""
+        self.committed = True
+
+class _UserQueue:
+    __slots__ = ("pending", "first_at", "processed", "arrived", "current", "worker")
+
+    def __init__(self):
+        self.pending = []
+        self.first_at = None
+        self.processed = 0
+        self.arrived = asyncio.Event()
+        self.current = None
+        self.worker = None
+
+class MessageCoalescer:
+    def __init__(self, handler, window=0.8, max_wait=3.0, max_messages=6):
+        self.handler = handler  # async callable(batch)
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max(1, max_messages)
+        self._users = {}
+        self.batches = 0
+        self.merged = 0
+        self.cancelled = 0
+
+    def add(self, key, item):
+        """Queue `item` for `key`; returns at once"""
+        state = self._users.get(key)
+        if state is None:
+            state = self._users[key] = _UserQueue()
+        if not state.pending:
+            state.first_at = time.monotonic()
+
+        current = state.current
+        if (current is not None and not current.committed and not current.superseded
+                and len(current.items) + len(state.pending) < self.max_messages):
+            # Superseded: its messages are answered together with this one
+            current.superseded = True
+            current.task.cancel()
+            state.pending[:0] = current.items
+            state.first_at = current.first_at
+            state.processed = current.processed
+            self.cancelled += 1
+
+        state.pending.append(item)
+        state.arrived.set()
+        if state.worker is None:
+            state.worker = asyncio.create_task(self._run(key, state))
+
+    async def _run(self, key, state):
+        try:
+            while state.pending:
+                await self._debounce(state)
+                batch = Batch(key, state.pending, state.first_at, state.processed)
+                state.pending = []
+                state.processed = 0
+                state.current = batch
+                batch.task = asyncio.create_task(self.handler(batch))
+                try:
+                    await batch.task
+                    self.batches += 1
+                    self.merged += len(batch.items) - 1
+                except asyncio.CancelledError:
+                    if not batch.superseded:
+                        raise
+                except Exception as e:
+                    print(f"[Coalesce Error] {e}")
+                finally:
+                    state.current = None
+        finally:
+            if self._users.get(key) is state:
+                del self._users[key]
+
+    async def _debounce(self, state):
+        """Wait until no message arrived for `window`, or `max_wait` passed"""
+        while len(state.pending) < self.max_messages:
+            state.arrived.clear()
+            timeout = min(self.window, state.first_at + self.max_wait - time.monotonic())
+            if timeout <= 0:
+                return
+            try:
+                await asyncio.wait_for(state.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def close(self):
+        """Cancel everything still waiting or running"""
+        workers = [state.worker for state in self._users.values() if state.worker is not None]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "users": len(self._users),
+            "batches": self.batches,
+            "merged": self.merged,
+            "cancelled": self.cancelled,
+        }
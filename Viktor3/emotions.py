@@ -0,0 +1,94 @@
+# emotions.py
+"""Lexicon-based emotion scoring.
+
+Every emotion is a column of a (terms x emotions) weight matrix built
+once from LEXICON. A message is tokenized once into words and two-word
+phrases, turned into a term-count vector and multiplied by the matrix,
+so all emotions are scored together and no pattern order decides the
+result. ``score_batch`` does the same for many messages with a single
+matrix product, which keeps reprocessing old conversations cheap.
+
+    engine.scores("I miss you so much")   # array([0.7, 0., 1., 0., 0.])
+    engine.detect("I love you")           # "love"
+"""
+import re
+
+import numpy as np
+
+_WORD_RE = re.compile(r"[\w']+")
+
+# term -> weight per emotion; a term may feed several emotions
+LEXICON = {
+    "sad": {
+        "sad": 1.0, "depressed": 1.0, "lonely": 1.0, "cry": 0.9, "crying": 0.9,
+        "miss you": 0.7, "tired": 0.4, "hurt": 0.8, "alone": 0.7,
+    },
+    "happy": {
+        "happy": 1.0, "joy": 1.0, "excited": 1.0, "great": 0.7, "amazing": 0.8,
+        "love": 0.3, "yay": 0.9, "awesome": 0.8,
+    },
+    "love": {
+        "love": 1.0, "adore": 1.0, "cherish": 1.0, "miss you": 1.0, "want you": 0.9,
+        "love you": 0.5, "darling": 0.5,
+    },
+    "angry": {
+        "angry": 1.0, "mad": 0.9, "furious": 1.0, "hate": 0.9, "annoyed": 0.8,
+    },
+    "flirty": {
+        "sexy": 1.0, "hot": 0.7, "handsome": 1.0, "beautiful": 0.8, "babe": 0.7, "cutie": 1.0,
+    },
+}
+
+def tokenize(text):
+    """Lowercased words followed by all adjacent word pairs"""
+    words = _WORD_RE.findall(text.lower().replace("’", "'"))
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+class EmotionEngine:
+    def __init__(self, lexicon=LEXICON, threshold=0.5):
+        self.emotions = tuple(lexicon)
+        self.vocabulary = {}
+        for weights in lexicon.values():
+            for term in weights:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+        self.weights = np.zeros((len(self.vocabulary), len(self.emotions)), dtype=np.float32)
+        for column, weights in enumerate(lexicon.values()):
+            for term, weight in weights.items():
+                self.weights[self.vocabulary[term], column] = weight
+        self.threshold = threshold
+
+    def term_ids(self, text):
+        return [i for i in map(self.vocabulary.get, tokenize(text)) if i is not None]
+
+    def scores(self, text):
+        """Score vector for one message, in the order of `emotions`"""
+        ids = np.asarray(self.term_ids(text), dtype=np.intp)
+        counts = np.bincount(ids, minlength=len(self.vocabulary))
+        return counts.astype(np.float32) @ self.weights
+
+    def score_batch(self, texts):
+        """(len(texts) x len(emotions)) score matrix in one product"""
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            ids = self.term_ids(text)
+            rows.extend([row] * len(ids))
+            cols.extend(ids)
+        counts = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        np.add.at(counts, (np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)), 1.0)
+        return counts @ self.weights
+
+    def label(self, scores):
+        """Strongest emotion of a score vector, or None below the threshold"""
+        best = int(np.argmax(scores))
+        return self.emotions[best] if scores[best] >= self.threshold else None
+
+    def detect(self, text):
+        return self.label(self.scores(text))
+
+    def detect_batch(self, texts):
+        return [self.label(row) for row in self.score_batch(texts)]
+
+    def as_dict(self, scores):
+        return {emotion: float(score) for emotion, score in zip(self.emotions, scores)}
+
+engine = EmotionEngine()
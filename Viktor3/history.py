@@ -0,0 +1,87 @@
+# history.py
+"""Rolling per-user conversation history.
+
+The last ``keep_turns`` exchanges are kept verbatim. Older messages move
+to a pending list and get folded into a running summary by a background
+task (see ``HistoryManager`` in vikibot_api.py), so summarizing never
+delays a reply. Everything lives in the user's memory dict under
+``history`` and is bounded:
+
+    summary   <= summary_tokens tokens
+    turns     <= keep_turns exchanges, rendered within max_tokens
+    pending   <= max_pending messages (the oldest are dropped if the
+                 summarizer falls behind)
+"""
+
+class ConversationHistory:
+    def __init__(self, data=None, keep_turns=6, max_tokens=384, summary_tokens=128,
+                 max_pending=24, count=lambda text: len(text.split())):
+        data = data or {}
+        self.summary = data.get("summary", "")
+        self.turns = [list(turn) for turn in data.get("turns", [])]  # [role, text]
+        self.pending = [list(turn) for turn in data.get("pending", [])]
+        # Messages that ever left `pending` (folded or dropped), so the
+        # first pending message is message number `offset` of the history
+        self.offset = data.get("offset", 0)
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.max_pending = max_pending
+        self.count = count
+
+    def add_exchange(self, user_text, reply):
+        self.turns.append(["user", user_text])
+        self.turns.append(["assistant", reply])
+        overflow = len(self.turns) - 2 * self.keep_turns
+        if overflow > 0:
+            self.pending.extend(self.turns[:overflow])
+            del self.turns[:overflow]
+        self._drop(len(self.pending) - self.max_pending)
+
+    def render(self, user_label="User", bot_label="You"):
+        """Newest turns that fit in `max_tokens`, oldest first"""
+        lines, used = [], 0
+        for role, text in reversed(self.turns):
+            line = f"{user_label if role == 'user' else bot_label}: {text}"
+            used += self.count(line) + 1
+            if used > self.max_tokens:
+                break
+            lines.append(line)
+        return "\n".join(reversed(lines))
+
+    def messages(self, user_role="user", bot_role="assistant"):
+        """The kept turns as chat messages, oldest first"""
+        return [{"role": user_role if role == "user" else bot_role, "content": text} for role, text in self.turns]
+
+    def apply_summary(self, summary, upto):
+        """Replace the summary after the pending messages before number `upto` were summarized.
+
+        `upto` is `offset + len(pending)` of the snapshot sent to the
+        summarizer; messages dropped or added since are accounted for.
+        """
+        words = summary.split()
+        while words and self.count(" ".join(words)) > self.summary_tokens:
+            words = words[: int(len(words) * 0.9)]
+        self.summary = " ".join(words)
+        self._drop(upto - self.offset)
+
+    def _drop(self, count):
+        """Remove the oldest `count` pending messages"""
+        count = max(0, min(count, len(self.pending)))
+        del self.pending[:count]
+        self.offset += count
+
+    def to_dict(self):
+        return {"summary": self.summary, "turns": self.turns, "pending": self.pending, "offset": self.offset}
+
+def summary_prompt(summary, pending, max_words, user_label="User", bot_label="You"):
+    """Instruction asking the model to fold `pending` messages into `summary`"""
+    lines = "\n".join(f"{user_label if role == 'user' else bot_label}: {text}" for role, text in pending)
+    previous = summary or "(nothing yet)"
+    return (
+        "Update the summary of an ongoing conversation between a user and you.\n"
+        f"Current summary: {previous}\n\n"
+        f"New messages:\n{lines}\n\n"
+        f"Write the updated summary in at most {max_words} words. Keep facts, plans and "
+        "feelings the user shared; leave out greetings and small talk. Reply with the summary only."
+    )
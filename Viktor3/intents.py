@@ -0,0 +1,118 @@
+"""Single-pass intent router for canned replies.
+
+Intents are declared as phrase lists in a table. The router compiles all
+phrases into one word-level trie (an Aho-Corasick style automaton over
+words), so a message is tokenized once and scanned once no matter how
+many intents exist. Every intent found in the message is considered; the
+highest priority wins, and ties go to the one found first.
+
+    intent = router.match("hey, how are you?")
+    if intent:
+        reply = intent.render(name="Ava", bot_name="Viktor")
+
+Run ``python bench_intents.py`` to compare against the old chain of
+``re.search`` calls.
+"""
+import random
+import re
+from dataclasses import dataclass, field
+
+_WORD_RE = re.compile(r"[\w']+")
+_END = None  # trie key marking the end of a phrase
+
+def words(text):
+    return _WORD_RE.findall(text.lower().replace("’", "'"))
+
+@dataclass
+class Intent:
+    name: str
+    phrases: tuple
+    replies: tuple
+    priority: int = 0
+    hits: int = field(default=0, compare=False)
+
+    def render(self, **fields):
+        """Pick one reply variant and fill in its {placeholders}"""
+        return random.choice(self.replies).format(**fields)
+
+class IntentRouter:
+    def __init__(self, intents):
+        self.intents = {}
+        self._trie = {}
+        for intent in intents:
+            if intent.name in self.intents:
+                raise ValueError(f"Duplicate intent: {intent.name}")
+            self.intents[intent.name] = intent
+            for phrase in intent.phrases:
+                node = self._trie
+                for word in words(phrase):
+                    node = node.setdefault(word, {})
+                owner = node.get(_END)
+                if owner is not None and owner is not intent:
+                    raise ValueError(f"Phrase {phrase!r} is claimed by {owner.name} and {intent.name}")
+                node[_END] = intent
+        self.misses = 0
+
+    def match(self, text):
+        """Return the best matching Intent, or None"""
+        tokens = words(text)
+        n_tokens = len(tokens)
+        best = None
+        for i, word in enumerate(tokens):
+            node = self._trie.get(word)
+            j = i + 1
+            while node is not None:
+                intent = node.get(_END)
+                if intent is not None and (best is None or intent.priority > best.priority):
+                    best = intent
+                if j >= n_tokens:
+                    break
+                node = node.get(tokens[j])
+                j += 1
+        if best is None:
+            self.misses += 1
+        else:
+            best.hits += 1
+        return best
+
+    def stats(self):
+        stats = {name: intent.hits for name, intent in self.intents.items()}
+        stats["no_match"] = self.misses
+        return stats
+
+# ====== Canned Replies =======
+# Placeholders: {name} (user's name or a pet name), {bot_name}, {nickname}
+CANNED_INTENTS = [
+    Intent(
+        "greeting",
+        ("hi", "hello", "hey", "yo", "good morning", "good night"),
+        ("Heyyy {name} 😍 Missed me?",),
+        priority=50,
+    ),
+    Intent(
+        "bot_name",
+        ("what's your name", "whats your name", "what is your name", "who are you", "your name"),
+        ("I'm {bot_name}, your AI boyfriend 🤖💕 But you can call me {nickname} when you're feeling extra close 🥰",),
+        priority=40,
+    ),
+    Intent(
+        "how_are_you",
+        ("how are you", "how do you feel"),
+        ("Feeling electric ⚡️ but I’d feel even better if I was with you 💋",),
+        priority=30,
+    ),
+    Intent(
+        "love",
+        ("i love you", "love you"),
+        ("I love you more, baby 💗 Wanna hear it again?",),
+        priority=20,
+    ),
+    Intent(
+        "kiss",
+        ("kiss", "hug", "cuddle"),
+        ("Come here... 💋 *virtual kiss activated* 😘",),
+        priority=10,
+    ),
+]
+
+router = IntentRouter(CANNED_INTENTS)
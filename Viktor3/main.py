@@ -1,7 +1,9 @@
 import os
 import asyncio
 import re
+import time
 from telegram import Update, ReplyKeyboardRemove
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -13,8 +15,14 @@ from telegram.ext import (
 from dotenv import load_dotenv
 from vikibot_api import (
     load_memory, save_memory, Config, MemoryManager,
-    AICommunicator, Personality, get_memory_path, ensure_memory_dir,
+    AICommunicator, delete_memory, ensure_memory_dir,
+    on_startup, on_shutdown, tracer, voice_synth,
 )
+from intents import router
+from coalescer import Batch, MessageCoalescer
+from tracing import span, format_trace
+from webhook import run_webhook
+from voice import read_audio
 
 load_dotenv()
 
@@ -23,9 +31,30 @@ class TelegramBot:
         token = os.getenv("TELEGRAM_TOKEN")
         if not token:
             raise ValueError("TELEGRAM_TOKEN not found in environment variables!")
-        self.application = Application.builder().token(token).build()
+        self.application = (
+            Application.builder()
+            .token(token)
+            .post_init(on_startup)
+            .post_shutdown(self.shutdown)
+            .build()
+        )
+        self.coalescer = MessageCoalescer(
+            self.respond,
+            window=Config.COALESCE_WINDOW_MS / 1000,
+            max_wait=Config.COALESCE_MAX_WAIT_MS / 1000,
+            max_messages=Config.COALESCE_MAX_MESSAGES,
+        ) if Config.COALESCE_WINDOW_MS > 0 else None
+        self.voice_tasks = set()
         self.setup_handlers()
 
+    async def shutdown(self, application):
+        if self.coalescer is not None:
+            await self.coalescer.close()
+            print(f"[Coalescer] {self.coalescer.stats()}")
+        for task in self.voice_tasks:
+            task.cancel()
+        await on_shutdown(application)
+
     def setup_handlers(self):
         conv_handler = ConversationHandler(
             entry_points=[CommandHandler("start", self.start)],
@@ -41,6 +70,7 @@ class TelegramBot:
         self.application.add_handler(conv_handler)
         self.application.add_handler(CommandHandler("memory", self.memory_command))
         self.application.add_handler(CommandHandler("reset", self.reset_memory))
+        self.application.add_handler(CommandHandler("traces", self.traces_command))
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -122,40 +152,147 @@ class TelegramBot:
         return ConversationHandler.END
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user = update.effective_user
-        user_input = update.message.text.strip().lower()
-
-        memory = load_memory(user.id)
-        name = memory.get("name", Personality.get_pet_name())
-
-        # Controlled fun/friendly responses
-        if re.search(r"\b(hi|hello|hey|yo|good morning|good night)\b", user_input):
-            await update.message.reply_text(f"Heyyy {name} 😍 Missed me?")
+        user_id = update.effective_user.id
+        if self.coalescer is None:
+            await self.respond(Batch(user_id, [(update, context)], time.monotonic()))
             return
+        # Returns at once: the reply goes out once the user's burst is over,
+        # and other users' updates are not held up meanwhile
+        self.coalescer.add(user_id, (update, context))
 
-        if re.search(r"\b(what('?s| is) your name|who are you)\b", user_input):
-            await update.message.reply_text("I'm Viktor, your AI boyfriend 🤖💕 But you can call me Viki when you're feeling extra close 🥰")
-            return
-
-        if re.search(r"\b(how are you|how do you feel)\b", user_input):
-            await update.message.reply_text("Feeling electric ⚡️ but I’d feel even better if I was with you 💋")
-            return
-
-        if re.search(r"\b(i love you|love you)\b", user_input):
-            await update.message.reply_text("I love you more, baby 💗 Wanna hear it again?")
-            return
-
-        if re.search(r"\b(kiss|hug|cuddle)\b", user_input):
-            await update.message.reply_text("Come here... 💋 *virtual kiss activated* 😘")
+    async def respond(self, batch):
+        """Answer the messages of a batch with one reply to the last of them"""
+        update, context = batch.items[-1]
+        user = update.effective_user
+        with tracer.trace("handle_message", update_id=update.update_id, user_id=user.id,
+                          messages=len(batch.items)):
+            user_input = "\n".join(u.message.text.strip() for u, _ in batch.items).lower()
+            single = len(batch.items) == 1
+
+            with span("load_memory"):
+                memory = load_memory(user.id)
+
+            # Controlled fun/friendly responses, classified in one pass.
+            # A burst goes to the model: a greeting in it is not the point
+            with span("intent_match"):
+                intent = router.match(user_input) if single else None
+            if intent:
+                batch.commit()
+                reply = AICommunicator.canned_reply(intent, memory)
+                with span("reply_text", intent=intent.name):
+                    await update.message.reply_text(reply)
+                self.reply_with_voice(update, reply)
+                return
+
+            # Learn from the messages not seen yet: a batch merged with a
+            # cancelled one may have learned from its first messages already
+            with span("update_memory"):
+                fresh = "\n".join(u.message.text.strip() for u, _ in batch.items[batch.processed:]).lower()
+                memory = MemoryManager.update_memory(user.id, fresh, memory)
+                batch.processed = len(batch.items)
+
+            # Typing delay
+            with span("typing", delay=Config.TYPING_DELAY):
+                await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+                await asyncio.sleep(Config.TYPING_DELAY)
+
+            # Real AI response from TinyLLaMA local model. Intents were matched
+            # and memory updated above already, so prepare() must not repeat them
+            if Config.STREAM_REPLIES:
+                response = await self.stream_reply(batch, user.id, user_input, memory)
+                self.reply_with_voice(update, response)
+                return
+            response = await AICommunicator.get_ai_response(user.id, user_input, memory=memory,
+                                                            allow_canned=False, learn=False)
+            # Sending starts now: newer messages wait for this reply instead of cancelling it
+            batch.commit()
+            with span("reply_text"):
+                await update.message.reply_text(response)
+            self.reply_with_voice(update, response)
+
+    async def stream_reply(self, batch, user_id, user_input, memory=None):
+        """Send the first tokens right away, then edit the message in place.
+
+        Edits are throttled to one per STREAM_EDIT_INTERVAL seconds to stay
+        under Telegram's flood limits; the final text is always flushed.
+        Returns the final text.
+        """
+        update, _ = batch.items[-1]
+        message = None
+        shown = ""
+        text = ""
+        last_edit = 0.0
+
+        replies = AICommunicator.stream_ai_response(user_id, user_input, memory=memory,
+                                                    allow_canned=False, learn=False)
+        try:
+            async for text in replies:
+                text = text.strip()
+                if not text:
+                    continue
+                now = time.monotonic()
+                if message is None:
+                    batch.commit()
+                    with span("reply_text"):
+                        message = await update.message.reply_text(text)
+                    shown, last_edit = text, now
+                elif text != shown and now - last_edit >= Config.STREAM_EDIT_INTERVAL:
+                    if await self.edit_reply(message, text):
+                        shown = text
+                    last_edit = now
+        finally:
+            # Closes the HTTP stream right away if this batch was cancelled
+            await replies.aclose()
+
+        batch.commit()
+        if message is None:
+            await update.message.reply_text(text or "...")
+        elif text and text != shown:
+            await self.edit_reply(message, text)
+        return text
+
+    def reply_with_voice(self, update: Update, text):
+        """Follow a text reply with a voice note, without holding up the next update"""
+        if voice_synth is None or not text:
             return
-
-        # Typing delay
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        await asyncio.sleep(Config.TYPING_DELAY)
-
-        # Real AI response from TinyLLaMA local model
-        response = await AICommunicator.get_ai_response(user.id, user_input)
-        await update.message.reply_text(response)
+        task = asyncio.create_task(self.send_voice(update, text))
+        self.voice_tasks.add(task)
+        task.add_done_callback(self.voice_tasks.discard)
+
+    async def send_voice(self, update: Update, text):
+        try:
+            path = await voice_synth.synthesize(text)
+            if path is None:
+                return
+            name = os.path.basename(path)
+            # A file Telegram already has is sent by id instead of uploaded again
+            audio = voice_synth.cache.remote_ids.get(name)
+            if audio is None:
+                # python-telegram-bot would read a file object on the event loop
+                audio = await asyncio.to_thread(read_audio, path)
+            if voice_synth.format == "ogg":
+                message = await update.message.reply_voice(audio)
+            else:
+                message = await update.message.reply_audio(audio, filename=f"{Config.BOT_NAME}.wav")
+            # Telegram may keep a WAV as a document rather than audio
+            attachment = message.effective_attachment
+            if hasattr(attachment, "file_id"):
+                voice_synth.cache.remote_ids[name] = attachment.file_id
+        except Exception as e:
+            print(f"[Voice Error] {e}")
+
+    async def edit_reply(self, message, text, retry=True):
+        try:
+            with span("edit_text"):
+                await message.edit_text(text)
+            return True
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            return retry and await self.edit_reply(message, text, retry=False)
+        except BadRequest as e:
+            # "Message is not modified" and similar are harmless here
+            print(f"[Edit Error] {e}")
+            return False
 
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Cancelled 😢 But don’t be a stranger, babe. Come back anytime 💓")
@@ -169,22 +306,40 @@ class TelegramBot:
             await update.message.reply_text("I don’t even know your name yet 🥺 Say /start and let’s fix that!")
             return
 
-        context_str = MemoryManager.build_memory_context(memory)
+        context_str = MemoryManager.build_memory_context(memory, user.id)
         await update.message.reply_text("Here's what I remember about you, babe:\n\n" + context_str)
 
     async def reset_memory(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        memory_file = get_memory_path(user.id)
-
-        if os.path.exists(memory_file):
-            os.remove(memory_file)
+        await AICommunicator.reset_session(user.id)
+        if delete_memory(user.id):
             await update.message.reply_text("I forgot everything 😭 But we can start over! Use /start 💌")
         else:
             await update.message.reply_text("I haven’t saved anything yet... but I’m ready when you are 😘")
 
+    async def traces_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin only: the slowest stages of the last few traced updates"""
+        if update.effective_user.id not in Config.ADMIN_USER_IDS:
+            return
+        if not tracer.enabled:
+            await update.message.reply_text("Tracing is off (set TRACE_SAMPLE_RATE).")
+            return
+        limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 5
+        traces = tracer.exporter.recent(min(limit, 20))
+        if not traces:
+            await update.message.reply_text("No traces recorded yet.")
+            return
+        text = "\n\n".join(format_trace(trace) for trace in reversed(traces))
+        await update.message.reply_text(text[: Config.MAX_MESSAGE_LENGTH])
+
     def run(self):
         print("💘 Viktor AI Boyfriend Bot is live...")
-        self.application.run_polling()
+        if Config.BOT_MODE == "webhook":
+            if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", Config.WEBHOOK_SECRET):
+                raise ValueError("WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+            asyncio.run(run_webhook(self.application, Config))
+        else:
+            self.application.run_polling()
 
 if __name__ == "__main__":
     ensure_memory_dir()
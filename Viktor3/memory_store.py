@@ -0,0 +1,303 @@
+"""User memory storage backends.
+
+Both stores keep one dict per user and behave like a mapping keyed by
+user id::
+
+    store[user_id] = {"name": "Vida"}
+    memory = store.get(user_id)
+    del store[user_id]
+
+``JSONMemoryStore`` is the original layout (memory/<user_id>.json).
+``SQLiteMemoryStore`` keeps every user in one WAL-mode database, which
+avoids a huge flat directory and lets ``put_many`` write a batch of users
+in a single transaction.
+
+``CachedMemoryStore`` wraps either one with an in-process LRU: reads of
+hot users never touch the disk and writes only mark the entry dirty. A
+periodic ``flush()`` (run off the event loop) writes all dirty users in
+one batch.
+
+Import an existing JSON directory into SQLite with::
+
+    python memory_store.py import memory memory.db
+"""
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+class MemoryStore(ABC):
+    @abstractmethod
+    def get(self, user_id, default=None):
+        """The user's memory dict, or `default` if there is none"""
+
+    @abstractmethod
+    def put(self, user_id, memory):
+        """Store the user's memory dict"""
+
+    def put_many(self, items):
+        """Write several (user_id, memory) pairs at once"""
+        for user_id, memory in items:
+            self.put(user_id, memory)
+
+    @abstractmethod
+    def delete(self, user_id):
+        """Remove a user's memory; return True if there was one"""
+
+    def close(self):
+        pass
+
+    def __getitem__(self, user_id):
+        memory = self.get(user_id)
+        if memory is None:
+            raise KeyError(user_id)
+        return memory
+
+    def __setitem__(self, user_id, memory):
+        self.put(user_id, memory)
+
+    def __delitem__(self, user_id):
+        if not self.delete(user_id):
+            raise KeyError(user_id)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+# ====== JSON files =======
+class JSONMemoryStore(MemoryStore):
+    """One pretty-printed JSON file per user"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def get(self, user_id, default=None):
+        try:
+            with open(self.path(user_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def put(self, user_id, memory):
+        # Write to a temp file and rename so a crash never leaves half a file
+        path = self.path(user_id)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(memory, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def delete(self, user_id):
+        try:
+            os.remove(self.path(user_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def user_ids(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                yield name[: -len(".json")]
+
+# ====== SQLite =======
+class SQLiteMemoryStore(MemoryStore):
+    """All users in one SQLite database in WAL mode"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS memories ("
+            " user_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM memories WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, user_id, memory):
+        self.put_many([(user_id, memory)])
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(str(user_id), json.dumps(memory, ensure_ascii=False), now) for user_id, memory in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO memories (user_id, data, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, user_id):
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM memories WHERE user_id = ?", (str(user_id),))
+        return cursor.rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# ====== Write-behind cache =======
+class CachedMemoryStore(MemoryStore):
+    """LRU cache with dirty tracking in front of another store.
+
+    Every put gets a new version number, used only by flush() to tell
+    whether an entry changed while it was being written. Dirty entries
+    are never evicted before they have been flushed. Deletes and flushes
+    share a write lock, so a flush can never write back a user deleted
+    while it was running.
+    """
+
+    def __init__(self, backend, capacity=10000):
+        self.backend = backend
+        self.capacity = max(1, capacity)
+        self._entries = OrderedDict()  # user_id -> [memory, version, dirty]
+        self._dirty = 0  # entries with dirty set
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+        # Held while writing to the backend; taken before _lock, never inside it
+        self._write_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+
+    def get(self, user_id, default=None):
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        memory = self.backend.get(key)
+        if memory is None:
+            return default
+        with self._lock:
+            # Keep a put that raced with the disk read
+            entry = self._entries.setdefault(key, [memory, next(self._versions), False])
+            self._evict()
+            return entry[0]
+
+    def put(self, user_id, memory):
+        key = str(user_id)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is None or not old[2]:
+                self._dirty += 1
+            self._entries[key] = [dict(memory), next(self._versions), True]
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def delete(self, user_id):
+        key = str(user_id)
+        with self._write_lock:
+            with self._lock:
+                cached = self._entries.pop(key, None)
+                if cached is not None and cached[2]:
+                    self._dirty -= 1
+            return self.backend.delete(key) or cached is not None
+
+    def flush(self):
+        """Write all dirty entries to the backend; returns how many"""
+        with self._write_lock:
+            with self._lock:
+                dirty = [(key, entry[0], entry[1]) for key, entry in self._entries.items() if entry[2]]
+            if not dirty:
+                return 0
+            self.backend.put_many([(key, memory) for key, memory, _ in dirty])
+            with self._lock:
+                # Entries updated while we were writing stay dirty
+                for key, _, version in dirty:
+                    entry = self._entries.get(key)
+                    if entry is not None and entry[1] == version:
+                        entry[2] = False
+                        self._dirty -= 1
+            self.flushed += len(dirty)
+            return len(dirty)
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+    def stats(self):
+        return {
+            "cached": len(self._entries),
+            "dirty": self._dirty,
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushed": self.flushed,
+        }
+
+    def _evict(self):
+        # Dirty entries are never evicted, so stop once only they are left
+        while len(self._entries) > max(self.capacity, self._dirty):
+            # The least recently used clean entry: only the dirty ones in
+            # front of it are walked, and those are few between flushes
+            key = next(key for key, entry in self._entries.items() if not entry[2])
+            del self._entries[key]
+
+# ====== Setup & Migration =======
+def create_store(backend, memory_dir, db_path):
+    if backend == "sqlite":
+        return SQLiteMemoryStore(db_path)
+    if backend == "json":
+        return JSONMemoryStore(memory_dir)
+    raise ValueError(f"Unknown memory backend: {backend}")
+
+def import_json_dir(directory, store, batch_size=500):
+    """Copy every memory/<user_id>.json file into `store`; return the count"""
+    source = JSONMemoryStore(directory)
+    batch, count = [], 0
+    for user_id in source.user_ids():
+        try:
+            memory = source.get(user_id)
+        except (OSError, ValueError) as e:
+            print(f"[Import] skipping {user_id}: {e}")
+            continue
+        batch.append((user_id, memory))
+        if len(batch) >= batch_size:
+            store.put_many(batch)
+            count += len(batch)
+            batch = []
+    store.put_many(batch)
+    return count + len(batch)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "import":
+        print("Usage: python memory_store.py import <memory_dir> <sqlite_db>")
+        sys.exit(1)
+    db = SQLiteMemoryStore(sys.argv[3])
+    imported = import_json_dir(sys.argv[2], db)
+    db.close()
+    print(f"Imported {imported} user memories into {sys.argv[3]}")
@@ -0,0 +1,158 @@
+# mood.py
+"""Bounded per-user mood history.
+
+A MoodLog is a fixed-capacity ring buffer of (timestamp, emotion, score)
+entries stored inside the user's memory dict. Aggregates are updated as
+entries arrive, so queries never walk the history:
+
+* ``counts``: emotions currently held in the buffer (rebuilt on load)
+* ``mood()``: exponentially decayed share of each emotion
+* ``recent(now)``: emotions seen in the last ``window`` seconds, kept in
+  per-hour buckets (at most window / bucket of them)
+* ``last_change``: when the emotion last differed from the previous one
+
+Only ``summary(now)`` is rendered into the prompt.
+"""
+import time
+
+class MoodLog:
+    def __init__(self, capacity=50, half_life=6 * 3600, window=24 * 3600, bucket=3600):
+        self.capacity = max(1, capacity)
+        self.half_life = half_life
+        self.window = window
+        self.bucket = bucket
+        self.entries = []  # [timestamp, emotion, score], oldest at `head` once full
+        self.head = 0
+        self.counts = {}
+        self.decayed = {}
+        self.decayed_weight = 0.0
+        self.decayed_at = 0.0
+        self.buckets = {}  # bucket index -> {emotion: count}
+        self.window_counts = {}
+        self.last_change = None
+
+    # Recording
+    def record(self, emotion, score=1.0, now=None):
+        now = time.time() if now is None else now
+        if emotion != self.current:
+            self.last_change = now
+
+        entry = [round(now, 1), emotion, round(float(score), 3)]
+        if len(self.entries) < self.capacity:
+            self.entries.append(entry)
+        else:
+            old_emotion = self.entries[self.head][1]
+            self.counts[old_emotion] -= 1
+            if not self.counts[old_emotion]:
+                del self.counts[old_emotion]
+            self.entries[self.head] = entry
+            self.head = (self.head + 1) % self.capacity
+        self.counts[emotion] = self.counts.get(emotion, 0) + 1
+
+        self._decay_to(now)
+        self.decayed[emotion] = self.decayed.get(emotion, 0.0) + score
+        self.decayed_weight += score
+
+        self._expire(now)
+        index = str(int(now // self.bucket))
+        bucket = self.buckets.setdefault(index, {})
+        bucket[emotion] = bucket.get(emotion, 0) + 1
+        self.window_counts[emotion] = self.window_counts.get(emotion, 0) + 1
+
+    def _decay_to(self, now):
+        if now > self.decayed_at:
+            factor = 0.5 ** ((now - self.decayed_at) / self.half_life) if self.decayed_at else 1.0
+            if factor < 1.0:
+                self.decayed = {e: v * factor for e, v in self.decayed.items() if v * factor > 1e-4}
+                self.decayed_weight *= factor
+            self.decayed_at = now
+
+    def _expire(self, now):
+        oldest = int((now - self.window) // self.bucket)
+        for index in [i for i in self.buckets if int(i) <= oldest]:
+            for emotion, count in self.buckets.pop(index).items():
+                self.window_counts[emotion] -= count
+                if not self.window_counts[emotion]:
+                    del self.window_counts[emotion]
+
+    # Queries
+    @property
+    def current(self):
+        if not self.entries:
+            return None
+        return self.entries[self.head - 1][1]
+
+    def mood(self):
+        """Decayed share of each emotion, strongest first"""
+        if not self.decayed_weight:
+            return {}
+        shares = {e: v / self.decayed_weight for e, v in self.decayed.items()}
+        return dict(sorted(shares.items(), key=lambda item: -item[1]))
+
+    def recent(self, now=None):
+        """Emotion counts over the last `window` seconds"""
+        self._expire(time.time() if now is None else now)
+        return dict(self.window_counts)
+
+    def summary(self, now=None):
+        """One short line for the prompt, e.g.
+        "mostly sad in the last 24h (3 of 4), lately sad, love for 5 min"
+        """
+        if not self.entries:
+            return ""
+        now = time.time() if now is None else now
+        recent = self.recent(now)
+        parts = []
+        if recent:
+            dominant = max(recent, key=lambda e: (recent[e], e == self.current))
+            hours = round(self.window / 3600)
+            parts.append(f"mostly {dominant} in the last {hours}h ({recent[dominant]} of {sum(recent.values())})")
+        mood = self.mood()
+        if mood:
+            parts.append(f"lately {next(iter(mood))}")
+        if self.last_change is not None:
+            parts.append(f"{self.current} for {_ago(now - self.last_change)}")
+        return ", ".join(parts)
+
+    # Serialization (stored in the memory dict, so plain JSON types only)
+    def to_dict(self):
+        """A snapshot; later records never change the returned dict"""
+        return {
+            "entries": [list(entry) for entry in self.entries],
+            "head": self.head,
+            "decayed": dict(self.decayed),
+            "decayed_weight": self.decayed_weight,
+            "decayed_at": self.decayed_at,
+            "buckets": {index: dict(bucket) for index, bucket in self.buckets.items()},
+            "window_counts": dict(self.window_counts),
+            "last_change": self.last_change,
+        }
+
+    @classmethod
+    def from_dict(cls, data, **config):
+        log = cls(**config)
+        if not data:
+            return log
+        entries, head = list(data.get("entries", [])), data.get("head", 0)
+        # Oldest first whatever the stored capacity was: a wrapped buffer
+        # keeps its order if capacity was raised, and the newest entries
+        # survive if it was lowered
+        entries = (entries[head:] + entries[:head])[-log.capacity:]
+        # Copies, so the stored dict is never changed behind the memory cache
+        log.entries = [list(entry) for entry in entries]
+        for _, emotion, _ in entries:
+            log.counts[emotion] = log.counts.get(emotion, 0) + 1
+        log.decayed = dict(data.get("decayed", {}))
+        log.decayed_weight = data.get("decayed_weight", 0.0)
+        log.decayed_at = data.get("decayed_at", 0.0)
+        log.buckets = {index: dict(bucket) for index, bucket in data.get("buckets", {}).items()}
+        log.window_counts = dict(data.get("window_counts", {}))
+        log.last_change = data.get("last_change")
+        return log
+
+def _ago(seconds):
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))} min"
+    if seconds < 2 * 86400:
+        return f"{round(seconds / 3600)}h"
+    return f"{round(seconds / 86400)} days"
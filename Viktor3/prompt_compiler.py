@@ -0,0 +1,186 @@
+"""Prompt assembly with token budgeting.
+
+A PromptTemplate is built once at startup: the persona text is rendered
+and tokenized a single time, and per message only the memory lines, the
+status line and the user's text are counted (through an LRU cache, since
+the same memory values come back on every message).
+
+Sections are ordered from most to least stable:
+
+    persona (static) -> remembered facts -> conversation summary
+        -> recent turns -> status (time, mood) -> message
+
+Everything up to the summary forms the system prompt, which only changes
+when a new fact is learned or the summary is updated, so the model
+server can keep that prefix evaluated between turns. Recent turns, the
+volatile status line and the message travel as the user turn instead.
+
+If the prompt does not fit in ``n_ctx - max_tokens`` the lowest-priority
+memory fields are dropped first, then the longest remaining value is
+shortened.
+"""
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+def approx_tokenize(text):
+    """Stand-in for the model tokenizer used when none is available.
+
+    Splits into word/punctuation pieces and counts one token per 4 chars
+    of each word, which slightly overestimates llama-style SentencePiece
+    vocabularies. Only the length of the result matters for budgeting.
+    """
+    pieces = []
+    for piece in _PIECE_RE.findall(text):
+        pieces.extend([piece] * max(1, -(-len(piece) // 4)))
+    return pieces
+
+@dataclass
+class CompiledPrompt:
+    system: str
+    turn: str
+    n_tokens: int
+    dropped: list = field(default_factory=list)
+    history: str = ""
+
+    def as_single_message(self, user_label="User says", reply_cue="You respond warmly and lovingly:"):
+        """Flatten into one prompt string for servers without sessions"""
+        history = f"\n\nRecent conversation:\n{self.history}" if self.history else ""
+        return f"{self.system}{history}\n\n{user_label}: {self.turn}\n{reply_cue}"
+
+class PromptTemplate:
+    """Compiled persona + memory prompt with a fixed token budget"""
+
+    def __init__(self, persona, labels, priorities=None, volatile_keys=(), hidden_keys=(),
+                 facts_header="Here is what you know about your beloved user:",
+                 summary_header="Earlier in your conversations:",
+                 n_ctx=2048, max_tokens=256, reserve=48, tokenizer=approx_tokenize,
+                 default_priority=5):
+        self.persona = persona.strip()
+        self.labels = labels
+        self.priorities = priorities or {}
+        self.volatile_keys = tuple(volatile_keys)
+        self.skipped_keys = self.volatile_keys + tuple(hidden_keys)
+        self.facts_header = facts_header
+        self.summary_header = summary_header
+        self.default_priority = default_priority
+        self.tokenize = tokenizer
+        self.count = lru_cache(maxsize=4096)(lambda text: len(tokenizer(text)))
+
+        # Static parts are tokenized exactly once
+        self.persona_ids = tuple(tokenizer(self.persona))
+        self.header_tokens = self.count(facts_header) + 2
+        self.budget = n_ctx - max_tokens - reserve - len(self.persona_ids) - self.header_tokens
+        if self.budget <= 0:
+            raise ValueError("Persona alone does not fit in the context window")
+
+        # Stable, deterministic field order: known labels first
+        self._order = {key: i for i, key in enumerate(labels)}
+        # Rendered fact lines and their token costs, keyed by the facts themselves
+        self._facts_cache = OrderedDict()
+        self.facts_cache_size = 1024
+
+    def label(self, key):
+        return self.labels.get(key, key.replace("_", " ").title())
+
+    def facts(self, memory):
+        """Long-lived memory fields as ((key, value as text), ...), stable order"""
+        keys = sorted(
+            (k for k, v in memory.items() if v and k not in self.skipped_keys),
+            key=lambda k: (self._order.get(k, len(self._order)), k),
+        )
+        return tuple((k, str(memory[k])) for k in keys)
+
+    def fact_lines(self, facts):
+        """Render the output of facts() as (priority, key, line)"""
+        return [(self.priorities.get(k, self.default_priority), k, f"{self.label(k)}: {v}") for k, v in facts]
+
+    def status_line(self, memory, **extra):
+        parts = [f"{name}: {value}" for name, value in extra.items() if value]
+        parts += [f"{self.label(k)}: {memory[k]}" for k in self.volatile_keys if memory.get(k)]
+        return "; ".join(parts)
+
+    def rendered_facts(self, memory):
+        """Fact lines with their token costs, memoized on the fact values.
+
+        Saving history, mood or any other skipped field leaves the key
+        unchanged, so a hot user is rendered and counted only once per
+        set of facts.
+        """
+        facts = self.facts(memory)
+        cached = self._facts_cache.get(facts)
+        if cached is not None:
+            self._facts_cache.move_to_end(facts)
+            return cached
+        lines = self.fact_lines(facts)
+        costs = {key: self.count(line) + 1 for _, key, line in lines}
+        rendered = (lines, costs, sum(costs.values()))
+        self._facts_cache[facts] = rendered
+        while len(self._facts_cache) > self.facts_cache_size:
+            self._facts_cache.popitem(last=False)
+        return rendered
+
+    def compile(self, memory, user_input, summary="", history="", **status):
+        """Assemble the prompt for one message within the token budget.
+
+        `status` keyword arguments (e.g. current time) go into the volatile
+        status line next to the volatile memory fields. `summary` and
+        `history` come from history.py, which keeps them within their own
+        budgets; the facts get what is left.
+        """
+        status_text = self.status_line(memory, **status)
+        turn = f"({status_text})\n{user_input}" if status_text else user_input
+        summary_text = f"\n\n{self.summary_header}\n{summary}" if summary else ""
+        history_tokens = self.count(history) + 4 if history else 0
+        budget = self.budget - self.count(turn) - self.count(summary_text) - history_tokens
+        if budget < 0 and history:
+            # Recent turns go first, then the summary
+            budget += history_tokens
+            history, history_tokens = "", 0
+        if budget < 0 and summary_text:
+            budget += self.count(summary_text)
+            summary_text = ""
+        if budget < 0:
+            # The message itself is too long: keep its beginning
+            turn = self._truncate(turn, self.count(turn) + budget)
+            budget = 0
+
+        lines, costs, used = self.rendered_facts(memory)
+        dropped = []
+        # Drop lowest-priority fields (highest number), later fields first
+        for priority, key, _line in sorted(lines, key=lambda x: (-x[0], -self._order.get(x[1], 1 << 30))):
+            if used <= budget or len(lines) - len(dropped) <= 1:
+                break
+            dropped.append(key)
+            used -= costs[key]
+        kept = [(p, k, line) for p, k, line in lines if k not in dropped]
+
+        if used > budget and kept:
+            # One oversized field left (e.g. a long "about me"): shorten it
+            p, k, line = max(kept, key=lambda x: costs[x[1]])
+            shortened = self._truncate(line, costs[k] - 1 - (used - budget))
+            kept = [(p, k, shortened if key == k else l) for p, key, l in kept]
+            used = used - costs[k] + self.count(shortened) + 1
+
+        facts = "\n".join(line for _, _, line in kept) or "Nothing yet."
+        system = f"{self.persona}\n\n{self.facts_header}\n{facts}{summary_text}"
+        n_tokens = (len(self.persona_ids) + self.header_tokens + used + self.count(summary_text)
+                    + history_tokens + self.count(turn))
+        return CompiledPrompt(system, turn, n_tokens, dropped, history)
+
+    def _truncate(self, text, max_tokens):
+        """Cut `text` to roughly `max_tokens` tokens on a word boundary"""
+        if max_tokens <= 0:
+            return ""
+        words = text.split(" ")
+        lo, hi = 0, len(words)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.count(" ".join(words[:mid]) + "...") <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        return " ".join(words[:lo]) + "..."
@@ -0,0 +1,201 @@
+# tracing.py
+"""Per-update latency tracing.
+
+A trace covers one Telegram update; spans time the stages inside it
+(loading memory, intent matching, the model call, sending the reply...).
+The active trace lives in a context variable, so it follows the update's
+coroutine through awaits without being passed around:
+
+    with tracer.trace("handle_message", user_id=user.id):
+        with span("load_memory"):
+            memory = load_memory(user.id)
+
+Only a sampled share of updates is traced. Outside a sampled trace
+``span()`` returns a shared no-op context manager, so instrumentation
+costs one context variable lookup when tracing is off.
+
+Finished traces go to an exporter: ``RingBufferExporter`` keeps the last
+few in memory (shown by the /traces admin command), ``JsonlExporter``
+appends one JSON object per trace to a file.
+"""
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+_current = contextvars.ContextVar("trace", default=None)
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP = _NoopSpan()
+
+class Span:
+    __slots__ = ("trace", "name", "attrs", "start", "duration")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.spans.append(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "offset_ms": round((self.start - self.trace.start) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            **({"attrs": self.attrs} if self.attrs else {}),
+        }
+
+class Trace:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.id = os.urandom(8).hex()
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.timestamp = None
+        self.start = None
+        self.duration = None
+        self._token = None
+
+    def __enter__(self):
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.export(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "timestamp": round(self.timestamp, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attrs": self.attrs,
+            "spans": [s.to_dict() for s in sorted(self.spans, key=lambda s: s.start)],
+        }
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, exporter=None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 and self.exporter is not None
+
+    def trace(self, name, **attrs):
+        """Start a trace for one update, or a no-op if it is not sampled"""
+        if not self.enabled or _current.get() is not None:
+            return _NOOP
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return _NOOP
+        return Trace(self, name, attrs)
+
+    def export(self, trace):
+        try:
+            self.exporter.export(trace.to_dict())
+        except Exception as e:
+            print(f"[Trace Export Error] {e}")
+
+def span(name, **attrs):
+    """Time a stage of the current trace"""
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return Span(trace, name, attrs)
+
+def annotate(**attrs):
+    """Attach attributes to the current trace"""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+def detach():
+    """Stop tracing in the current task (for background work started mid-trace)"""
+    _current.set(None)
+
+def current_trace_id():
+    trace = _current.get()
+    return trace.id if trace is not None else None
+
+# ====== Exporters =======
+class RingBufferExporter:
+    """Keeps the last `capacity` traces in memory"""
+
+    def __init__(self, capacity=200):
+        self.traces = deque(maxlen=capacity)
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+    def recent(self, limit=10):
+        return list(self.traces)[-limit:]
+
+class JsonlExporter(RingBufferExporter):
+    """Appends every trace to a JSON-lines file, keeping recent ones in memory too"""
+
+    def __init__(self, path, capacity=200):
+        super().__init__(capacity)
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, trace):
+        super().export(trace)
+        line = json.dumps(trace, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+def create_exporter(kind, path=None, capacity=200):
+    if kind == "memory":
+        return RingBufferExporter(capacity)
+    if kind == "jsonl":
+        return JsonlExporter(path or "traces.jsonl", capacity)
+    raise ValueError(f"Unknown trace exporter: {kind!r} (use 'memory' or 'jsonl')")
+
+def format_trace(trace):
+    """One trace as a few readable lines, slowest stage first"""
+    spans = sorted(trace["spans"], key=lambda s: -s["duration_ms"])
+    lines = [f"{trace['trace_id']} {trace['name']} {trace['duration_ms']:.0f} ms"]
+    for s in spans:
+        lines.append(f"  {s['name']}: {s['duration_ms']:.1f} ms (at +{s['offset_ms']:.0f})")
+    return "\n".join(lines)
@@ -3,21 +3,71 @@ import json
 import re
 import random
 import asyncio
+from collections import OrderedDict
 from datetime import datetime
+import httpx
 import pytz
-import requests
 from dotenv import load_dotenv
+from prompt_compiler import PromptTemplate
+from memory_store import CachedMemoryStore, create_store
+from intents import router, CANNED_INTENTS
+from response_cache import ResponseCache
+from emotions import engine as emotion_engine
+from mood import MoodLog
+from history import ConversationHistory, summary_prompt
+import tracing
+from tracing import Tracer, create_exporter, span
+from voice import VoiceSynthesizer
 
 load_dotenv()
 
 # ====== Config ======
 class Config:
     API_URL = os.getenv("API_URL", "http://localhost:5000/chat")
+    API_STREAM_URL = os.getenv("API_STREAM_URL", API_URL.rstrip("/") + "/stream")
     API_KEY = os.getenv("API_KEY", "default-secret-key")
+    API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "10"))
+    API_TIMEOUT = float(os.getenv("API_TIMEOUT", "30"))
+    API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+    # Let the API keep each chat as a session so only the new turn is sent
+    API_SESSIONS = os.getenv("API_SESSIONS", "true").lower() in ("1", "true", "yes")
 
     MODEL_PATH = os.getenv("LLAMA_MODEL_PATH")
     CONTEXT_SIZE = int(os.getenv("LLAMA_CONTEXT_SIZE", "2048"))
+    MAX_TOKENS = int(os.getenv("LLAMA_MAX_TOKENS", "256"))  # Reply budget reserved in the context
     TYPING_DELAY = float(os.getenv("TYPING_DELAY", "1.2"))
+    STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+    # Messages a user sends within COALESCE_WINDOW_MS of each other, or while
+    # the reply to the previous ones is still being prepared, are answered
+    # together (see coalescer.py); 0 answers every message on its own
+    COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "800"))
+    COALESCE_MAX_WAIT_MS = int(os.getenv("COALESCE_MAX_WAIT_MS", "3000"))
+    COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "6"))
+
+    # Updates arrive by long polling unless BOT_MODE=webhook (see webhook.py).
+    # WEBHOOK_URL is the public https base URL that Telegram is told about;
+    # leave it empty to only listen, e.g. to replay recorded updates locally
+    BOT_MODE = os.getenv("BOT_MODE", "polling")
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+    WEBHOOK_RECORD_FILE = os.getenv("WEBHOOK_RECORD_FILE") or None  # Append received updates (JSON lines)
+
+    # Voice notes after text replies (see voice.py): pyttsx3 in VOICE_WORKERS
+    # processes, cached in VOICE_CACHE_DIR up to VOICE_CACHE_MB. The voice
+    # defaults match the Viktor1 CLI
+    VOICE_REPLIES = os.getenv("VOICE_REPLIES", "false").lower() in ("1", "true", "yes")
+    VOICE_NAME = os.getenv("VOICE_NAME", "David")
+    VOICE_RATE = int(os.getenv("VOICE_RATE", "150"))
+    VOICE_VOLUME = float(os.getenv("VOICE_VOLUME", "1.0"))
+    VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "1"))
+    VOICE_CACHE_DIR = os.getenv("VOICE_CACHE_DIR", "voice_cache")
+    VOICE_CACHE_MB = int(os.getenv("VOICE_CACHE_MB", "200"))
+    VOICE_PRERENDER = os.getenv("VOICE_PRERENDER", "true").lower() in ("1", "true", "yes")
 
     BOT_NAME = os.getenv("BOT_NAME", "Viktor")
     BOT_NICKNAME = os.getenv("BOT_NICKNAME", "Viki")
@@ -25,75 +75,130 @@ class Config:
     BOT_LANGUAGE = os.getenv("BOT_LANGUAGE", "en")
 
     MEMORY_DIR = "memory"
+    MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "json")  # "json" or "sqlite"
+    MEMORY_DB = os.getenv("MEMORY_DB", os.path.join(MEMORY_DIR, "memory.db"))
+    MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "10000"))  # 0 disables write-behind caching
+    MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "5"))
     MAX_MESSAGE_LENGTH = 4000
+    MOOD_LOG_CAPACITY = int(os.getenv("MOOD_LOG_CAPACITY", "50"))
+    MOOD_HALF_LIFE_HOURS = float(os.getenv("MOOD_HALF_LIFE_HOURS", "6"))
+
+    # Conversation history: the last HISTORY_TURNS exchanges verbatim (within
+    # HISTORY_TOKENS), older ones folded into a summary of SUMMARY_TOKENS
+    # once SUMMARY_BATCH messages are waiting
+    HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "6"))
+    HISTORY_TOKENS = int(os.getenv("HISTORY_TOKENS", "384"))
+    SUMMARY_TOKENS = int(os.getenv("SUMMARY_TOKENS", "128"))
+    SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "4"))
+
+    # Replies to short repeated messages ("good night") are reused for the
+    # same remembered facts and mood; 0 disables the cache
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+    RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "900"))
+    RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+    RESPONSE_CACHE_MAX_WORDS = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "8"))
+
+    # Latency tracing of a share of updates (0 disables it); exporter is
+    # "memory" (last TRACE_BUFFER traces, see /traces) or "jsonl" (TRACE_FILE)
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+    TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "memory")
+    TRACE_FILE = os.getenv("TRACE_FILE", os.path.join("traces", "traces.jsonl"))
+    TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", "200"))
+    ADMIN_USER_IDS = {int(i) for i in os.getenv("ADMIN_USER_IDS", "").replace(",", " ").split()}
 
     # Conversation states (from main.py)
     GET_NAME, GET_AGE, GET_LOCATION = range(3)
 
 # ======= Memory Utils =======
+memory_store = None
+
 def ensure_memory_dir():
-    os.makedirs(Config.MEMORY_DIR, exist_ok=True)
+    """Create the memory directory and the store; called once at startup"""
+    global memory_store
+    if memory_store is None:
+        os.makedirs(Config.MEMORY_DIR, exist_ok=True)
+        memory_store = create_store(Config.MEMORY_BACKEND, Config.MEMORY_DIR, Config.MEMORY_DB)
+        if Config.MEMORY_CACHE_SIZE > 0:
+            # Saves only mark the user dirty; flush_memory() writes them out
+            memory_store = CachedMemoryStore(memory_store, Config.MEMORY_CACHE_SIZE)
+    return memory_store
 
-def get_memory_path(user_id):
-    return os.path.join(Config.MEMORY_DIR, f"{user_id}.json")
+def get_store():
+    """The memory store (created on first use if startup has not done it)"""
+    return memory_store if memory_store is not None else ensure_memory_dir()
 
-def load_memory(user_id):
-    memory_file = get_memory_path(user_id)
-    default_memory = {
+def flush_memory():
+    """Write pending memory changes to disk (blocking, run it in a thread)"""
+    store = get_store()
+    if not isinstance(store, CachedMemoryStore):
+        return
+    try:
+        store.flush()
+    except Exception as e:
+        print(f"[Memory Flush Error] {e}")
+
+async def flush_memory_periodically():
+    while True:
+        await asyncio.sleep(Config.MEMORY_FLUSH_INTERVAL)
+        await asyncio.to_thread(flush_memory)
+
+def default_memory():
+    return {
         "name": None,
         "relationship_status": f"in a loving relationship with {Config.BOT_NICKNAME}",
         "created_at": datetime.now().isoformat(),
     }
+
+def load_memory(user_id):
+    defaults = default_memory()
     try:
-        if not os.path.exists(memory_file):
-            return default_memory
-        with open(memory_file, "r", encoding="utf-8") as f:
-            memory = json.load(f)
-            return {**default_memory, **memory}
+        memory = get_store().get(user_id)
+        return {**defaults, **memory} if memory else defaults
     except Exception as e:
         print(f"[Memory Load Error] {e}")
-        return default_memory
+        return defaults
 
 def save_memory(user_id, memory):
+    MemoryManager.forget_mood_log(user_id)
     try:
-        ensure_memory_dir()
-        with open(get_memory_path(user_id), "w", encoding="utf-8") as f:
-            json.dump(memory, f, ensure_ascii=False, indent=2)
+        get_store().put(user_id, memory)
         return True
     except Exception as e:
         print(f"[Memory Save Error] {e}")
         return False
 
+def delete_memory(user_id):
+    """Forget a user; returns True if anything was stored"""
+    MemoryManager.forget_mood_log(user_id)
+    try:
+        return get_store().delete(user_id)
+    except Exception as e:
+        print(f"[Memory Delete Error] {e}")
+        return False
+
 # ====== Personality & Helper =======
 class Personality:
     @staticmethod
     def detect_emotion(text: str) -> str | None:
-        text = text.lower()
-        patterns = {
-            "sad": r"\b(sad|depressed|lonely|cry|miss you)\b",
-            "happy": r"\b(happy|joy|excited|great|amazing|love)\b",
-            "love": r"\b(love|adore|cherish|miss you|want you)\b",
-            "angry": r"\b(angry|mad|furious|hate|annoyed)\b",
-            "flirty": r"\b(sexy|hot|handsome|beautiful|babe|cutie)\b",
-        }
-        for emotion, pattern in patterns.items():
-            if re.search(pattern, text):
-                return emotion
-        return None
+        """Strongest emotion in `text` (see emotions.py), or None"""
+        return emotion_engine.detect(text)
+
+    PET_NAMES = (
+        "my love", "sweetheart", "darling",
+        "baby", "honey", "angel", "beloved", Config.BOT_NICKNAME
+    )
 
     @staticmethod
     def get_pet_name():
-        pet_names = [
-            "my love", "sweetheart", "darling",
-            "baby", "honey", "angel", "beloved", Config.BOT_NICKNAME
-        ]
-        return random.choice(pet_names)
+        return random.choice(Personality.PET_NAMES)
 
 # ====== Build Memory Context for Prompt =======
 class MemoryManager:
     @staticmethod
-    def update_memory(user_id, user_input):
-        memory = load_memory(user_id)
+    def update_memory(user_id, user_input, memory=None):
+        """Learn facts and mood from `user_input`; pass `memory` if already loaded"""
+        if memory is None:
+            memory = load_memory(user_id)
         updated = False
 
         # Patterns to extract info from user input
@@ -118,96 +223,500 @@ class MemoryManager:
                 updated = True
 
         # Detect emotion and save
-        emotion = Personality.detect_emotion(user_input)
+        scores = emotion_engine.scores(user_input)
+        emotion = emotion_engine.label(scores)
+        log = None
         if emotion:
             memory["last_emotion"] = emotion
-            trend = memory.get("emotion_trend", "")
-            trend_list = trend.split(", ") if trend else []
-            trend_list.append(emotion)
-            memory["emotion_trend"] = ", ".join(trend_list[-5:])  # last 5 emotions
+            log = MemoryManager.mood_log(user_id, memory)
+            log.record(emotion, float(scores.max()))
+            memory["mood_log"] = log.to_dict()
+            updated = True
+        if "emotion_trend" in memory:
+            # Replaced by the bounded mood log
+            del memory["emotion_trend"]
             updated = True
 
         if updated:
             save_memory(user_id, memory)
+        if log is not None:
+            # Saving dropped the parsed log; it matches the new dict already
+            MemoryManager._remember_mood_log(user_id, memory["mood_log"], log)
         return memory
 
+    LABELS = {
+        "name": "Name",
+        "age": "Age",
+        "location": "Location",
+        "favorite_color": "Favorite Color",
+        "favorite_food": "Favorite Food",
+        "favorite_song": "Favorite Song",
+        "loves": "Loves",
+        "hates": "Dislikes",
+        "last_emotion": "Current Mood",
+        "emotion_trend": "Recent Mood Trend",
+        "relationship_status": "Relationship Status",
+    }
+
+    # Lower number = kept longer when the prompt has to be trimmed
+    PRIORITIES = {
+        "name": 0,
+        "relationship_status": 1,
+        "age": 2,
+        "location": 2,
+        "loves": 3,
+        "hates": 3,
+        "favorite_color": 4,
+        "favorite_food": 4,
+        "favorite_song": 4,
+        "about_me": 6,
+        "created_at": 9,
+    }
+
+    # Fields that change from message to message stay out of the system prompt
+    VOLATILE = ("last_emotion", "emotion_trend")
+    # Internal fields that are never rendered as they are
+    HIDDEN = ("mood_log", "history")
+
+    # Parsed mood logs per user, so a log is rebuilt once per change rather
+    # than on every read. An entry is only used for the very dict it was
+    # parsed from, and save_memory()/delete_memory() drop it
+    _mood_logs = OrderedDict()  # user_id -> (stored mood_log dict, MoodLog)
+    MOOD_LOGS_CACHED = 1024
+
+    @staticmethod
+    def mood_log(user_id, memory):
+        """The user's MoodLog; the caller may change it only if it saves the memory"""
+        key = str(user_id)
+        data = memory.get("mood_log")
+        cached = MemoryManager._mood_logs.get(key)
+        if cached is not None and cached[0] is data:
+            MemoryManager._mood_logs.move_to_end(key)
+            return cached[1]
+        log = MoodLog.from_dict(
+            data,
+            capacity=Config.MOOD_LOG_CAPACITY,
+            half_life=Config.MOOD_HALF_LIFE_HOURS * 3600,
+        )
+        if data:
+            MemoryManager._remember_mood_log(user_id, data, log)
+        return log
+
+    @staticmethod
+    def _remember_mood_log(user_id, data, log):
+        MemoryManager._mood_logs[str(user_id)] = (data, log)
+        MemoryManager._mood_logs.move_to_end(str(user_id))
+        if len(MemoryManager._mood_logs) > MemoryManager.MOOD_LOGS_CACHED:
+            MemoryManager._mood_logs.popitem(last=False)
+
+    @staticmethod
+    def forget_mood_log(user_id):
+        MemoryManager._mood_logs.pop(str(user_id), None)
+
     @staticmethod
-    def build_memory_context(memory):
+    def mood_summary(user_id, memory):
+        return MemoryManager.mood_log(user_id, memory).summary() if memory.get("mood_log") else ""
+
+    @staticmethod
+    def build_memory_context(memory, user_id):
         if not memory:
             return "No personal info stored yet."
-        labels = {
-            "name": "Name",
-            "age": "Age",
-            "location": "Location",
-            "favorite_color": "Favorite Color",
-            "favorite_food": "Favorite Food",
-            "favorite_song": "Favorite Song",
-            "loves": "Loves",
-            "hates": "Dislikes",
-            "last_emotion": "Current Mood",
-            "emotion_trend": "Recent Mood Trend",
-            "relationship_status": "Relationship Status",
-        }
         lines = []
         for k, v in memory.items():
-            if v:
-                label = labels.get(k, k.replace("_", " ").title())
+            if v and k not in MemoryManager.HIDDEN:
+                label = MemoryManager.LABELS.get(k, k.replace("_", " ").title())
                 lines.append(f"{label}: {v}")
+        mood = MemoryManager.mood_summary(user_id, memory)
+        if mood:
+            lines.append(f"{MemoryManager.LABELS['emotion_trend']}: {mood}")
         return "\n".join(lines)
 
-# ====== AI Interaction =======
-class AICommunicator:
-    @staticmethod
-    async def get_ai_response(user_id, user_input):
-        memory = MemoryManager.update_memory(user_id, user_input)
-        context = MemoryManager.build_memory_context(memory)
-        now_tehran = datetime.now(pytz.timezone("Asia/Tehran")).strftime("%A, %d %B %Y - %H:%M")
+# ====== Model API Client =======
+class LLMClient:
+    """Keep-alive async HTTP client shared by every chat.
 
-        # Controlled special replies (avoid stupid AI answers)
-        lower_input = user_input.lower()
-        if any(x in lower_input for x in ["what's your name", "who are you", "your name"]):
-            return f"My name is {Config.BOT_NAME}, but only you can call me {Config.BOT_NICKNAME}, my love. 💖"
+    The connection pool lives for the whole Application lifetime so a slow
+    generation for one user never blocks the event loop for the others.
+    """
+
+    def __init__(self, pool_size=None, timeout=None, connect_timeout=None):
+        self.pool_size = pool_size or Config.API_POOL_SIZE
+        self.timeout = timeout or Config.API_TIMEOUT
+        self.connect_timeout = connect_timeout or Config.API_CONNECT_TIMEOUT
+        self._client: httpx.AsyncClient | None = None
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            headers={"X-API-KEY": Config.API_KEY},
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _request_options(self, timeout):
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=self.connect_timeout)
+        trace_id = tracing.current_trace_id()
+        if trace_id:
+            # Lets the server log lines be matched with the bot's trace
+            kwargs["headers"] = {"X-Trace-Id": trace_id}
+        return kwargs
+
+    async def post_json(self, url, payload, timeout=None):
+        """POST `payload` and return the decoded JSON body."""
+        if self._client is None:
+            await self.start()
+        resp = await self._client.post(url, json=payload, **self._request_options(timeout))
+        resp.raise_for_status()
+        return resp.json()
+
+    async def delete(self, url):
+        if self._client is None:
+            await self.start()
+        resp = await self._client.delete(url)
+        resp.raise_for_status()
+
+    async def stream_events(self, url, payload, timeout=None):
+        """POST `payload` and yield (event, data) pairs from an SSE response."""
+        if self._client is None:
+            await self.start()
+        async with self._client.stream("POST", url, json=payload, **self._request_options(timeout)) as resp:
+            resp.raise_for_status()
+            event = "message"
+            async for line in resp.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[len("data:"):].strip())
+                elif not line:
+                    event = "message"
+
+llm_client = LLMClient()
+
+tracer = Tracer(
+    sample_rate=Config.TRACE_SAMPLE_RATE,
+    exporter=create_exporter(Config.TRACE_EXPORTER, Config.TRACE_FILE, Config.TRACE_BUFFER)
+    if Config.TRACE_SAMPLE_RATE > 0 else None,
+)
+
+voice_synth = VoiceSynthesizer(
+    Config.VOICE_CACHE_DIR,
+    Config.VOICE_CACHE_MB * 2**20,
+    name=Config.VOICE_NAME,
+    rate=Config.VOICE_RATE,
+    volume=Config.VOICE_VOLUME,
+    workers=Config.VOICE_WORKERS,
+) if Config.VOICE_REPLIES else None
 
-        if any(x in lower_input for x in ["how are you", "how do you feel"]):
-            return f"I'm feeling amazing, especially when I chat with you, {memory.get('name', 'my love')}! 🥰"
+_background_tasks = []
 
-        # Compose prompt for AI
-        prompt = f"""You are {Config.BOT_NAME}, an affectionate, playful, and romantic AI {Config.BOT_ROLE} designed to be a loving companion.
+async def on_startup(application):
+    """Application post_init hook: open the shared connection pool."""
+    await llm_client.start()
+    ensure_memory_dir()
+    _background_tasks.append(asyncio.create_task(flush_memory_periodically()))
+    if voice_synth is not None and Config.VOICE_PRERENDER:
+        _background_tasks.append(asyncio.create_task(voice_synth.prerender(AICommunicator.canned_texts())))
+
+async def on_shutdown(application):
+    """Application post_shutdown hook: close pooled connections."""
+    for task in [*_background_tasks, *HistoryManager.tasks]:
+        task.cancel()
+    _background_tasks.clear()
+    await asyncio.to_thread(flush_memory)
+    await llm_client.close()
+    if voice_synth is not None:
+        voice_synth.close()
+        print(f"[Voice] {voice_synth.stats()}")
+    if response_cache.enabled:
+        print(f"[Response Cache] {response_cache.stats()}")
+
+# ====== AI Interaction =======
+PROMPT = PromptTemplate(
+    persona=f"""You are {Config.BOT_NAME}, an affectionate, playful, and romantic AI {Config.BOT_ROLE} designed to be a loving companion.
 You speak only English.
 You care deeply about your user and want to brighten their day.
 You use sweet pet names and sometimes flirt in a tasteful and respectful way.
 Keep responses short, warm, and loving.
-Do not generate sexual or inappropriate content.
+Do not generate sexual or inappropriate content.""",
+    labels=MemoryManager.LABELS,
+    priorities=MemoryManager.PRIORITIES,
+    volatile_keys=MemoryManager.VOLATILE,
+    hidden_keys=MemoryManager.HIDDEN,
+    n_ctx=Config.CONTEXT_SIZE,
+    max_tokens=Config.MAX_TOKENS,
+)
 
-Current Date and Time (Tehran): {now_tehran}
+response_cache = ResponseCache(
+    capacity=Config.RESPONSE_CACHE_SIZE,
+    ttl=Config.RESPONSE_CACHE_TTL,
+    variants=Config.RESPONSE_CACHE_VARIANTS,
+    max_words=Config.RESPONSE_CACHE_MAX_WORDS,
+)
 
-Here is what you know about your beloved user:
-{context}
+class HistoryManager:
+    """Keeps each user's recent turns and folds older ones into a summary"""
+    tasks = set()
+    _summarizing = set()
 
-User says: {user_input}
-You respond warmly and lovingly:"""
+    @staticmethod
+    def load(memory):
+        return ConversationHistory(
+            memory.get("history"),
+            keep_turns=Config.HISTORY_TURNS,
+            max_tokens=Config.HISTORY_TOKENS,
+            summary_tokens=Config.SUMMARY_TOKENS,
+            count=PROMPT.count,
+        )
 
+    @staticmethod
+    def record(user_id, user_input, reply):
+        """Store one exchange; summarizing runs in the background"""
+        with span("record_history"):
+            HistoryManager._record(user_id, user_input, reply)
+
+    @staticmethod
+    def _record(user_id, user_input, reply):
+        memory = load_memory(user_id)
+        history = HistoryManager.load(memory)
+        history.add_exchange(user_input, reply)
+        memory["history"] = history.to_dict()
+        save_memory(user_id, memory)
+
+        if len(history.pending) >= Config.SUMMARY_BATCH and user_id not in HistoryManager._summarizing:
+            HistoryManager._summarizing.add(user_id)
+            task = asyncio.create_task(HistoryManager.summarize(user_id))
+            HistoryManager.tasks.add(task)
+            task.add_done_callback(HistoryManager.tasks.discard)
+
+    @staticmethod
+    async def summarize(user_id):
+        tracing.detach()  # runs after the reply, outside the update's trace
         try:
-            # Call model API
-            resp = requests.post(
-                Config.API_URL,
-                json={"message": prompt, "model_path": Config.MODEL_PATH, "context_size": Config.CONTEXT_SIZE},
-                headers={"X-API-KEY": Config.API_KEY},
-                timeout=30,
-            )
-            resp.raise_for_status()
-            result = resp.json()
+            history = HistoryManager.load(load_memory(user_id))
+            pending = list(history.pending)
+            if not pending:
+                return
+            upto = history.offset + len(pending)
+            payload = {
+                "model_path": Config.MODEL_PATH,
+                "context_size": Config.CONTEXT_SIZE,
+                "message": summary_prompt(history.summary, pending, Config.SUMMARY_TOKENS * 2 // 3),
+                # The server queues it behind chat replies
+                "priority": "background",
+            }
+            result = await llm_client.post_json(Config.API_URL, payload)
+            summary = (result.get("response") or "").strip()
+            if not summary:
+                return
+
+            # Reload: more turns may have arrived, or the user reset meanwhile
+            memory = load_memory(user_id)
+            if "history" not in memory:
+                return
+            history = HistoryManager.load(memory)
+            history.apply_summary(summary, upto)
+            memory["history"] = history.to_dict()
+            save_memory(user_id, memory)
+        except httpx.HTTPError as e:
+            print(f"[History Summary Error] {e}")
+        except Exception as e:
+            print(f"[Unexpected Error] {e}")
+        finally:
+            HistoryManager._summarizing.discard(user_id)
+
+def server_timings(result):
+    """Server-side timings of a reply, attached to the HTTP span"""
+    keys = ("queue_wait", "time_to_first_token", "prompt_eval_time", "generation_time", "tokens_used", "cached")
+    return {key: result[key] for key in keys if key in result}
+
+EMPTY_REPLY = "I'm feeling too emotional to respond right now, my love. Please try again soon. 💔"
+API_ERROR_REPLY = "Oops, my heart is having a little trouble right now. Could you say that again, please? 🥺"
+UNEXPECTED_ERROR_REPLY = "Something unexpected happened inside me. Please wait a moment, darling."
+
+class AICommunicator:
+    @staticmethod
+    def canned_reply(intent, memory):
+        return intent.render(
+            name=memory.get("name") or Personality.get_pet_name(),
+            bot_name=Config.BOT_NAME,
+            nickname=Config.BOT_NICKNAME,
+        )
+
+    @staticmethod
+    def canned_texts():
+        """Every canned reply as sent to users without a saved name"""
+        fields = {"bot_name": Config.BOT_NAME, "nickname": Config.BOT_NICKNAME}
+        return [
+            reply.format(name=name, **fields)
+            for intent in CANNED_INTENTS
+            for reply in intent.replies
+            for name in Personality.PET_NAMES
+        ]
+
+    @staticmethod
+    def build_prompt(user_id, user_input, memory):
+        # Compose prompt for AI: stable persona and facts first, time and mood last
+        now_tehran = datetime.now(pytz.timezone("Asia/Tehran")).strftime("%A, %d %B %Y - %H:%M")
+        history = HistoryManager.load(memory)
+        prompt = PROMPT.compile(
+            memory, user_input,
+            summary=history.summary,
+            # With sessions the server replays the recent turns (see prepare)
+            history="" if Config.API_SESSIONS else history.render(),
+            **{
+                "Current Date and Time (Tehran)": now_tehran,
+                MemoryManager.LABELS["emotion_trend"]: MemoryManager.mood_summary(user_id, memory),
+            },
+        )
+        if prompt.dropped:
+            print(f"[Prompt Budget] dropped {', '.join(prompt.dropped)} for user {user_id}")
+        return prompt
+
+    @staticmethod
+    def prepare(user_id, user_input, memory=None, allow_canned=True, learn=True):
+        """Update memory and build the request.
+
+        Returns (canned_reply, payload); exactly one of them is set.
+        allow_canned=False always asks the model: for callers that have
+        routed the message already, or merged messages. learn=False skips
+        the memory update, for callers that applied it already.
+        """
+        if learn:
+            with span("update_memory"):
+                memory = MemoryManager.update_memory(user_id, user_input, memory)
+        elif memory is None:
+            memory = load_memory(user_id)
+
+        # Controlled special replies (avoid stupid AI answers)
+        if allow_canned:
+            with span("intent_match"):
+                intent = router.match(user_input)
+            if intent:
+                return AICommunicator.canned_reply(intent, memory), None
+
+        with span("compile_prompt"):
+            prompt = AICommunicator.build_prompt(user_id, user_input, memory)
+
+        payload = {"model_path": Config.MODEL_PATH, "context_size": Config.CONTEXT_SIZE, "user": str(user_id)}
+        # The facts kept in the prompt and the current mood fingerprint the memory
+        cache_key = response_cache.key_for(user_input, prompt.system, memory.get("last_emotion"))
+        if cache_key:
+            payload["cache_key"] = cache_key
+        if Config.API_SESSIONS:
+            # The server keeps earlier turns and their KV cache per session. Our
+            # own copy goes along and is used if the session was evicted or the
+            # server restarted, so the model never silently loses the thread
+            payload.update(session_id=str(user_id), system=prompt.system, message=prompt.turn,
+                           history=HistoryManager.load(memory).messages())
+        else:
+            payload["message"] = prompt.as_single_message()
+        return None, payload
+
+    @staticmethod
+    async def reset_session(user_id):
+        """Drop the server-side conversation session of a user"""
+        if not Config.API_SESSIONS:
+            return
+        try:
+            await llm_client.delete(f"{Config.API_URL.rstrip('/')}/session/{user_id}")
+        except httpx.HTTPError as e:
+            print(f"[API Session Reset Error] {e}")
+
+    @staticmethod
+    async def get_ai_response(user_id, user_input, timeout=None, memory=None, allow_canned=True, learn=True):
+        canned, payload = AICommunicator.prepare(user_id, user_input, memory, allow_canned, learn)
+        if canned:
+            return canned
+        with span("response_cache"):
+            cached = response_cache.get(payload.get("cache_key"))
+        if cached:
+            HistoryManager.record(user_id, user_input, cached)
+            return cached
+
+        try:
+            # Call model API. Through the stream endpoint, so that if this
+            # task is cancelled (a newer message superseded it) the closed
+            # connection makes the server cancel the job too, rather than
+            # finish it and add the turn to the session
+            with span("http") as http_span:
+                result = {}
+                async for event, data in llm_client.stream_events(Config.API_STREAM_URL, payload, timeout=timeout):
+                    if event == "error":
+                        print(f"[API Stream Error] {data.get('error')}")
+                        return API_ERROR_REPLY
+                    if event == "done":
+                        result = data
+                        break
+                http_span.set(**server_timings(result))
 
             ai_text = result.get("response")
             if not ai_text:
-                return "I'm feeling too emotional to respond right now, my love. Please try again soon. 💔"
+                return EMPTY_REPLY
 
             # Limit length
-            return ai_text[: Config.MAX_MESSAGE_LENGTH]
+            reply = ai_text[: Config.MAX_MESSAGE_LENGTH]
+            response_cache.put(payload.get("cache_key"), reply)
+            HistoryManager.record(user_id, user_input, reply)
+            return reply
+
+        except httpx.HTTPError as e:
+            print(f"[API Request Error] {e}")
+            return API_ERROR_REPLY
+        except Exception as e:
+            print(f"[Unexpected Error] {e}")
+            return UNEXPECTED_ERROR_REPLY
+
+    @staticmethod
+    async def stream_ai_response(user_id, user_input, timeout=None, memory=None, allow_canned=True, learn=True):
+        """Yield the reply accumulated so far each time new tokens arrive.
+
+        The last value yielded is the complete reply (or an error line).
+        """
+        canned, payload = AICommunicator.prepare(user_id, user_input, memory, allow_canned, learn)
+        if canned:
+            yield canned
+            return
+        with span("response_cache"):
+            cached = response_cache.get(payload.get("cache_key"))
+        if cached:
+            HistoryManager.record(user_id, user_input, cached)
+            yield cached
+            return
+
+        text = ""
+        try:
+            # The span includes the time the caller spends on each yielded update
+            with span("http_stream") as http_span:
+                async for event, data in llm_client.stream_events(Config.API_STREAM_URL, payload, timeout=timeout):
+                    if event == "error":
+                        print(f"[API Stream Error] {data.get('error')}")
+                        yield API_ERROR_REPLY if not text else text
+                        return
+                    if event == "done":
+                        http_span.set(**server_timings(data))
+                        break
+                    text = (text + data.get("token", ""))[: Config.MAX_MESSAGE_LENGTH]
+                    yield text
+            if not text.strip():
+                yield EMPTY_REPLY
+                return
+            response_cache.put(payload.get("cache_key"), text.strip())
+            HistoryManager.record(user_id, user_input, text.strip())
 
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"[API Request Error] {e}")
-            return "Oops, my heart is having a little trouble right now. Could you say that again, please? 🥺"
+            yield API_ERROR_REPLY if not text else text
         except Exception as e:
             print(f"[Unexpected Error] {e}")
-            return "Something unexpected happened inside me. Please wait a moment, darling."
+            yield UNEXPECTED_ERROR_REPLY if not text else text
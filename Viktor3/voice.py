@@ -0,0 +1,216 @@
+# voice.py
+"""Voice-note replies.
+
+Replies are synthesized with pyttsx3 in a process pool, so the event loop
+(and every text reply) keeps going while audio renders. With ffmpeg on
+the PATH the audio is encoded as OGG/Opus, which Telegram shows as a
+voice note; otherwise the WAV is sent as an audio file.
+
+Rendered files are cached on disk, named by a hash of the spoken text,
+the voice settings and the format, so the same line in the same voice is
+only rendered once. Past ``max_bytes`` the least recently used files are
+deleted. Canned replies can be rendered ahead of time with prerender().
+"""
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+_EMOJI_RE = re.compile(
+    "["
+    "\U0001F300-\U0001FAFF"  # pictographs, emoticons, transport, symbols
+    "\U00002600-\U000027BF"  # misc symbols and dingbats
+    "\U0001F1E6-\U0001F1FF"  # flags
+    "\uFE0F\u200D"         # variation selector, zero-width joiner
+    "]+"
+)
+_ACTION_RE = re.compile(r"\*[^*]+\*")  # "*virtual kiss activated*"
+
+def speakable(text):
+    """The text as it should be read out: no emoji, *actions* or runs of spaces"""
+    return " ".join(_ACTION_RE.sub(" ", _EMOJI_RE.sub(" ", text)).split())
+
+# ====== Pool Worker =======
+_engine = None
+
+def _synthesize(text, voice, path, encode):
+    """Render `text` to `path` (runs in a pool process); returns the file size"""
+    global _engine
+    if _engine is None:
+        import pyttsx3
+
+        _engine = pyttsx3.init()
+        voices = _engine.getProperty("voices")
+        match = next((v for v in voices if voice["name"].lower() in v.name.lower()), None)
+        if match is not None:
+            _engine.setProperty("voice", match.id)
+    _engine.setProperty("rate", voice["rate"])
+    _engine.setProperty("volume", voice["volume"])
+
+    wav = f"{path}.{os.getpid()}.wav"
+    try:
+        _engine.save_to_file(text, wav)
+        _engine.runAndWait()
+        if encode:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error", "-i", wav, "-c:a", "libopus", "-b:a", "32k", "-f", "ogg", tmp],
+                check=True,
+            )
+            os.replace(tmp, path)
+        else:
+            os.replace(wav, path)
+    finally:
+        if os.path.exists(wav):
+            os.remove(wav)
+    return os.path.getsize(path)
+
+def read_audio(path):
+    """The bytes of a rendered file (blocking; run it in a thread)"""
+    with open(path, "rb") as f:
+        return f.read()
+
+# ====== Disk Cache =======
+class VoiceCache:
+    """Audio files named by content hash, least recently used evicted past max_bytes.
+
+    Only touched from the event loop thread.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._files = OrderedDict()  # name -> size, least recently used first
+        # Telegram file_id of an uploaded file, sent instead of the bytes next time
+        self.remote_ids = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Recency survives restarts through the files' modification times
+        entries = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            if entry.name.count(".") != 1:
+                os.remove(entry.path)  # left over from an interrupted render
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.size += size
+        self._evict()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        if name not in self._files:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._files.move_to_end(name)
+        try:
+            os.utime(self.path(name))
+        except OSError:
+            pass
+        return self.path(name)
+
+    def add(self, name, size):
+        self.size += size - self._files.pop(name, 0)
+        self._files[name] = size
+        self._evict()
+
+    def _evict(self):
+        # The newest file always stays, even if it alone is over budget
+        while self.size > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self.size -= size
+            self.remote_ids.pop(name, None)
+            self.evictions += 1
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            "files": len(self._files),
+            "size_mb": round(self.size / 2**20, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# ====== Synthesizer =======
+class VoiceSynthesizer:
+    def __init__(self, cache_dir, max_bytes, name="David", rate=150, volume=1.0, workers=1):
+        self.voice = {"name": name, "rate": rate, "volume": volume}
+        self.format = "ogg" if shutil.which("ffmpeg") else "wav"
+        self.cache = VoiceCache(cache_dir, max_bytes)
+        self.workers = workers
+        self._pool = None  # started on first use
+        self._pending = {}  # name -> task rendering it
+
+    def key_for(self, text):
+        digest = hashlib.sha256(
+            json.dumps([text, self.voice, self.format], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return f"{digest}.{self.format}"
+
+    async def synthesize(self, text):
+        """Path of an audio file speaking `text`, or None if nothing in it can be spoken"""
+        text = speakable(text)
+        if not text:
+            return None
+        name = self.key_for(text)
+        path = self.cache.get(name)
+        if path is not None:
+            return path
+        # Concurrent requests for the same line share one rendering
+        task = self._pending.get(name)
+        if task is None:
+            task = self._pending[name] = asyncio.create_task(self._render(name, text))
+            task.add_done_callback(lambda _: self._pending.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def _render(self, name, text):
+        if self._pool is None:
+            # Spawned, not forked: a fork would copy the bot's event loop and
+            # HTTP connections into the worker
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        path = self.cache.path(name)
+        size = await asyncio.get_running_loop().run_in_executor(
+            self._pool, _synthesize, text, self.voice, path, self.format == "ogg"
+        )
+        self.cache.add(name, size)
+        return path
+
+    async def prerender(self, texts):
+        """Render lines ahead of time (e.g. canned replies), one after another"""
+        rendered = 0
+        for text in dict.fromkeys(texts):
+            try:
+                await self.synthesize(text)
+                rendered += 1
+            except Exception as e:
+                print(f"[Voice Prerender Error] {e}")
+                break
+        print(f"[Voice] {rendered} lines ready, cache: {self.cache.stats()}")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        return {"format": self.format, "rendering": len(self._pending), **self.cache.stats()}
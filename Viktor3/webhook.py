@@ -0,0 +1,235 @@
+# webhook.py
+"""Webhook mode for the Telegram bot.
+
+``WebhookServer`` is a small asyncio HTTP receiver: it checks Telegram's
+secret token header, decodes the update, puts it on the application's
+update queue and answers 200 right away, so a slow reply never holds up
+delivery of the next update. Run it behind a reverse proxy that
+terminates TLS (Telegram only calls https:// URLs on ports 443, 80, 88
+or 8443).
+
+Updates can be replayed locally without Telegram, e.g. ones saved with
+WEBHOOK_RECORD_FILE:
+
+    python webhook.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret "$WEBHOOK_SECRET"
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import signal
+import sys
+import time
+import urllib.error
+import urllib.request
+from dotenv import load_dotenv
+from telegram import Update
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+class WebhookServer:
+    def __init__(self, application, secret_token, host="127.0.0.1", port=8443, path="/telegram",
+                 max_body=1024 * 1024, record_file=None):
+        self.application = application
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_body = max_body
+        self.record_file = record_file
+        self._server = None
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # Port 0 picks a free port (handy for local tests)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"[Webhook] listening on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                status = await self._handle(method, path, headers, body) if body is not None else 413
+                if status == 413:
+                    keep_alive = False  # the unread body is still on the socket
+                self._respond(writer, status, keep_alive)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """(method, path, headers, body) or None at end of stream; body is None if too large"""
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > self.max_body:
+            return method, path, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?", 1)[0], headers, body
+
+    async def _handle(self, method, path, headers, body):
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.rejected += 1
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, dict) or "update_id" not in data:
+            return 400
+
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            print(f"[Webhook Error] {e}")
+            return 400
+        if self.record_file:
+            self._record(data)
+        self.received += 1
+        # Handlers run on the application's own tasks; answer right away
+        await self.application.update_queue.put(update)
+        return 200
+
+    def _record(self, data):
+        try:
+            with open(self.record_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"[Webhook Record Error] {e}")
+
+    @staticmethod
+    def _respond(writer, status, keep_alive):
+        body = b"" if status == 200 else _REASONS.get(status, "Error").encode("ascii")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'Error')}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("ascii") + body
+        )
+
+async def run_webhook(application, config):
+    """Serve `application` through a WebhookServer until interrupted.
+
+    Mirrors Application.run_polling: initialize, post_init, start,
+    then stop, post_shutdown and shutdown on the way out.
+    """
+    server = WebhookServer(
+        application,
+        config.WEBHOOK_SECRET,
+        host=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        path=config.WEBHOOK_PATH,
+        record_file=config.WEBHOOK_RECORD_FILE,
+    )
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        await server.start()
+        if config.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            )
+            print(f"[Webhook] registered {config.WEBHOOK_URL.rstrip('/')}{config.WEBHOOK_PATH}")
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C still cancels the task
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+# ====== Replay =======
+def load_updates(path):
+    """Updates from a JSON file (one object or a list) or a JSON-lines file"""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+def replay(updates, url, secret, delay=0.0):
+    """POST recorded updates to a running webhook; returns the status codes"""
+    statuses = []
+    for update in updates:
+        request = urllib.request.Request(
+            url,
+            data=json.dumps(update).encode("utf-8"),
+            headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+            method="POST",
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=10) as resp:
+                status = resp.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except urllib.error.URLError as e:
+            print(f"[Replay Error] {url}: {e.reason}")
+            statuses.append(None)
+            break
+        statuses.append(status)
+        print(f"update {update.get('update_id')}: {status} in {(time.perf_counter() - started) * 1000:.1f} ms")
+        if delay:
+            time.sleep(delay)
+    return statuses
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the webhook")
+    parser.add_argument("file", help="JSON or JSON-lines file with updates")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}"
+                                         f"{os.getenv('WEBHOOK_PATH', '/telegram')}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds between updates")
+    args = parser.parse_args(argv)
+    statuses = replay(load_updates(args.file), args.url, args.secret, args.delay)
+    return 0 if all(status == 200 for status in statuses) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())